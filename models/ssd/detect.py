@@ -5,10 +5,12 @@ BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 sys.path.insert(0, BASE_PATH)
 
 from torchvision import transforms
+from models.ssd.model import is_quantized
 from models.ssd.utils import *
 from utils.utils import *
 from PIL import Image, ImageDraw, ImageFont
 from utils.datasets import SingleImage
+from utils.runtime import is_backend_path, load_backend
 
 
 
@@ -44,12 +46,12 @@ def detect(model, image_path, min_score, max_overlap, top_k, suppress=None, clas
     # Transform
     #image = normalize(to_tensor(resize(original_image)))
     tf = SingleImage(input_size)
-    image = tf.apply_transform(image_path)
+    image, _ = tf.apply_transform(image_path)
     # image = normalize(image1)
 
-    # Move to default device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    image = image.to(device)
+    # Move to the model device (backends and quantized models run on the CPU)
+    device = next(model.parameters()).device if isinstance(model, torch.nn.Module) else torch.device("cpu")
+    image = normalize_batch(image, device)
 
     # Forward prop.
     model.eval()
@@ -73,7 +75,12 @@ def detect(model, image_path, min_score, max_overlap, top_k, suppress=None, clas
 
 if __name__ == '__main__':
     model_path = "/home/salvacarrion/Documents/Programming/Python/Projects/yolo4math/checkpoints/ssd_best.pth"
-    model = torch.load(model_path)
+    if is_backend_path(model_path):
+        model = load_backend(model_path)
+    else:
+        model = torch.load(model_path, map_location="cpu")
+        if not is_quantized(model):  # Quantized models (see quantize.py) only run on the CPU
+            model = model.to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
     model.eval()
 
     img_path = '/home/salvacarrion/Documents/datasets/equations/1024/{}'
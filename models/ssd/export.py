@@ -0,0 +1,34 @@
+import os
+import sys
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, BASE_PATH)
+
+import torch
+
+from models.ssd.model import export_ssd
+from utils.runtime import ONNXBackend, check_parity
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights_path", type=str, default=BASE_PATH+"/checkpoints/ssd_best.pth", help="path to the saved model")
+    parser.add_argument("--check_parity", type=int, default=True, help="compare the ONNX Runtime outputs against PyTorch")
+    parser.add_argument("--output", type=str, default=BASE_PATH+"/checkpoints/ssd.onnx", help="path to the exported graph")
+    opt = parser.parse_args()
+    print(opt)
+
+    # Load model (exported on the CPU)
+    model = torch.load(opt.weights_path, map_location="cpu")
+    model.priors_cxcy = model.priors_cxcy.cpu()
+    model.eval()
+
+    export_ssd(model, opt.output)
+    print("Model exported! => {}".format(opt.output))
+
+    if opt.check_parity:
+        backend = ONNXBackend(opt.output)
+        diffs = check_parity(model, backend, model.input_size, batch_size=2)
+        print("\t+ Parity {}: max. abs. diff (locs, scores) {:.6f}, {:.6f}".format(model.input_size, *diffs))
+        assert torch.allclose(backend.priors_cxcy, model.priors_cxcy), "Different priors"
@@ -1,5 +1,7 @@
+import copy
 from torch import nn
 from models.ssd.utils import *
+from utils.utils import nms_groups
 import torch.nn.functional as F
 from math import sqrt, ceil
 from itertools import product as product
@@ -471,99 +473,54 @@ class SSD300(nn.Module):
         :return: detections (boxes, labels, and scores), lists of length batch_size
         """
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
         batch_size = predicted_locs.size(0)
         n_priors = self.priors_cxcy.size(0)
         predicted_scores = F.softmax(predicted_scores, dim=2)  # (N, 8732, n_classes)
 
-        # Lists to store final predicted boxes, labels, and scores for all images
-        all_images_boxes = list()
-        all_images_labels = list()
-        all_images_scores = list()
-
         assert n_priors == predicted_locs.size(1) == predicted_scores.size(1)
 
         if cpu:
-            device = torch.device("cpu")
             predicted_locs = predicted_locs.cpu()
             predicted_scores = predicted_scores.cpu()
-            self.priors_cxcy = self.priors_cxcy.cpu()
+        device = predicted_locs.device
+        priors_cxcy = self.priors_cxcy.to(device)  # Keep the model priors where they are
 
-        for i in range(batch_size):
-            # Decode object coordinates from the form we regressed predicted boxes to
-            decoded_locs = cxcy_to_xy(
-                gcxgcy_to_cxcy(predicted_locs[i], self.priors_cxcy))  # (8732, 4), these are fractional pt. coordinates
-
-            # Lists to store boxes and scores for this image
-            image_boxes = list()
-            image_labels = list()
-            image_scores = list()
-
-            max_scores, best_label = predicted_scores[i].max(dim=1)  # (8732)
-
-            # Check for each class
-            for c in range(1, self.n_classes):
-                # Keep only predicted boxes and scores where scores for this class are above the minimum score
-                class_scores = predicted_scores[i][:, c]  # (8732)
-                score_above_min_score = class_scores > min_score  # torch.uint8 (byte) tensor, for indexing
-                n_above_min_score = score_above_min_score.sum().item()
-                if n_above_min_score == 0:
-                    continue
-                class_scores = class_scores[score_above_min_score]  # (n_qualified), n_min_score <= 8732
-                class_decoded_locs = decoded_locs[score_above_min_score]  # (n_qualified, 4)
-
-                # Sort predicted boxes and scores by scores
-                class_scores, sort_ind = class_scores.sort(dim=0, descending=True)  # (n_qualified), (n_min_score)
-
-                # # Control maxium number of hypothesis
-                # max_indxs = min(len(sort_ind), 8000)
-                # class_scores = class_scores[:max_indxs]
-                # sort_ind = sort_ind[:max_indxs]
-                n_above_min_score = len(sort_ind)
-
-                class_decoded_locs = class_decoded_locs[sort_ind]  # (n_min_score, 4)
-
-                # Find the overlap between predicted boxes
-                overlap = find_jaccard_overlap(class_decoded_locs, class_decoded_locs)  # (n_qualified, n_min_score)
-
-                # Non-Maximum Suppression (NMS)
-
-                # A torch.uint8 (byte) tensor to keep track of which predicted boxes to suppress
-                # 1 implies suppress, 0 implies don't suppress
-                suppress = torch.zeros((n_above_min_score), dtype=torch.uint8).to(device)  # (n_qualified)
-
-                # Consider each box in order of decreasing scores
-                for box in range(class_decoded_locs.size(0)):
-                    # If this box is already marked for suppression
-                    if suppress[box] == 1:
-                        continue
-
-                    # Suppress boxes whose overlaps (with this box) are greater than maximum overlap
-                    # Find such boxes and update suppress indices
-                    suppress = torch.max(suppress.type(torch.uint8), (overlap[box] > max_overlap).type(torch.uint8))
-                    # The max operation retains previously suppressed boxes, like an 'OR' operation
-
-                    # Don't suppress this box, even though it has an overlap of 1 with itself
-                    suppress[box] = 0
-
-                # Store only unsuppressed boxes for this class
-                image_boxes.append(class_decoded_locs[1 - suppress])
-                image_labels.append(torch.LongTensor((1 - suppress).sum().item() * [c]).to(device))
-                image_scores.append(class_scores[1 - suppress])
+        # Decode object coordinates of all images at once
+        decoded_locs = cxcy_to_xy(gcxgcy_to_cxcy(predicted_locs.reshape(-1, 4), priors_cxcy.repeat(batch_size, 1)))
+        decoded_locs = decoded_locs.view(batch_size, n_priors, 4)  # (N, 8732, 4), fractional pt. coordinates
 
-            # If no object in any class is found, store a placeholder for 'background'
-            if len(image_boxes) == 0:
-                image_boxes.append(torch.FloatTensor([[0., 0., 1., 1.]]).to(device))
-                image_labels.append(torch.LongTensor([0]).to(device))
-                image_scores.append(torch.FloatTensor([0.]).to(device))
-
-            # Concatenate into single tensors
-            image_boxes = torch.cat(image_boxes, dim=0)  # (n_objects, 4)
-            image_labels = torch.cat(image_labels, dim=0)  # (n_objects)
-            image_scores = torch.cat(image_scores, dim=0)  # (n_objects)
+        # Keep every (image, prior, class) whose score is above the minimum score (background excluded)
+        image_idxs, prior_idxs, class_idxs = (predicted_scores[:, :, 1:] > min_score).nonzero(as_tuple=True)
+        class_idxs = class_idxs + 1
+        boxes = decoded_locs[image_idxs, prior_idxs]  # (n_qualified, 4)
+        scores = predicted_scores[image_idxs, prior_idxs, class_idxs]  # (n_qualified)
+
+        # Non-Maximum Suppression (NMS) for each (image, class) at once
+        groups = image_idxs * self.n_classes + class_idxs
+        keep, _ = nms_groups(boxes, scores, groups, nms_thres=max_overlap, iou_fn=find_jaccard_overlap)
+
+        # Order by image, then class, then decreasing score (as the per-class loop did)
+        keep = keep[(groups[keep] * keep.numel() + torch.arange(keep.numel(), device=device)).argsort()]
+        boxes, class_idxs, scores, image_idxs = boxes[keep], class_idxs[keep], scores[keep], image_idxs[keep]
+
+        # Lists to store final predicted boxes, labels, and scores for all images
+        all_images_boxes = list()
+        all_images_labels = list()
+        all_images_scores = list()
+
+        image_counts = torch.bincount(image_idxs, minlength=batch_size).tolist()
+        image_boxes_list = boxes.split(image_counts)
+        image_labels_list = class_idxs.split(image_counts)
+        image_scores_list = scores.split(image_counts)
+        for image_boxes, image_labels, image_scores in zip(image_boxes_list, image_labels_list, image_scores_list):
             n_objects = image_scores.size(0)
 
+            # If no object in any class is found, store a placeholder for 'background'
+            if n_objects == 0:
+                image_boxes = torch.FloatTensor([[0., 0., 1., 1.]]).to(device)
+                image_labels = torch.LongTensor([0]).to(device)
+                image_scores = torch.FloatTensor([0.]).to(device)
+
             # Keep only the top k objects
             if n_objects > top_k:
                 image_scores, sort_ind = image_scores.sort(dim=0, descending=True)
@@ -579,6 +536,74 @@ class SSD300(nn.Module):
         return all_images_boxes, all_images_labels, all_images_scores  # lists of length batch_size
 
 
+class SSDExport(nn.Module):
+    """
+    SSD300 whose graph also outputs its priors (they depend on the input size), as exported by export_ssd.
+    """
+
+    def __init__(self, model):
+        super(SSDExport, self).__init__()
+        self.model = model
+        self.register_buffer("priors", model.priors_cxcy.clone())
+
+    def forward(self, image):
+        locs, classes_scores = self.model(image)
+        return locs, classes_scores, self.priors
+
+
+def export_ssd(model, onnx_path, batch_size=1, opset_version=11):
+    """
+    Exports a SSD300 to ONNX, with a dynamic batch size (height and width are the model input size).
+
+    :param model: SSD300 (its priors are exported as a constant output)
+    :return: graph: images (N, 3, H, W) => locs (N, n_priors, 4), scores (N, n_priors, n_classes), priors (n_priors, 4)
+    """
+    model.eval()
+    height, width = model.input_size
+    dummy = torch.zeros(batch_size, 3, height, width, device=model.rescale_factors.device)
+    with torch.no_grad():
+        torch.onnx.export(
+            SSDExport(model), dummy, onnx_path,
+            input_names=["images"], output_names=["locs", "scores", "priors"],
+            dynamic_axes={"images": {0: "batch"}, "locs": {0: "batch"}, "scores": {0: "batch"}},
+            opset_version=opset_version,
+        )
+    return onnx_path
+
+
+def quantize_ssd(model, calibration_batches, backend="fbgemm"):
+    """
+    Post-training INT8 quantization of the prediction convolutions of a SSD300, for CPU inference.
+    Each convolution is quantized on its own (its output is dequantized), the rest of the model stays in float.
+
+    :param model: SSD300 (it is not modified)
+    :param calibration_batches: iterable of images, to calibrate the activations
+    :return: a quantized copy of the model, on the CPU
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model.priors_cxcy = model.priors_cxcy.cpu()
+    pred_convs = model.pred_convs
+    for name, module in list(pred_convs.named_children()):
+        if isinstance(module, nn.Conv2d):
+            setattr(pred_convs, name, nn.Sequential(torch.quantization.QuantStub(), module,
+                                                    torch.quantization.DeQuantStub()))
+
+    torch.backends.quantized.engine = backend
+    pred_convs.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(pred_convs, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            model(images.cpu())
+    torch.quantization.convert(pred_convs, inplace=True)
+    return model
+
+
+def is_quantized(model):
+    """Whether a model has quantized modules (see quantize_ssd): they only run on the CPU"""
+    return any(type(module).__module__.startswith(("torch.nn.quantized", "torch.ao.nn.quantized"))
+               for module in model.modules())
+
+
 class MultiBoxLoss(nn.Module):
     """
     The MultiBox loss, a loss function for object detection.
@@ -0,0 +1,85 @@
+import os
+import sys
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, BASE_PATH)
+
+import torch
+from terminaltables import AsciiTable
+
+from models.ssd.model import quantize_ssd
+from models.ssd.test import make_predictions
+
+from utils.utils import *
+from utils.datasets import *
+from utils.parse_config import *
+from utils.evaluate import *
+from utils.runtime import TorchBackend
+
+
+def get_model_stats(model, dataloader, n_classes, conf_thres, nms_thres, top_k):
+    det_boxes, det_labels, det_scores, true_boxes, true_labels = \
+        make_predictions(dataloader, model, min_score=conf_thres, max_overlap=nms_thres, top_k=top_k)
+    matrix = confusion_matrix(det_boxes, det_labels, det_scores, true_boxes, true_labels, n_classes, ignore_bg=True)
+    return get_stats(matrix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=1, help="size of each image batch")
+    parser.add_argument("--data_config", type=str, default=BASE_PATH+"/config/custom.data", help="path to data config file")
+    parser.add_argument("--weights_path", type=str, help="path to the saved float model")
+    parser.add_argument("--calibration_size", type=int, default=64, help="number of training images used to calibrate the activations")
+    parser.add_argument("--backend", type=str, default="fbgemm", help="quantized engine (fbgemm: x86, qnnpack: ARM)")
+    parser.add_argument("--conf_thres", type=float, default=0.5, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.3, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--top_k", type=int, default=200, help="Keep top K best hypothesis")
+    parser.add_argument("--report", type=int, default=True, help="compare the mAP of the float and the quantized model (test set)")
+    parser.add_argument("--output", type=str, default=BASE_PATH+"/checkpoints/ssd_int8.pth", help="path to the quantized model (CPU only: test.py and detect.py load it on the CPU)")
+    opt = parser.parse_args()
+    print(opt)
+
+    # Float model (quantized models run on the CPU)
+    model = torch.load(opt.weights_path, map_location="cpu")
+    model.priors_cxcy = model.priors_cxcy.cpu()
+    model.eval()
+
+    data_config = parse_data_config(opt.data_config)
+    train_path = data_config["train"].format(model.input_size[0])
+    test_path = data_config["test"].format(model.input_size[0])
+    labels_path = data_config["labels"]
+    class_names = load_classes(data_config["classes"])
+    class_names.insert(0, 'background')
+
+    # Calibration subset (default format: no augmentation)
+    dataset = ListDatasetSSD(images_path=train_path, labels_path=labels_path, input_size=model.input_size,
+                             class_names=class_names)
+    indices = np.random.RandomState(0).permutation(len(dataset))[:opt.calibration_size].tolist()
+    dataloader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices), batch_size=opt.batch_size, shuffle=False, num_workers=0,
+        collate_fn=dataset.collate_fn
+    )
+
+    print("Calibrating ({} images)...".format(len(indices)))
+    quantized = quantize_ssd(model, (normalize_batch(images) for _, images, _, _, _ in dataloader), backend=opt.backend)
+    torch.save(quantized, opt.output)
+    print("Quantized model saved! => {}".format(opt.output))
+
+    # Accuracy report
+    if opt.report:
+        dataset = ListDatasetSSD(images_path=test_path, labels_path=labels_path, input_size=model.input_size,
+                                 class_names=class_names)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=opt.batch_size, shuffle=False, num_workers=0, collate_fn=dataset.collate_fn
+        )
+
+        print("Evaluating the float model...")
+        stats = get_model_stats(TorchBackend(model, device=torch.device("cpu")), dataloader,
+                                len(class_names), opt.conf_thres, opt.nms_thres, opt.top_k)
+        print("Evaluating the quantized model...")
+        quantized_stats = get_model_stats(TorchBackend(quantized, device=torch.device("cpu")), dataloader,
+                                          len(class_names), opt.conf_thres, opt.nms_thres, opt.top_k)
+
+        print(AsciiTable(compare_stats(stats, quantized_stats, class_names)).table)
+        save_dataset({'float': stats, 'int8': quantized_stats}, os.path.splitext(opt.output)[0] + "_report.json")
@@ -19,6 +19,7 @@ from torch.autograd import Variable
 import torch.optim as optim
 from torch.utils.data.sampler import SubsetRandomSampler
 
+from models.ssd.model import is_quantized
 from models.ssd.utils import find_jaccard_overlap
 
 from terminaltables import AsciiTable
@@ -27,6 +28,7 @@ from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
 from utils.evaluate import *
+from utils.runtime import is_backend_path, load_backend
 
 
 def evaluate_raw(model, images_path, labels_path, iou_thres, conf_thres, nms_thres, input_size, batch_size, top_k, class_names=None,  plot_detections=None):
@@ -47,10 +49,10 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, to
 
     labels = []
     sample_metrics = []  # List of tuples (TP, confs, pred)
-    for batch_i, (img_paths, images, boxes, labels) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
+    for batch_i, (img_paths, images, boxes, labels, letterboxes) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
     # for batch_i, (images_path, input_imgs, targets) in enumerate(dataloader, 1):
 
-        images = Variable(images.type(Tensor), requires_grad=False)
+        images = Variable(normalize_batch(images).type(Tensor), requires_grad=False)
 
         # Forward prop.
         predicted_locs, predicted_scores = model(images)
@@ -71,7 +73,6 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, to
                 save_path = BASE_PATH+'/outputs/{}'.format(img_paths[0].split('/')[-1])
                 # Scale target bboxes
                 input_img = img2img(images[0])
-                ori_img = img2img(img_paths[0])
 
                 # Output
                 p_bboxes = det_boxes[0].cpu().data.numpy()
@@ -79,8 +80,13 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, to
                 t_bboxes = boxes[0].cpu().data.numpy()
 
                 if use_original:
-                    p_bboxes = rescale_boxes(p_bboxes, current_shape=input_img.shape[:2], original_shape=ori_img.shape[:2], relxyxy=True)
-                    t_bboxes = rescale_boxes(t_bboxes, current_shape=input_img.shape[:2], original_shape=ori_img.shape[:2], relxyxy=True)
+                    # REL(xyxy) in the input => ABS(xyxy) in the page (letterbox record: no need to read it again)
+                    img_h, img_w = input_img.shape[:2]
+                    p_bboxes = rel2abs(torch.from_numpy(p_bboxes), img_h, img_w)
+                    t_bboxes = rel2abs(torch.from_numpy(t_bboxes), img_h, img_w)
+                    p_bboxes = unletterbox_boxes(p_bboxes, letterboxes[0:1].expand(len(p_bboxes), -1)).numpy()
+                    t_bboxes = unletterbox_boxes(t_bboxes, letterboxes[0:1].expand(len(t_bboxes), -1)).numpy()
+                    ori_img = img2img(img_paths[0])
                     plot_bboxes(ori_img, p_bboxes,  class_ids=p_labels, class_names=class_names, show_results=False, coords_rel=False,
                                 t_bboxes=t_bboxes, title="Detection + ground truth ({})".format(img_paths[0]), save_path=save_path)
                 else:
@@ -104,8 +110,8 @@ def make_predictions(dataloader, model, min_score=0.01, max_overlap=0.45, top_k=
     with torch.no_grad():
 
         # Get predictions
-        for batch_i, (img_paths, images, boxes, labels) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
-            images = images.to(device)
+        for batch_i, (img_paths, images, boxes, labels, _) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
+            images = normalize_batch(images, device)
             batch_size = len(img_paths)
 
             # Forward prop.
@@ -142,9 +148,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", type=int, default=1, help="size of each image batch")
     parser.add_argument("--data_config", type=str, default=BASE_PATH+"/config/custom.data", help="path to data config file")
-    parser.add_argument("--weights_path", type=str, help="if specified starts from checkpoint model")
+    parser.add_argument("--weights_path", type=str, help="if specified starts from checkpoint model (or an exported *.onnx / quantized *.jit)")
     parser.add_argument("--input_size", default=(1024, 1024), help="size of each image dimension")
     parser.add_argument("--n_cpu", type=int, default=1, help="number of cpu threads to use during batch generation")
+    parser.add_argument("--n_threads", type=int, default=None, help="number of ONNX Runtime threads (*.onnx and *.jit only)")
     parser.add_argument("--shuffle_dataset", type=int, default=False, help="shuffle dataset")
     parser.add_argument("--validation_split", type=float, default=0.0, help="validation split [0..1]")
     parser.add_argument("--checkpoint_dir", type=str, default=BASE_PATH+"/checkpoints", help="path to checkpoint folder")
@@ -165,8 +172,15 @@ if __name__ == "__main__":
     class_names = load_classes(dataset_path + data_config["classes"])
     class_names.insert(0, 'background')
 
-    # Load model
-    model = torch.load(opt.weights_path).to(device)
+    # Load model (or an exported graph, run with ONNX Runtime on the CPU)
+    if is_backend_path(opt.weights_path):
+        model = load_backend(opt.weights_path, num_threads=opt.n_threads)
+    else:
+        model = torch.load(opt.weights_path, map_location="cpu")
+        if is_quantized(model):
+            print("Quantized model (see quantize.py): evaluating on the CPU")
+            device = torch.device("cpu")
+        model = model.to(device)
 
     print("\nEvaluating model:\n")
 
@@ -170,7 +170,7 @@ if __name__ == "__main__":
         # Train model
         epoch_batches_done = 0
 
-        for batch_i, (img_paths, images, boxes, labels) in enumerate(train_loader, 1):
+        for batch_i, (img_paths, images, boxes, labels, _) in enumerate(train_loader, 1):
 
             if boxes is None or len(boxes) == 0:
                 # print("Skipping image #{}...".format(batch_i))
@@ -188,7 +188,7 @@ if __name__ == "__main__":
 
             # Inputs/Targets to device
             # Move to default device
-            images = images.to(device)  # (batch_size (N), 3, 300, 300)
+            images = normalize_batch(images, device)  # (batch_size (N), 3, 300, 300), uint8 => float
             boxes = [b.to(device) for b in boxes]
             labels = [l.to(device) for l in labels]
 
@@ -1,5 +1,8 @@
 from __future__ import division
 
+import copy
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,7 +10,7 @@ from torch.autograd import Variable
 import numpy as np
 
 from utils.parse_config import *
-from utils.utils import build_targets, to_cpu, non_max_suppression
+from utils.utils import build_targets, to_cpu
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -83,6 +86,46 @@ def create_modules(module_defs, input_size):
     return hyperparams, module_list
 
 
+def config_channels(config_path):
+    """Input channels of a model definition (1: grayscale pages, see ImageFolder/ListDataset 'single_channel')"""
+    return int(parse_model_config(config_path)[0]["channels"])
+
+
+def plan_memory(module_defs):
+    """
+    Liveness analysis of the layer outputs (module_defs without hyperparams).
+
+    Returns:
+        free_after: for each layer, the layers whose outputs are not read anymore once it has run
+        inplace_shortcuts: shortcut layers that can add in place into their input (it is not read afterwards)
+    """
+    num_layers = len(module_defs)
+    last_use = list(range(num_layers))  # Unused outputs die as soon as they are created
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "route":
+            inputs = [int(layer_i) for layer_i in module_def["layers"].split(",")]
+        elif module_def["type"] == "shortcut":
+            inputs = [-1, int(module_def["from"])]
+        else:
+            inputs = [-1]  # Previous output (x)
+        for layer_i in inputs:
+            layer_i = i + layer_i if layer_i < 0 else layer_i
+            if layer_i >= 0:
+                last_use[layer_i] = max(last_use[layer_i], i)
+
+    free_after = [[] for _ in range(num_layers)]
+    for layer_i, i in enumerate(last_use):
+        free_after[i].append(layer_i)
+
+    inplace_shortcuts = set()
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "shortcut" and i > 0 and last_use[i - 1] == i:
+            from_i = int(module_def["from"])
+            if (i + from_i if from_i < 0 else from_i) != i - 1:
+                inplace_shortcuts.add(i)
+    return free_after, inplace_shortcuts
+
+
 class Upsample(nn.Module):
     """ nn.Upsample is deprecated """
 
@@ -120,32 +163,71 @@ class YOLOLayer(nn.Module):
         self.metrics = {}
         self.img_dim = img_dim
         self.grid_size = 0  # grid size
+        self.grids = {}  # (grid_h, grid_w, device, dtype) => (grid_xy, anchor_wh, stride)
+
+    def get_grid(self, grid_h, grid_w, device, dtype):
+        """
+        Cell offsets (1, 1, grid_h, grid_w, 2), anchors in pixels (1, num_anchors, 1, 1, 2) and stride of a grid.
+        They are computed once per grid shape, so changing the input size (multiscale) does not rebuild them
+        """
+        key = (grid_h, grid_w, device, dtype)
+        if key not in self.grids:
+            stride = self.img_dim / grid_h  # Same stride for both dimensions
+            grid_x = torch.arange(grid_w, dtype=dtype, device=device).repeat(grid_h, 1)
+            grid_y = torch.arange(grid_h, dtype=dtype, device=device).repeat(grid_w, 1).t()
+            grid_xy = torch.stack((grid_x, grid_y), -1).view(1, 1, grid_h, grid_w, 2)
+            anchor_wh = torch.tensor(self.anchors, dtype=dtype, device=device).view(1, self.num_anchors, 1, 1, 2)
+            self.grids[key] = (grid_xy, anchor_wh, stride)
+        return self.grids[key]
 
     def compute_grid_offsets(self, grid_size, cuda=True):
-        self.grid_size = grid_size
-        g = self.grid_size
-        FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
-        self.stride = self.img_dim / self.grid_size
+        # grid_size => (grid_h, grid_w) (or a single int for square grids)
+        self.grid_size = grid_size if isinstance(grid_size, tuple) else (grid_size, grid_size)
+        g_h, g_w = self.grid_size
+        device = torch.device("cuda" if cuda else "cpu")
+        grid_xy, anchor_wh, self.stride = self.get_grid(g_h, g_w, device, torch.float32)
         # Calculate offsets for each grid
-        self.grid_x = torch.arange(g).repeat(g, 1).view([1, 1, g, g]).type(FloatTensor)
-        self.grid_y = torch.arange(g).repeat(g, 1).t().view([1, 1, g, g]).type(FloatTensor)
-        self.scaled_anchors = FloatTensor([(a_w / self.stride, a_h / self.stride) for a_w, a_h in self.anchors])
+        self.grid_x = grid_xy[..., 0]
+        self.grid_y = grid_xy[..., 1]
+        self.scaled_anchors = anchor_wh.view(self.num_anchors, 2) / self.stride
         self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
         self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
 
-    def forward(self, x, targets=None, img_dim=None):
+    def decode(self, x, out=None):
+        """
+        Inference-only decoding => (num_samples, num_anchors*grid_h*grid_w, ABS(cxcywh) + obj_conf + class probs)
+        Writes straight into 'out' (a slice of the Darknet output buffer) if given
+        """
+        num_samples, _, grid_h, grid_w = x.shape
+        grid_xy, anchor_wh, stride = self.get_grid(grid_h, grid_w, x.device, x.dtype)
+
+        prediction = x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_h, grid_w).permute(0, 1, 3, 4, 2)
+        if out is None:
+            out = x.new_empty((num_samples, self.num_anchors * grid_h * grid_w, self.num_classes + 5))
+        output = out.view(num_samples, self.num_anchors, grid_h, grid_w, self.num_classes + 5)
+
+        output[..., 0:2].copy_(prediction[..., 0:2]).sigmoid_().add_(grid_xy).mul_(stride)  # Centers
+        output[..., 2:4].copy_(prediction[..., 2:4]).exp_().mul_(anchor_wh)  # Width and height
+        output[..., 4:].copy_(prediction[..., 4:]).sigmoid_()  # Conf + Cls pred.
+        return out
+
+    def forward(self, x, targets=None, img_dim=None, out=None):
 
         # Tensors for cuda support
         FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
         LongTensor = torch.cuda.LongTensor if x.is_cuda else torch.LongTensor
         ByteTensor = torch.cuda.ByteTensor if x.is_cuda else torch.ByteTensor
 
-        self.img_dim = img_dim
+        self.img_dim = img_dim  # Image height
         num_samples = x.size(0)
-        grid_size = x.size(2)
+        grid_size = (x.size(2), x.size(3))  # (grid_h, grid_w)
+
+        # Fast path (inference): no loss, so there is nothing to keep for autograd
+        if targets is None and not torch.is_grad_enabled():
+            return self.decode(x, out), 0
 
         prediction = (
-            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
+            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size[0], grid_size[1])
             .permute(0, 1, 3, 4, 2)
             .contiguous()
         )
@@ -226,7 +308,7 @@ class YOLOLayer(nn.Module):
                 "precision": to_cpu(precision).item(),
                 "conf_obj": to_cpu(conf_obj).item(),
                 "conf_noobj": to_cpu(conf_noobj).item(),
-                "grid_size": grid_size,
+                "grid_size": grid_size[0],
             }
 
             return output, total_loss
@@ -243,11 +325,46 @@ class Darknet(nn.Module):
         self.input_size = input_size
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
+        self.output_shapes = {}  # input key => output shape, for inference
+        self.output_buffer = None  # (input key, tensor) overwritten by each call with reuse_output=True
+        self.free_after, self.inplace_shortcuts = plan_memory(self.module_defs)
+
+    @staticmethod
+    def output_key(x):
+        return x.size(0), x.size(2), x.size(3), x.device, x.dtype
 
-    def forward(self, x, targets=None):
+    def get_output_buffer(self, x, out=None, reuse_output=False):
+        """
+        Buffer the YOLO layers decode into for inference (None until the layout of this input is known).
+        'out' is used as given. With reuse_output, the buffer of the previous call with the same input shape is
+        overwritten (clone the output to keep it); otherwise a new tensor owned by the caller is allocated
+        """
+        key = self.output_key(x)
+        if key not in self.output_shapes:
+            return None
+        shape = self.output_shapes[key]
+        if out is not None:
+            if tuple(out.shape) != shape:
+                raise ValueError("out has shape {}, expected {}".format(tuple(out.shape), shape))
+            return out
+        if reuse_output:
+            if self.output_buffer is None or self.output_buffer[0] != key:
+                self.output_buffer = (key, x.new_empty(shape))
+            return self.output_buffer[1]
+        return x.new_empty(shape)
+
+    def forward(self, x, targets=None, out=None, reuse_output=False):
         img_dim = x.shape[2]
         loss = 0
         layer_outputs, yolo_outputs = [], []
+
+        # Inference => the YOLO layers decode straight into a single buffer, and residuals are added in place
+        inference = not torch.is_grad_enabled()
+        use_buffer = inference and targets is None
+        output = self.get_output_buffer(x, out, reuse_output) if use_buffer else None
+        output_key = self.output_key(x)
+        offset = 0
+
         for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
             if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
                 x = module(x)
@@ -255,17 +372,80 @@ class Darknet(nn.Module):
                 x = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
             elif module_def["type"] == "shortcut":
                 layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
+                if inference and i in self.inplace_shortcuts:
+                    x = layer_outputs[-1].add_(layer_outputs[layer_i])  # Its input is not read anymore
+                else:
+                    x = layer_outputs[-1] + layer_outputs[layer_i]
             elif module_def["type"] == "yolo":
-                x, layer_loss = module[0](x, targets, img_dim)
+                out_rows = None
+                if output is not None:
+                    rows = module[0].num_anchors * x.size(2) * x.size(3)
+                    out_rows = output[:, offset:offset + rows]
+                    offset += rows
+                x, layer_loss = module[0](x, targets, img_dim, out=out_rows)
                 loss += layer_loss
                 yolo_outputs.append(x)
             layer_outputs.append(x)
-        yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
+
+            # Drop the outputs that no later layer reads (the list keeps its indices)
+            for layer_i in self.free_after[i]:
+                layer_outputs[layer_i] = None
+
+        if output is None:
+            # First call with this input shape => learn the layout
+            output = torch.cat(yolo_outputs, 1)
+            if use_buffer:
+                self.output_shapes[output_key] = tuple(output.shape)
+                if out is not None:
+                    output = out.copy_(output)
+                elif reuse_output:
+                    self.output_buffer = (output_key, output)
+        yolo_outputs = to_cpu(output)
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
-    def load_darknet_weights(self, weights_path, cutoff=None, freeze_layers=None):
-        """Parses and loads the weights stored in 'weights_path'"""
+    def fuse(self):
+        """
+        Folds each BatchNorm2d into the weights and bias of its Conv2d (inference only), in place.
+        Load the weights (*.pth or *.weights) before fusing: fused layers no longer have batch normalization
+        """
+        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
+            if module_def["type"] != "convolutional" or not int(module_def["batch_normalize"]):
+                continue
+
+            conv, bn = module[0], module[1]
+            fused_conv = nn.Conv2d(
+                in_channels=conv.in_channels,
+                out_channels=conv.out_channels,
+                kernel_size=conv.kernel_size,
+                stride=conv.stride,
+                padding=conv.padding,
+                bias=True,
+            ).to(conv.weight.device)
+
+            # W' = W * gamma/sqrt(var + eps); b' = beta - mean * gamma/sqrt(var + eps)
+            with torch.no_grad():
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                fused_conv.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+                fused_conv.bias.copy_(bn.bias - bn.running_mean * scale)
+
+            # Rebuild the block without the batch normalization
+            modules = nn.Sequential()
+            modules.add_module("conv_{}".format(i), fused_conv)
+            for name, layer in list(module.named_children())[2:]:
+                modules.add_module(name, layer)
+            self.module_list[i] = modules
+            module_def["batch_normalize"] = 0  # Conv. bias is now used (eg. by save_darknet_weights)
+        return self
+
+    def load_darknet_weights(self, weights_path, cutoff=None, freeze_layers=None, in_channels=None):
+        """
+        Parses and loads the weights stored in 'weights_path'.
+        in_channels: input channels of the weights (None => 3 for darknet53.conv.74, else the model's own input
+        channels, eg. weights written by save_darknet_weights). RGB weights are summed into a single-channel
+        first convolution (same response to a gray image: R=G=B)
+        """
+        if in_channels is None:
+            in_channels = 3 if "darknet53.conv.74" in weights_path else int(self.hyperparams["channels"])
 
         # Open the weights file
         with open(weights_path, "rb") as f:
@@ -318,8 +498,17 @@ class Darknet(nn.Module):
                     conv_layer.bias.data.copy_(conv_b)
                     ptr += num_b
                 # Load conv. weights
-                num_w = conv_layer.weight.numel()
-                conv_w = torch.from_numpy(weights[ptr : ptr + num_w]).view_as(conv_layer.weight)
+                if i == 0 and conv_layer.in_channels != in_channels:
+                    if conv_layer.in_channels != 1:
+                        raise ValueError("Cannot load {}-channel weights into a {}-channel model".format(
+                            in_channels, conv_layer.in_channels))
+                    out_c, _, k_h, k_w = conv_layer.weight.shape
+                    num_w = out_c * in_channels * k_h * k_w
+                    conv_w = torch.from_numpy(weights[ptr : ptr + num_w]).view(out_c, in_channels, k_h, k_w)
+                    conv_w = conv_w.sum(dim=1, keepdim=True)  # RGB => gray
+                else:
+                    num_w = conv_layer.weight.numel()
+                    conv_w = torch.from_numpy(weights[ptr : ptr + num_w]).view_as(conv_layer.weight)
                 conv_layer.weight.data.copy_(conv_w)
                 ptr += num_w
 
@@ -349,4 +538,223 @@ class Darknet(nn.Module):
                 # Load conv weights
                 conv_layer.weight.data.cpu().numpy().tofile(fp)
 
-        fp.close()
\ No newline at end of file
+        fp.close()
+
+class LayerStep(nn.Module):
+    """Compiled conv/maxpool block (reads the previous output only)"""
+
+    def __init__(self, module, slot):
+        super(LayerStep, self).__init__()
+        self.module = module
+        self.slot = slot  # Slot to save the output to (-1 => not read by a route/shortcut)
+
+    def forward(self, x, slots: List[torch.Tensor]):
+        return self.module(x)
+
+
+class UpsampleStep(nn.Module):
+    """Compiled upsample layer"""
+
+    def __init__(self, scale_factor, slot):
+        super(UpsampleStep, self).__init__()
+        self.scale_factor = float(scale_factor)
+        self.slot = slot
+
+    def forward(self, x, slots: List[torch.Tensor]):
+        return F.interpolate(x, scale_factor=self.scale_factor, mode="nearest")
+
+
+class RouteStep(nn.Module):
+    """Compiled route layer (concatenates saved outputs)"""
+
+    def __init__(self, input_slots, slot):
+        super(RouteStep, self).__init__()
+        self.input_slots = input_slots
+        self.slot = slot
+        self.cat = nn.quantized.FloatFunctional()  # Plain torch.cat unless quantized
+
+    def forward(self, x, slots: List[torch.Tensor]):
+        return self.cat.cat([slots[i] for i in self.input_slots], 1)
+
+
+class ShortcutStep(nn.Module):
+    """Compiled shortcut layer (adds a saved output to the previous one)"""
+
+    def __init__(self, input_slot, slot):
+        super(ShortcutStep, self).__init__()
+        self.input_slot = input_slot
+        self.slot = slot
+        self.add = nn.quantized.FloatFunctional()  # Plain addition unless quantized
+
+    def forward(self, x, slots: List[torch.Tensor]):
+        return self.add.add(x, slots[self.input_slot])
+
+
+class YOLOStep(nn.Module):
+    """Compiled YOLO layer (inference decoding only, same output as YOLOLayer.decode)"""
+
+    def __init__(self, yolo_layer, stride, slot):
+        super(YOLOStep, self).__init__()
+        self.num_anchors = yolo_layer.num_anchors
+        self.num_classes = yolo_layer.num_classes
+        self.stride = float(stride)
+        self.slot = slot
+        self.dequant = torch.quantization.DeQuantStub()  # Decoding is done in float (quantized models)
+        self.register_buffer("anchor_wh", torch.tensor(yolo_layer.anchors, dtype=torch.float32).view(1, -1, 1, 1, 2))
+
+    def forward(self, x, slots: List[torch.Tensor]):
+        x = self.dequant(x)
+        num_samples, grid_h, grid_w = x.size(0), x.size(2), x.size(3)
+        prediction = x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_h, grid_w).permute(0, 1, 3, 4, 2)
+
+        grid_x = torch.arange(grid_w, dtype=x.dtype, device=x.device).repeat(grid_h, 1)
+        grid_y = torch.arange(grid_h, dtype=x.dtype, device=x.device).repeat(grid_w, 1).t()
+        grid_xy = torch.stack((grid_x, grid_y), -1).view(1, 1, grid_h, grid_w, 2)
+
+        output = torch.cat(
+            (
+                (torch.sigmoid(prediction[..., 0:2]) + grid_xy) * self.stride,  # Centers
+                torch.exp(prediction[..., 2:4]) * self.anchor_wh.to(x.dtype),  # Width and height
+                torch.sigmoid(prediction[..., 4:]),  # Conf + Cls pred.
+            ),
+            -1,
+        )
+        return output.view(num_samples, -1, self.num_classes + 5)
+
+
+class CompiledDarknet(nn.Module):
+    """
+    Static version of a Darknet model for inference (built by compile_darknet).
+    The cfg is resolved once: every layer is a step with its inputs as precomputed slot indices,
+    so forward has no string handling and can be compiled with torch.jit.script
+    """
+
+    def __init__(self, steps, num_slots, yolo_slots):
+        super(CompiledDarknet, self).__init__()
+        self.steps = nn.ModuleList(steps)
+        self.num_slots = num_slots
+        self.yolo_slots = yolo_slots
+        self.quant = torch.quantization.QuantStub()  # Identity unless quantized (see quantize_darknet)
+
+    def forward(self, x):
+        x = self.quant(x)
+        slots = [x for _ in range(self.num_slots)]
+        for step in self.steps:
+            x = step(x, slots)
+            if step.slot >= 0:
+                slots[step.slot] = x
+        return torch.cat([slots[i] for i in self.yolo_slots], 1)
+
+
+def compile_darknet(model):
+    """
+    Compiles a Darknet model into a CompiledDarknet (it shares the weights, so load them and fuse before).
+    Only the outputs read by routes, shortcuts and the final concatenation are saved, in slots
+    that are reused as soon as their output is dead
+    """
+    module_defs = model.module_defs
+    num_layers = len(module_defs)
+
+    # Absolute inputs of each layer, besides the previous output (x)
+    inputs = []
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "route":
+            layers = [int(layer_i) for layer_i in module_def["layers"].split(",")]
+        elif module_def["type"] == "shortcut":
+            layers = [int(module_def["from"])]
+        else:
+            layers = []
+        inputs.append([i + layer_i if layer_i < 0 else layer_i for layer_i in layers])
+
+    # Last reader of each saved output (YOLO outputs are read at the end)
+    last_use = {}
+    for i, layers in enumerate(inputs):
+        for layer_i in layers:
+            last_use[layer_i] = max(last_use.get(layer_i, i), i)
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "yolo":
+            last_use[i] = num_layers
+
+    # Slot allocation (a slot is free once its output has been read for the last time)
+    slot_of, free_slots, num_slots = {}, [], 0
+    for i in range(num_layers):
+        for layer_i in inputs[i]:
+            if last_use[layer_i] == i and slot_of[layer_i] not in free_slots:
+                free_slots.append(slot_of[layer_i])
+        if i in last_use:
+            if free_slots:
+                slot_of[i] = free_slots.pop()
+            else:
+                slot_of[i] = num_slots
+                num_slots += 1
+
+    # Build the steps
+    steps, yolo_slots, strides = [], [], []
+    stride = 1
+    for i, (module_def, module) in enumerate(zip(module_defs, model.module_list)):
+        slot = slot_of.get(i, -1)
+        if module_def["type"] in ["convolutional", "maxpool"]:
+            stride *= int(module_def["stride"])
+            steps.append(LayerStep(module, slot))
+        elif module_def["type"] == "upsample":
+            stride //= int(module_def["stride"])
+            steps.append(UpsampleStep(int(module_def["stride"]), slot))
+        elif module_def["type"] == "route":
+            stride = strides[inputs[i][0]]
+            steps.append(RouteStep([slot_of[layer_i] for layer_i in inputs[i]], slot))
+        elif module_def["type"] == "shortcut":
+            steps.append(ShortcutStep(slot_of[inputs[i][0]], slot))
+        elif module_def["type"] == "yolo":
+            steps.append(YOLOStep(module[0], stride, slot))
+            yolo_slots.append(slot)
+        strides.append(stride)
+
+    compiled = CompiledDarknet(steps, num_slots, yolo_slots)
+    return compiled.to(next(model.parameters()).device).eval()
+
+
+def script_darknet(model, freeze=True):
+    """Compiles a Darknet model with torch.jit (frozen and optimized for inference if 'freeze')"""
+    scripted = torch.jit.script(compile_darknet(model))
+    if freeze:
+        scripted = torch.jit.freeze(scripted)
+        scripted = torch.jit.optimize_for_inference(scripted)
+    return scripted
+
+
+def export_darknet(model, onnx_path, input_size, batch_size=1, opset_version=11):
+    """
+    Exports a Darknet model to ONNX (compiled, YOLO decoding included), with dynamic batch size, height and width.
+    Graph: images (N, C, H, W) => detections (N, boxes, ABS(cxcywh) + obj_conf + class probs)
+    """
+    height, width = input_size if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+    compiled = compile_darknet(model)
+    dummy = torch.zeros(batch_size, int(model.hyperparams["channels"]), height, width,
+                        device=next(model.parameters()).device)
+    with torch.no_grad():
+        torch.onnx.export(
+            compiled, dummy, onnx_path,
+            input_names=["images"], output_names=["detections"],
+            dynamic_axes={"images": {0: "batch", 2: "height", 3: "width"}, "detections": {0: "batch", 1: "boxes"}},
+            opset_version=opset_version,
+        )
+    return onnx_path
+
+
+def quantize_darknet(model, calibration_batches, backend="fbgemm"):
+    """
+    Post-training static INT8 quantization of a Darknet model, for CPU inference (the model is not modified).
+    Batch normalization is folded, and the activations are calibrated with 'calibration_batches' (iterable of images).
+    Returns a quantized CompiledDarknet (YOLO decoding is still done in float)
+    """
+    model = copy.deepcopy(model).cpu().eval().fuse()
+    compiled = compile_darknet(model)
+
+    torch.backends.quantized.engine = backend
+    compiled.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(compiled, inplace=True)
+    with torch.no_grad():
+        for images in calibration_batches:
+            compiled(images.cpu())
+    torch.quantization.convert(compiled, inplace=True)
+    return compiled
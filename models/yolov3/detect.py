@@ -13,23 +13,35 @@ import torch
 from torch.utils.data import DataLoader
 from torch.autograd import Variable
 
-from models.yolov3.darknet import Darknet
+from models.yolov3.darknet import Darknet, script_darknet, config_channels
 
 from utils.datasets import *
+from utils.runtime import is_backend_path, load_backend
+from utils.pipeline import Pipeline
+from utils.writers import get_writer
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--image_folder", type=str, default="/home/salvacarrion/Documents/datasets/equations/test", help="path to dataset")
     parser.add_argument("--model_def", type=str, default=BASE_PATH+"/config/yolov3-math.cfg", help="path to model definition file")
-    parser.add_argument("--weights_path", type=str, default=BASE_PATH+"/checkpoints/yolov3_best__5e.pth", help="path to weights file")
+    parser.add_argument("--weights_path", type=str, default=BASE_PATH+"/checkpoints/yolov3_best__5e.pth", help="path to weights file (*.pth, *.weights, an exported *.onnx or a quantized *.jit)")
     parser.add_argument("--class_path", type=str, default="/home/salvacarrion/Documents/datasets/equations/class.names", help="path to class label file")
     parser.add_argument("--conf_thres", type=float, default=0.8, help="object confidence threshold")
     parser.add_argument("--nms_thres", type=float, default=0.4, help="iou thresshold for non-maximum suppression")
     parser.add_argument("--batch_size", type=int, default=1, help="size of the batches")
     parser.add_argument("--n_cpu", type=int, default=1, help="number of cpu threads to use during batch generation")
-    parser.add_argument("--input_size", type=int, default=1024, help="size of each image dimension")
+    parser.add_argument("--n_post_workers", type=int, default=2, help="number of post-processing threads (NMS)")
+    parser.add_argument("--queue_size", type=int, default=4, help="max. batches waiting between two stages")
+    parser.add_argument("--n_threads", type=int, default=None, help="number of ONNX Runtime threads (*.onnx and *.jit only)")
+    parser.add_argument("--input_size", type=int, nargs="+", default=[1024], help="size of each image dimension (or height width, eg. 1024 800)")
+    parser.add_argument("--fuse", type=int, default=True, help="fold batch normalization into the convolutions")
+    parser.add_argument("--jit", type=int, default=False, help="compile the model with torch.jit (frozen, inference only)")
+    parser.add_argument("--manifest", type=str, default=None, help="if specified lists the images from a manifest (see preprocessing/build_manifest.py)")
     parser.add_argument("--output_dir", type=str, default=BASE_PATH+'/output', help="path to checkpoint folder")
+    parser.add_argument("--detections_path", type=str, default=None, help="detections file: *.jsonl, *.json (COCO results) or *.npz (default: output_dir/detections.jsonl)")
+    parser.add_argument("--category_ids", type=int, nargs="+", default=None, help="COCO category id of each class (*.json detections; default: the class index)")
+    parser.add_argument("--render_every", type=int, default=0, help="plot one page of every N (0: no plots)")
     opt = parser.parse_args()
     print(opt)
 
@@ -43,54 +55,74 @@ if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
-    # Initiate model
-    model = Darknet(config_path=opt.model_def).to(device)
-    model.apply(weights_init_normal)
-
-    # Load weights
-    if opt.weights_path:
-        if opt.weights_path.endswith(".pth"):
-            model.load_state_dict(torch.load(opt.weights_path))
-            print("Model loaded! (*.pth)")
-        else:
-            model.load_darknet_weights(opt.weights_path)
-            print("Model loaded!")
-
-    # Set in evaluation mode
-    model.eval()
+    # Input size: square or rectangular (height, width)
+    input_size = tuple(opt.input_size) if len(opt.input_size) > 1 else opt.input_size[0]
+
+    if is_backend_path(opt.weights_path):
+        # Exported graph (ONNX Runtime) or TorchScript model (eg. quantized), on the CPU
+        model = load_backend(opt.weights_path, num_threads=opt.n_threads)
+        in_channels = model.input_channels or config_channels(opt.model_def)  # No cfg needed unless unknown
+        print("Model loaded! ({})".format(opt.weights_path))
+    else:
+        # Initiate model
+        model = Darknet(config_path=opt.model_def, input_size=max(opt.input_size)).to(device)
+        model.apply(weights_init_normal)
+
+        # Load weights
+        if opt.weights_path:
+            if opt.weights_path.endswith(".pth"):
+                model.load_state_dict(torch.load(opt.weights_path))
+                print("Model loaded! (*.pth)")
+            else:
+                model.load_darknet_weights(opt.weights_path)
+                print("Model loaded!")
+
+        # Set in evaluation mode
+        model.eval()
+        if opt.fuse:
+            model.fuse()
+        in_channels = int(model.hyperparams["channels"])
+        if opt.jit:
+            model = script_darknet(model)
 
     # Get dataloader
-    dataset = ImageFolder(opt.image_folder, input_size=opt.input_size)
+    dataset = ImageFolder(opt.image_folder, input_size=input_size, manifest=opt.manifest,
+                          single_channel=in_channels == 1)
 
-    # Build data loader
+    # Build data loader (its workers decode the next images while the model runs)
     dataloader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size, num_workers=opt.n_cpu)
 
-    print("\nPerforming object detection:")
-    prev_time = time.time()
-    for batch_i, (img_paths, imgs) in enumerate(dataloader):
-        # Configure input
-        input_imgs = Variable(imgs.type(Tensor))
-
-        # Get detections
+    def forward(batch):
+        img_paths, imgs, letterboxes = batch
         with torch.no_grad():
-            detections = model(input_imgs)
-            detections[..., :4] = cxcywh2xyxy(detections[..., :4])
-            detections = remove_low_conf(detections, conf_thres=opt.conf_thres)
-            detections = keep_max_class(detections)
-            detections = non_max_suppression(detections, nms_thres=opt.nms_thres)
-
-        # Log progress
-        current_time = time.time()
-        inference_time = datetime.timedelta(seconds=current_time - prev_time)
-        prev_time = current_time
-        print("\t+ Batch %d, Inference Time: %s" % (batch_i, inference_time))
-
-        # Show detections
-        if detections:
-            process_detections(img_paths, detections, opt.input_size, class_names, rescale_bboxes=True,
-                               show_results=True, save_path=opt.output_dir, title="Detection result", colors=None)
-        else:
-            print("\t\t=> NO DETECTIONS: (#{})".format(img_paths[0]))
-
-        if batch_i == 5:
-            break
+            return model(Variable(normalize_batch(imgs, device).type(Tensor)))  # uint8 => float after the loader
+
+    def post_process(batch, detections):
+        img_paths, imgs, letterboxes = batch
+        detections = batched_non_max_suppression(detections, conf_thres=opt.conf_thres, nms_thres=opt.nms_thres)
+        detections = unletterbox_detections(detections, letterboxes)  # Page coordinates (whole batch, no I/O)
+        records = [detection_record(img_path, det, letterbox[:2].tolist())
+                   for img_path, det, letterbox in zip(img_paths, detections, letterboxes)]
+        return img_paths, detections, records
+
+    def write(results):
+        img_paths, detections, records = results
+        first_page = writer.count
+        writer.write_batch(records)
+
+        # Rendering (optional side channel): one page of every 'render_every'
+        if opt.render_every:
+            for page_i, (img_path, det) in enumerate(zip(img_paths, detections), first_page):
+                if page_i % opt.render_every == 0 and det.size(0):
+                    process_detections([img_path], [det], input_size, class_names, rescale_bboxes=False,
+                                       show_results=False, save_path=opt.output_dir, title="Detection result")
+
+    # Loader => model => post-process (NMS) => writer, overlapped
+    print("\nPerforming object detection:")
+    pipeline = Pipeline(dataloader, forward, post_process, write, num_post_workers=opt.n_post_workers,
+                        queue_size=opt.queue_size)
+    with get_writer(opt.detections_path or os.path.join(opt.output_dir, "detections.jsonl"),
+                    category_ids=opt.category_ids) as writer:
+        pipeline.run()
+    print(pipeline.report())
+    print("Done! {} images ({:.2f} images/s)".format(len(dataset), len(dataset) / pipeline.total_time))
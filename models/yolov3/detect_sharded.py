@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, BASE_PATH)
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+
+from models.yolov3.darknet import Darknet
+
+from utils.datasets import *
+from utils.writers import JSONLWriter
+
+
+def shard_indices(num_items, num_shards, shard_i):
+    """Contiguous range of the items of a shard (deterministic: it only depends on the number of items and shards)"""
+    start = num_items * shard_i // num_shards
+    end = num_items * (shard_i + 1) // num_shards
+    return list(range(start, end))
+
+
+def shard_filename(output_dir, shard_i, done=True):
+    return os.path.join(output_dir, "shard_{:04d}.jsonl{}".format(shard_i, "" if done else ".tmp"))
+
+
+def load_partial_shard(path):
+    """
+    Images already written to an unfinished shard (they are skipped when resuming).
+    A truncated last line (crash while writing) is removed from the file
+    """
+    done, valid_size = set(), 0
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line.decode("utf-8"))["image"])
+            except ValueError:
+                break
+            valid_size += len(line)
+    with open(path, "ab") as f:
+        f.truncate(valid_size)
+    return done
+
+
+def run_shard(model, dataset, shard_i, num_shards, output_dir, batch_size, conf_thres, nms_thres, num_threads):
+    """Worker: detects the images of a shard and writes them (JSONL) as they are done"""
+    torch.set_num_threads(num_threads)
+
+    tmp_path = shard_filename(output_dir, shard_i, done=False)
+    done = load_partial_shard(tmp_path)
+    indices = [i for i in shard_indices(len(dataset), num_shards, shard_i) if dataset.images[i] not in done]
+    dataloader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=0)
+
+    start_time = time.time()
+    with JSONLWriter(tmp_path, append=True) as writer:
+        for img_paths, imgs, letterboxes in dataloader:
+            with torch.no_grad():
+                detections = model(normalize_batch(imgs))
+                detections = batched_non_max_suppression(detections, conf_thres=conf_thres, nms_thres=nms_thres)
+                detections = unletterbox_detections(detections, letterboxes)  # Page coordinates
+            writer.write_batch([detection_record(img_path, det, letterbox[:2].tolist())
+                                for img_path, det, letterbox in zip(img_paths, detections, letterboxes)])  # Flushed: a crash only loses a batch
+
+    os.replace(tmp_path, shard_filename(output_dir, shard_i))  # Atomic: the shard is finished
+    print("\t+ Shard {}: {} images ({:.2f}s)".format(shard_i, len(indices), time.time() - start_time))
+
+
+def merge_shards(output_dir, num_shards, output_path):
+    """Concatenates the finished shards (in order) into a single JSONL file"""
+    with open(output_path, "w") as f_out:
+        for shard_i in range(num_shards):
+            with open(shard_filename(output_dir, shard_i), "r") as f_in:
+                for line in f_in:
+                    f_out.write(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_folder", type=str, default="/home/salvacarrion/Documents/datasets/equations/test", help="path to dataset")
+    parser.add_argument("--model_def", type=str, default=BASE_PATH+"/config/yolov3-math.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default=BASE_PATH+"/checkpoints/yolov3_best__5e.pth", help="path to weights file")
+    parser.add_argument("--conf_thres", type=float, default=0.8, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.4, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--batch_size", type=int, default=4, help="size of the batches (per worker)")
+    parser.add_argument("--input_size", type=int, nargs="+", default=[1024], help="size of each image dimension (or height width, eg. 1024 800)")
+    parser.add_argument("--fuse", type=int, default=True, help="fold batch normalization into the convolutions")
+    parser.add_argument("--n_workers", type=int, default=None, help="number of worker processes (default: 1 per 4 cores)")
+    parser.add_argument("--n_shards", type=int, default=None, help="number of shards (default: number of workers). Keep it to resume")
+    parser.add_argument("--retries", type=int, default=1, help="times a crashed shard is run again")
+    parser.add_argument("--manifest", type=str, default=None, help="if specified lists the images from a manifest (see preprocessing/build_manifest.py)")
+    parser.add_argument("--output_dir", type=str, default=BASE_PATH+'/output/detections', help="path to the shards and the merged detections")
+    opt = parser.parse_args()
+    print(opt)
+
+    os.makedirs(opt.output_dir, exist_ok=True)
+
+    # Workers x threads = cores (a few threads per worker scale better than one process with all of them)
+    num_cores = os.cpu_count() or 1
+    num_workers = opt.n_workers or max(1, num_cores // 4)
+    num_threads = max(1, num_cores // num_workers)
+    num_shards = opt.n_shards or num_workers
+
+    # Input size: square or rectangular (height, width)
+    input_size = tuple(opt.input_size) if len(opt.input_size) > 1 else opt.input_size[0]
+
+    # The workers are forked (they inherit the weights and the dataset). Forking after the parent has started
+    # its intra-op thread pool (GNU OpenMP) can deadlock the children, which would hang instead of crashing
+    # (no retry). So the parent runs its torch ops (load, fuse) single-threaded and never starts the pool
+    torch.set_num_threads(1)
+
+    # Load the model once (CPU), in shared memory: the forked workers do not copy the weights
+    model = Darknet(config_path=opt.model_def, input_size=max(opt.input_size))
+    if opt.weights_path.endswith(".pth"):
+        model.load_state_dict(torch.load(opt.weights_path, map_location="cpu"))
+    else:
+        model.load_darknet_weights(opt.weights_path)
+    model.eval()
+    if opt.fuse:
+        model.fuse()
+    model.share_memory()
+
+    # Same (sorted) file list in every worker
+    dataset = ImageFolder(opt.image_folder, input_size=input_size, manifest=opt.manifest,
+                          single_channel=int(model.hyperparams["channels"]) == 1)
+    print("\nPerforming object detection: {} images, {} shards, {} workers x {} threads".format(
+        len(dataset), num_shards, num_workers, num_threads))
+
+    # The partition depends on the number of images and shards: they cannot change when resuming
+    meta_path = os.path.join(opt.output_dir, "shards.json")
+    meta = {"num_images": len(dataset), "num_shards": num_shards}
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f) != meta:
+                raise ValueError("The output dir has shards of another run ({}). Use a new one".format(meta_path))
+    else:
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    # Run the unfinished shards (at most 'num_workers' at once); crashed shards resume where they stopped
+    ctx = mp.get_context("fork")
+    start_time = time.time()
+    for attempt in range(opt.retries + 1):
+        pending = [i for i in range(num_shards) if not os.path.exists(shard_filename(opt.output_dir, i))]
+        running = []
+        while pending or running:
+            while pending and len(running) < num_workers:
+                shard_i = pending.pop(0)
+                p = ctx.Process(target=run_shard, args=(model, dataset, shard_i, num_shards, opt.output_dir,
+                                                        opt.batch_size, opt.conf_thres, opt.nms_thres, num_threads))
+                p.start()
+                running.append((shard_i, p))
+            time.sleep(0.1)
+            for shard_i, p in list(running):
+                if not p.is_alive():
+                    p.join()
+                    running.remove((shard_i, p))
+                    if p.exitcode != 0:
+                        print("\t=> Shard {} crashed (exit code {})".format(shard_i, p.exitcode))
+
+    # Merge (only when every shard is finished)
+    failed = [i for i in range(num_shards) if not os.path.exists(shard_filename(opt.output_dir, i))]
+    if failed:
+        print("Unfinished shards: {}. Run it again to resume them".format(failed))
+        sys.exit(1)
+    output_path = os.path.join(opt.output_dir, "detections.jsonl")
+    merge_shards(opt.output_dir, num_shards, output_path)
+    print("Done! {} images ({:.2f}s) => {}".format(len(dataset), time.time() - start_time, output_path))
@@ -0,0 +1,47 @@
+import os
+import sys
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+sys.path.insert(0, BASE_PATH)
+
+import torch
+
+from models.yolov3.darknet import Darknet, export_darknet
+from utils.runtime import ONNXBackend, check_parity
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default=BASE_PATH+"/config/yolov3-math.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default=BASE_PATH+"/checkpoints/yolov3_best__5e.pth", help="path to weights file")
+    parser.add_argument("--input_size", type=int, nargs="+", default=[1024], help="size used to trace the graph (or height width, eg. 1024 800)")
+    parser.add_argument("--fuse", type=int, default=True, help="fold batch normalization into the convolutions")
+    parser.add_argument("--check_parity", type=int, default=True, help="compare the ONNX Runtime outputs against PyTorch")
+    parser.add_argument("--output", type=str, default=BASE_PATH+"/checkpoints/yolov3.onnx", help="path to the exported graph")
+    opt = parser.parse_args()
+    print(opt)
+
+    input_size = tuple(opt.input_size) if len(opt.input_size) > 1 else opt.input_size[0]
+
+    # Initiate model (exported on the CPU)
+    model = Darknet(config_path=opt.model_def, input_size=max(opt.input_size))
+    if opt.weights_path.endswith(".pth"):
+        model.load_state_dict(torch.load(opt.weights_path, map_location="cpu"))
+    else:
+        model.load_darknet_weights(opt.weights_path)
+    model.eval()
+    if opt.fuse:
+        model.fuse()
+
+    export_darknet(model, opt.output, input_size)
+    print("Model exported! => {}".format(opt.output))
+
+    # Parity (dynamic axes): another batch size and the transposed rectangle
+    if opt.check_parity:
+        backend = ONNXBackend(opt.output)
+        channels = int(model.hyperparams["channels"])
+        sizes = [input_size] if isinstance(input_size, int) else [input_size, input_size[::-1]]
+        for size in sizes:
+            diffs = check_parity(model, backend, size, batch_size=2, channels=channels)
+            print("\t+ Parity {}: max. abs. diff {:.6f}".format(size, max(diffs)))
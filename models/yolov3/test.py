@@ -20,20 +20,27 @@ from torch.utils.data.sampler import SubsetRandomSampler
 
 from terminaltables import AsciiTable
 
-from models.yolov3.darknet import Darknet
+from models.yolov3.darknet import Darknet, config_channels
 
 from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
 from utils.evaluate import *
+from utils.runtime import is_backend_path, load_backend
 
 
-def evaluate_raw(model, images_path, labels_path, iou_thres, conf_thres, nms_thres, input_size, batch_size, class_names=None,  plot_detections=None):
+def evaluate_raw(model, images_path, labels_path, iou_thres, conf_thres, nms_thres, input_size, batch_size, class_names=None,  plot_detections=None, rect_batches=False):
     # Get dataloader
     dataset = ListDataset(images_path=images_path, labels_path=labels_path, input_size=input_size, class_names=class_names)
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
-    )
+    if rect_batches:
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size=batch_size, shuffle=False)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler, num_workers=1, collate_fn=dataset.collate_fn
+        )
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
+        )
 
     return evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, class_names, plot_detections)
 
@@ -46,7 +53,7 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, cl
 
     labels = []
     sample_metrics = []  # List of tuples (TP, confs, pred)
-    for batch_i, (images_path, input_imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
+    for batch_i, (images_path, input_imgs, targets, letterboxes) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
     # for batch_i, (images_path, input_imgs, targets) in enumerate(dataloader, 1):
     #
     #     # Format boxes to YOLO format REL(cxcywh)
@@ -55,30 +62,27 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, cl
         # Extract labels
         labels += targets[:, 1].tolist()
 
-        input_imgs = Variable(input_imgs.type(Tensor), requires_grad=False)
+        input_imgs = Variable(normalize_batch(input_imgs).type(Tensor), requires_grad=False)
         dev_targets = Variable(targets.type(Tensor), requires_grad=False)
 
         with torch.no_grad():
             loss, detections = model(input_imgs, dev_targets)  # TODO: Validation loss working properly
             running_loss += loss.item()
 
-            detections[..., :4] = cxcywh2xyxy(detections[..., :4])
-            detections = remove_low_conf(detections, conf_thres=conf_thres)
-            detections = keep_max_class(detections)
-            detections = non_max_suppression(detections, nms_thres=nms_thres)
+            detections = batched_non_max_suppression(detections, conf_thres=conf_thres, nms_thres=nms_thres)
         # detections = [detections[0][23].unsqueeze(0)]
 
         # Targets (here, already formated due to the dataloader)
-        targets[:, 2:] = xywh2xyxy(rel2abs(targets[:, 2:], input_size, input_size))
+        img_h, img_w = input_imgs.shape[2:]  # Rectangular batches have their own shape
+        targets[:, 2:] = xywh2xyxy(rel2abs(targets[:, 2:], img_h, img_w))
 
         # Show detections
         if plot_detections and batch_i <= plot_detections:
-            if detections:
+            if detections[0].size(0):
                 use_original = True
                 save_path = BASE_PATH+'/outputs/{}'.format(images_path[0].split('/')[-1])
                 # Scale target bboxes
                 input_img = img2img(input_imgs[0])
-                ori_img = img2img(images_path[0])
 
                 # Output
                 class_ids = detections[0][:, -1]
@@ -86,8 +90,10 @@ def evaluate(model, dataloader, iou_thres, conf_thres, nms_thres, input_size, cl
                 t_bboxes = targets[targets[:, 0] == 0][:, 2:]
 
                 if use_original:
-                    p_bboxes = rescale_boxes(p_bboxes, current_shape=input_img.shape[:2], original_shape=ori_img.shape[:2])
-                    t_bboxes = rescale_boxes(t_bboxes, current_shape=input_img.shape[:2], original_shape=ori_img.shape[:2])
+                    # Letterbox record of the page => no need to read it again to know its size
+                    p_bboxes = unletterbox_boxes(p_bboxes, letterboxes[0:1].expand(len(p_bboxes), -1))
+                    t_bboxes = unletterbox_boxes(t_bboxes, letterboxes[0:1].expand(len(t_bboxes), -1))
+                    ori_img = img2img(images_path[0])
                     plot_bboxes(ori_img, p_bboxes,  class_ids=class_ids, class_names=class_names, show_results=False,
                                 t_bboxes=t_bboxes, title="Detection + ground truth ({})".format(images_path[0]), save_path=save_path)
                 else:
@@ -125,20 +131,16 @@ def make_predictions(dataloader, model, min_score=0.01, max_overlap=0.45, top_k=
     with torch.no_grad():
 
         # Get predictions
-        for batch_i, (images_path, images, targets) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
+        for batch_i, (images_path, images, targets, _) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects"), 1):
 
-            images = images.to(device)
+            images = normalize_batch(images, device)
             _, h, w = images[0].shape
             batch_size = len(images_path)
 
             # Forward prop.
             detections = model(images)
 
-            detections[..., :4] = cxcywh2xyxy(detections[..., :4])
-            detections = remove_low_conf(detections, conf_thres=min_score)
-            detections = keep_max_class(detections)
-            detections = non_max_suppression(detections, nms_thres=max_overlap)
-            detections = detections
+            detections = batched_non_max_suppression(detections, conf_thres=min_score, nms_thres=max_overlap)
 
             det_boxes_batch = []
             det_labels_batch = []
@@ -182,9 +184,10 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=1, help="size of each image batch")
     parser.add_argument("--data_config", type=str, default=BASE_PATH+"/config/custom.data", help="path to data config file")
     parser.add_argument("--model_def", type=str, help="path to model definition file")
-    parser.add_argument("--weights_path", type=str, help="if specified starts from checkpoint model")
+    parser.add_argument("--weights_path", type=str, help="if specified starts from checkpoint model (or an exported *.onnx / quantized *.jit)")
     parser.add_argument("--input_size", type=int, default=1024, help="size of each image dimension")
     parser.add_argument("--n_cpu", type=int, default=1, help="number of cpu threads to use during batch generation")
+    parser.add_argument("--n_threads", type=int, default=None, help="number of ONNX Runtime threads (*.onnx and *.jit only)")
     parser.add_argument("--shuffle_dataset", type=int, default=False, help="shuffle dataset")
     parser.add_argument("--validation_split", type=float, default=0.0, help="validation split [0..1]")
     parser.add_argument("--checkpoint_dir", type=str, default=BASE_PATH+"/checkpoints", help="path to checkpoint folder")
@@ -193,6 +196,9 @@ if __name__ == "__main__":
     parser.add_argument("--nms_thres", type=float, default=0.3, help="iou thresshold for non-maximum suppression")
     parser.add_argument("--top_k", type=int, default=200, help="Keep top K best hypothesis")
     parser.add_argument("--plot_detections", type=int, default=None, help="Number of detections to plot and save")
+    parser.add_argument("--fuse", type=int, default=False, help="fold batch normalization into the convolutions")
+    parser.add_argument("--rect_batches", type=int, default=False, help="group pages by aspect ratio and letterbox each batch to its own rectangle")
+    parser.add_argument("--manifest", type=str, default=None, help="if specified lists the images from a manifest (see preprocessing/build_manifest.py)")
     opt = parser.parse_args()
     print(opt)
 
@@ -204,27 +210,45 @@ if __name__ == "__main__":
     labels_path = dataset_path + data_config["labels"]
     class_names = load_classes(dataset_path + data_config["classes"])
 
-    # Initiate model
-    model = Darknet(config_path=opt.model_def, input_size=opt.input_size).to(device)
-    model.apply(weights_init_normal)
+    if is_backend_path(opt.weights_path):
+        # Exported graph (ONNX Runtime) or TorchScript model (eg. quantized), on the CPU
+        model = load_backend(opt.weights_path, num_threads=opt.n_threads)
+        in_channels = model.input_channels or config_channels(opt.model_def)  # No cfg needed unless unknown
+    else:
+        # Initiate model
+        model = Darknet(config_path=opt.model_def, input_size=opt.input_size).to(device)
+        model.apply(weights_init_normal)
+
+        # Load weights
+        if opt.weights_path:
+            if opt.weights_path.endswith(".pth"):
+                model.load_state_dict(torch.load(opt.weights_path))
+            else:
+                model.load_darknet_weights(opt.weights_path, cutoff=None, freeze_layers=None)
 
-    # Load weights
-    if opt.weights_path:
-        if opt.weights_path.endswith(".pth"):
-            model.load_state_dict(torch.load(opt.weights_path))
-        else:
-            model.load_darknet_weights(opt.weights_path, cutoff=None, freeze_layers=None)
+        # Fold batch normalization (after loading the weights)
+        if opt.fuse:
+            model.fuse()
+        in_channels = int(model.hyperparams["channels"])
 
     print("\nEvaluating model:\n")
 
     # Dataloader
     dataset = ListDataset(images_path=test_path, labels_path=labels_path, input_size=opt.input_size,
-                             class_names=class_names)
+                             class_names=class_names, manifest=opt.manifest,
+                             single_channel=in_channels == 1)
     valid_sampler = SubsetRandomSampler(range(10))
-    dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=opt.batch_size, shuffle=False, num_workers=0, pin_memory=False,
-        collate_fn=dataset.collate_fn
-    )
+    if opt.rect_batches:
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size=opt.batch_size, shuffle=False)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=batch_sampler, num_workers=0, pin_memory=False,
+            collate_fn=dataset.collate_fn
+        )
+    else:
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=opt.batch_size, shuffle=False, num_workers=0, pin_memory=False,
+            collate_fn=dataset.collate_fn
+        )
 
     # Make predictions
     print("Making predictions...")
@@ -18,6 +18,7 @@ from models.yolov3.test import evaluate
 
 from utils.datasets import *
 from utils.parse_config import *
+from utils.page_cache import PageCache
 
 
 if __name__ == "__main__":
@@ -38,9 +39,16 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--gradient_accumulations", type=int, default=2, help="number of gradient accums before step")
     parser.add_argument("--multiscale_training", default=False, help="allow for multi-scale training")
+    parser.add_argument("--rect_batches", type=int, default=False, help="group pages by aspect ratio and letterbox each batch to its own rectangle")
+    parser.add_argument("--manifest", type=str, default=None, help="if specified lists the images from a manifest (see preprocessing/build_manifest.py)")
+    parser.add_argument("--cache_gb", type=float, default=0, help="shared-memory cache of decoded pages for all the workers, in GB (0: no cache; at least one input_size page)")
+    parser.add_argument("--shard_path", type=str, default=None, help="if specified reads the images from a packed shard (see preprocessing/pack_shards.py)")
     opt = parser.parse_args()
     print(opt)
 
+    if opt.rect_batches and opt.shard_path:
+        parser.error("--rect_batches needs the original pages (shards are letterboxed to a square)")
+
     # Make default dirs
     os.makedirs(opt.logdir, exist_ok=True)
     os.makedirs(opt.checkpoint_dir, exist_ok=True)
@@ -76,9 +84,18 @@ if __name__ == "__main__":
                            interpolation=cv2.INTER_AREA, border_mode=cv2.BORDER_REPLICATE, p=1.0),
     ], p=1.0)
 
-    # Get dataloader
-    dataset = ListDataset(images_path=images_path, labels_path=labels_path, input_size=opt.input_size, transform=data_aug, balance_classes=False, class_names=class_names ,multiscale=opt.multiscale_training)
-    dataset2 = ListDataset(images_path=images_path, labels_path=labels_path, input_size=opt.input_size, transform=data_aug, balance_classes=False, class_names=class_names ,multiscale=False)
+    # Get dataloader (as many channels as the model input: grayscale pages are decoded as L)
+    single_channel = int(model.hyperparams["channels"]) == 1
+    page_cache = None
+    if opt.cache_gb and not opt.shard_path:  # Shards are already decoded
+        page_shape = (opt.input_size, opt.input_size) if single_channel else (opt.input_size, opt.input_size, 3)
+        page_cache = PageCache(int(opt.cache_gb * 2 ** 30), page_shape)  # Shared by both datasets (same pages)
+    if opt.shard_path:
+        dataset = ShardDataset(shard_path=opt.shard_path, transform=data_aug, balance_classes=False, class_names=class_names, multiscale=opt.multiscale_training)
+        dataset2 = ShardDataset(shard_path=opt.shard_path, transform=data_aug, balance_classes=False, class_names=class_names, multiscale=False)
+    else:
+        dataset = ListDataset(images_path=images_path, labels_path=labels_path, input_size=opt.input_size, transform=data_aug, balance_classes=False, class_names=class_names ,multiscale=opt.multiscale_training, manifest=opt.manifest, single_channel=single_channel, page_cache=page_cache)
+        dataset2 = ListDataset(images_path=images_path, labels_path=labels_path, input_size=opt.input_size, transform=data_aug, balance_classes=False, class_names=class_names ,multiscale=False, manifest=opt.manifest, single_channel=single_channel, page_cache=page_cache)
 
     # Creating data indices for training and validation splits:
     dataset_size = len(dataset)
@@ -93,8 +110,14 @@ if __name__ == "__main__":
     valid_sampler = SubsetRandomSampler(val_indices)
 
     # Build data loader
-    train_loader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size, sampler=train_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset.collate_fn)
-    validation_loader = torch.utils.data.DataLoader(dataset2, batch_size=opt.batch_size, sampler=valid_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset2.collate_fn)
+    if opt.rect_batches:
+        train_batch_sampler = AspectRatioBatchSampler(dataset, batch_size=opt.batch_size, indices=train_indices, shuffle=True)
+        valid_batch_sampler = AspectRatioBatchSampler(dataset2, batch_size=opt.batch_size, indices=val_indices, shuffle=False)
+        train_loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_batch_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset.collate_fn)
+        validation_loader = torch.utils.data.DataLoader(dataset2, batch_sampler=valid_batch_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset2.collate_fn)
+    else:
+        train_loader = torch.utils.data.DataLoader(dataset, batch_size=opt.batch_size, sampler=train_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset.collate_fn)
+        validation_loader = torch.utils.data.DataLoader(dataset2, batch_size=opt.batch_size, sampler=valid_sampler, num_workers=opt.n_cpu, pin_memory=True, collate_fn=dataset2.collate_fn)
 
     # Optimizer
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
@@ -131,7 +154,7 @@ if __name__ == "__main__":
         running_loss = 0
 
         # Train model
-        for batch_i, (img_paths, imgs, targets) in enumerate(train_loader, 1):
+        for batch_i, (img_paths, imgs, targets, _) in enumerate(train_loader, 1):
             # Input target => image_i + class_id + REL(cxcywh)
             # Output target => ABS(cxcywh) + obj_conf + class_prob + class_id
 
@@ -149,7 +172,7 @@ if __name__ == "__main__":
             # process_detections([f_img], [fake_targets], opt.input_size, class_names, rescale_bboxes=False, title="Augmented final ({})".format(img_paths[0]), colors=colors)
 
             # Inputs/Targets to device
-            imgs = Variable(imgs.to(device))
+            imgs = Variable(normalize_batch(imgs, device))  # uint8 => float on the device
             targets = Variable(targets.to(device), requires_grad=False)
 
             # Fit model
@@ -158,10 +181,7 @@ if __name__ == "__main__":
             running_loss += loss.item()
 
             # Sanity check II
-            # outputs[..., :4] = cxcywh2xyxy(outputs[..., :4])
-            # detections = remove_low_conf(outputs, conf_thres=opt.conf_thres)
-            # detections = keep_max_class(detections)
-            # detections = non_max_suppression(detections, nms_thres=opt.nms_thres)
+            # detections = batched_non_max_suppression(outputs, conf_thres=opt.conf_thres, nms_thres=opt.nms_thres)
             # if detections:
             #     process_detections([f_img], [detections[0]], opt.img_size, class_names, rescale_bboxes=False, title="Detection result", colors=None)
             # else:
@@ -203,6 +223,10 @@ if __name__ == "__main__":
                 if name != "grid_size":
                     writer.add_scalar(tag="{}_{}".format(name, j + 1), scalar_value=metric, global_step=epoch+1)
         writer.add_scalar(tag="loss", scalar_value=train_loss, global_step=epoch+1)
+        if page_cache is not None:
+            cache_stats = page_cache.stats()
+            writer.add_scalar(tag="page_cache_hit_rate", scalar_value=cache_stats['hit_rate'], global_step=epoch+1)
+            print(page_cache.report())
 
         # [TB] Histogram / one per epoch (takes more time (0.x seconds))
         for name, param in model.named_parameters():
@@ -254,3 +278,5 @@ if __name__ == "__main__":
 
     # Close writer
     writer.close()
+    if page_cache is not None:
+        page_cache.close()
@@ -0,0 +1,27 @@
+import os
+import sys
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+from utils.datasets import LabelStore
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--labels_path", type=str, default=None, help="path to the folder with one .txt per image")
+    parser.add_argument("--json_path", type=str, default=None, help="path to the preprocessing json (eg. raw/train.json)")
+    parser.add_argument("--images_path", type=str, default=None, help="images of the json (only if it has no image sizes)")
+    parser.add_argument("--output", type=str, default=BASE_PATH+"/labels.npz", help="path to the label store")
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.labels_path:
+        store = LabelStore.from_labels_dir(opt.labels_path, opt.output)
+    elif opt.json_path:
+        store = LabelStore.from_json(opt.json_path, opt.output, images_path=opt.images_path)
+    else:
+        raise ValueError("Either --labels_path or --json_path is required")
+
+    print("Label store saved! ({} images, {} bboxes) => {}".format(len(store), len(store.boxes), opt.output))
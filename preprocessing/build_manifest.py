@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+from utils.datasets import Manifest
+from utils.utils import load_classes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images_path", type=str, required=True, help="path to the images folder")
+    parser.add_argument("--labels_path", type=str, default=None, help="path to the labels folder or label store (none: every image)")
+    parser.add_argument("--class_path", type=str, default=None, help="path to class label file (size of the class histograms)")
+    parser.add_argument("--n_cpu", type=int, default=None, help="number of processes (default: all the cores)")
+    parser.add_argument("--output", type=str, default=None, help="path to the manifest (default: <images_path>.manifest.npz, next to the folder)")
+    opt = parser.parse_args()
+    print(opt)
+
+    start_time = time.time()
+    output = opt.output or opt.images_path.rstrip("/") + ".manifest.npz"  # Outside the images folder
+    num_classes = len(load_classes(opt.class_path)) if opt.class_path else None
+    manifest = Manifest.build(opt.images_path, opt.labels_path, output, num_classes=num_classes, num_workers=opt.n_cpu)
+
+    # Summary (no image was decoded)
+    print('\n\nSUMMARY:')
+    print('-----------------------------')
+    for k, v in manifest.stats().items():
+        print('{}: {}'.format(k, v))
+    print('boxes per class: {}'.format(manifest.class_histogram.tolist()))
+    print("\nManifest saved! ({:.2f}s) => {}".format(time.time() - start_time, output))
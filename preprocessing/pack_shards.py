@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import argparse
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+from utils.datasets import ListDataset, pack_dataset
+from utils.parse_config import parse_data_config
+from utils.utils import load_classes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_config", type=str, default=BASE_PATH+"/config/custom.data", help="path to data config file")
+    parser.add_argument("--split", type=str, default="train", help="split to pack (key of the data config)")
+    parser.add_argument("--input_sizes", type=int, nargs="+", default=[1024], help="input sizes to pack (eg. 1024 1280 1440 2048)")
+    parser.add_argument("--single_channel", type=int, default=True, help="store one channel per page (as ListDataset)")
+    parser.add_argument("--output_dir", type=str, default=BASE_PATH+"/shards", help="path to the shards folder")
+    opt = parser.parse_args()
+    print(opt)
+
+    # Get data configuration
+    data_config = parse_data_config(opt.data_config)
+    labels_path = data_config["labels"]
+    class_names = load_classes(data_config["classes"])
+
+    for input_size in opt.input_sizes:
+        start_time = time.time()
+        images_path = data_config[opt.split].format(input_size)
+        shard_path = os.path.join(opt.output_dir, "{}_{}".format(opt.split, input_size))
+
+        # Default format only (no augmentation, no balancing)
+        dataset = ListDataset(images_path=images_path, labels_path=labels_path, input_size=input_size,
+                              class_names=class_names, single_channel=bool(opt.single_channel))
+        total = pack_dataset(dataset, shard_path)
+        print("Packed {}/{} images into {} ({:.2f}s)".format(total, len(dataset), shard_path, time.time() - start_time))
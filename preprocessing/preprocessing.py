@@ -1,144 +1,124 @@
+import os
+import sys
+import copy
 import time
-import torch
+import argparse
+import multiprocessing
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
 import numpy as np
-import json
 import cv2
+import tqdm
 from utils.utils import *
-import random
-from collections import defaultdict
+from utils.datasets import image_size
 
 
 # initialize a list of colors to represent each possible class label
 np.random.seed(42)
 COLORS = np.array([[200, 0, 0, 255], [0, 0, 200, 255]])#np.random.randint(0, 255, size=(len(CATEGORIES), 3), dtype="uint8")
 
-#CATEGORIES = {c['id']: c['name'] for c in JSON_DATASET['categories']}
-# ANNOTATIONS = defaultdict(list)
-#
-# # Get annotations per image
-# for annotation in JSON_DATASET['annotations']:
-#     image_id = annotation['image_id']
-#     data = {}
-#     for k, v in annotation.items():
-#         if k != 'image_id':
-#             data[k] = v
-#     ANNOTATIONS[image_id].append(data)
-#
-#
-# NEW_JSON = {'categories': CATEGORIES,
-#             'annotations': dict(ANNOTATIONS),
-#             'images': JSON_DATASET['images']}
-# save_dataset(NEW_JSON, 'new_train.json')
-#
-# asw = 3
 
-def main():
-    start_time = time.time()
-    WIDTH, HEIGHT = (1440, 1440)
+def is_up_to_date(filename, src_filename):
+    return os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(src_filename)
 
-    load_path_raw = '/home/salvacarrion/Documents/datasets/equations/raw'
 
-    load_path = load_path_raw  # load_path_resized
-    save_path = "/home/salvacarrion/Documents/datasets/equations/{}".format(HEIGHT)
-    JSON_DATASET = load_dataset(load_path + '/train.json')
+def process_image(job):
+    """
+    Worker: decodes a page once and writes it at every requested size (existing, up-to-date outputs are skipped).
+    Returns the id of the page and, for each size, its bboxes and (width, height)
+    """
+    image_id, filename, bboxes, outputs, quality, bits, force = job
 
-    # Make dir if it doesn't exist
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
+    # Decode only if some output is missing or older than the page
+    pending = [(size, save_filename) for size, save_filename in outputs
+               if force or not is_up_to_date(save_filename, filename)]
+    if pending:
+        image = cv2.imread(filename)
+        ori_h, ori_w = image.shape[:2]
+    else:
+        ori_w, ori_h = image_size(filename)  # Header only
 
-    print('Loading images from: {}'.format(load_path))
-    print('Save images to: {}'.format(save_path))
-    print('-----------------------------\n')
+    results = {}
+    for size, save_filename in outputs:
+        coords = letterbox_coords(ori_w, ori_h, (size, size), padding=False)  # Same as letterbox_image
+        if (size, save_filename) in pending:
+            resized_image, coords = letterbox_image(image, (size, size), padding=False)
+            write_image(resized_image, save_filename, quality=quality, bits=bits)
+        results[size] = (resize_bboxes(copy.deepcopy(bboxes), coords), (coords[2], coords[3]))
+    return image_id, results, len(pending)
 
-    total_w = 0
-    total_h = 0
-    min_w = 10000000000
-    min_h = 10000000000
-    max_w = 0
-    max_h = 0
 
-    # Get data
-    for i, image_data in enumerate(JSON_DATASET['images'], 1):
-        image_id = str(image_data['id'])
-        bboxes = JSON_DATASET['annotations'][image_id]
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--load_path", type=str, default="/home/salvacarrion/Documents/datasets/equations/raw", help="path to the raw pages (and their train.json)")
+    parser.add_argument("--save_path", type=str, default="/home/salvacarrion/Documents/datasets/equations/{}", help="output folder of each size ('{}' => size)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1280, 1440], help="target sizes (longest side); every page is decoded once for all of them")
+    parser.add_argument("--format", type=str, default="png", choices=["jpg", "png", "webp", "npy", "bits"], help="output format (png: level 1, npy: raw array, bits: bit-packed grayscale)")
+    parser.add_argument("--quality", type=int, default=None, help="jpg/webp quality or png compression level (default: 95 / 1)")
+    parser.add_argument("--bits", type=int, default=1, choices=[1, 2], help="bits per pixel of the bit-packed pages (1: binarized)")
+    parser.add_argument("--n_cpu", type=int, default=None, help="number of processes (default: all the cores)")
+    parser.add_argument("--force", type=int, default=False, help="write every output again, even if it is up to date")
+    opt = parser.parse_args()
+    print(opt)
 
-        # Build paths
-        filename = load_path + '/' + image_data['filename']
-        save_filename = save_path + '/' + image_data['filename']
+    start_time = time.time()
+    JSON_DATASET = load_dataset(opt.load_path + '/train.json')
+    ext = '.' + opt.format
 
-        print("Loading image  #{} ({}/{})...".format(image_id, i, len(JSON_DATASET['images'])))
-        image = cv2.imread(filename)
+    # Make dirs if they don't exist
+    save_paths = {size: opt.save_path.format(size) for size in opt.sizes}
+    for save_path in save_paths.values():
+        os.makedirs(save_path, exist_ok=True)
 
-        print("\t- Resizing image...")
-        image, new_coords = letterbox_image(image, (WIDTH, HEIGHT), padding=False)
-
-        # Stats
-        h, w, _ = image.shape
-        total_w += w
-        total_h += h
-        min_w = min(min_w, w)
-        min_h = min(min_h, h)
-        max_w = max(max_w, w)
-        max_h = max(max_h, h)
-
-        print("\t- Resizing bounding boxes...")
-        bboxes = resize_bboxes(bboxes, new_coords)
-        JSON_DATASET['annotations'][image_id] = bboxes
-
-        # # print("\t- Performing bbox augmentation...")
-        # # bboxes = augment_bboxes(bboxes)
-        # #
-        # # print("\t- Performing non-maximum supression...")
-        # # bboxes, total_boxes1, total_boxes2 = non_maximum_supression(bboxes)
-        # # print("\t\t- Boxes supressed: {} ({:.2f}%)".format(total_boxes1 - total_boxes2, (total_boxes1 - total_boxes2) / total_boxes1 * 100))
-        #
-        # # Draw bounding boxes
-        # print("\t- Drawing bboxes...")
-        # image = Image.fromarray(image)
-        # for annotation in bboxes:
-        #     cat_id = str(annotation['category_id'])
-        #     text = JSON_DATASET['categories'][cat_id]
-        #     draw_bbox(image, annotation['bbox'], cat_id, COLORS, thickness=2)
-        #     draw_labels(image, annotation['bbox'], text, cat_id, COLORS, font_size=24)
-
-        # # Crop boxes
-        # #crop_images(filename, bboxes, 'datasets/equations/crops', image_id, CATEGORIES)
-        #
-        # Show image
-        #image.show()
-
-        print('\t- Saving image...')
-        save_image(image, save_filename)
-
-        # Finish loop
-        # if i == 10:
-        #     break
-
-    # # Fix json
-    # categories = {int(k): v for k, v in JSON_DATASET['categories'].items()}
-    # images = []
-    # for x in JSON_DATASET['images']:
-    #     images.append({'id': int(x['id']), 'filename': x['file_name']})
-    # annotations = {int(k): v for k, v in JSON_DATASET['annotations'].items()}
-    # NEW_JSON_DATASET = {'categories': categories,
-    #                     'annotations': annotations,
-    #                     'images': images}
-    # Save new json
-    print('Saving JSON dataset...')
-    save_dataset(JSON_DATASET, save_path + '/train.json')
+        # Partial outputs of killed runs (see write_image)
+        for filename in os.listdir(save_path):
+            if filename.endswith('.tmp'):
+                os.remove(os.path.join(save_path, filename))
 
-    print('\n\nSUMMARY:')
-    print('-----------------------------')
+    print('Loading images from: {}'.format(opt.load_path))
+    print('Save images to: {}'.format(', '.join(save_paths.values())))
+    print('-----------------------------\n')
 
-    avg_w = total_w/len(JSON_DATASET['images'])
-    avg_h = total_h/len(JSON_DATASET['images'])
+    # One job per page (all its sizes)
+    jobs = []
+    for image_data in JSON_DATASET['images']:
+        image_id = str(image_data['id'])
+        save_filename = os.path.splitext(image_data['filename'])[0] + ext
+        outputs = [(size, save_paths[size] + '/' + save_filename) for size in opt.sizes]
+        jobs.append((image_id, opt.load_path + '/' + image_data['filename'], JSON_DATASET['annotations'][image_id],
+                     outputs, opt.quality, opt.bits, bool(opt.force)))
+
+    results, written = {}, 0
+    with multiprocessing.Pool(opt.n_cpu) as pool:
+        for image_id, result, num_written in tqdm.tqdm(pool.imap_unordered(process_image, jobs, chunksize=4),
+                                                       total=len(jobs), desc="Resizing"):
+            results[image_id] = result
+            written += num_written
 
-    print('avg_w: ', avg_w)
-    print('avg_h: ', avg_h)
-    print('min_w: ', min_w)
-    print('min_h: ', min_h)
-    print('max_w: ', max_w)
-    print('max_h: ', max_h)
+    print('\n\nSUMMARY:')
+    print('-----------------------------')
+    print('images written: {} ({} up to date)'.format(written, len(jobs) * len(opt.sizes) - written))
+    for size, save_path in save_paths.items():
+        # New json (sizes included, so the label store does not need to open the images)
+        images = []
+        for image_data in JSON_DATASET['images']:
+            width, height = results[str(image_data['id'])][size][1]
+            images.append(dict(image_data, filename=os.path.splitext(image_data['filename'])[0] + ext,
+                               width=width, height=height))
+        annotations = {image_id: results[image_id][size][0] for image_id in JSON_DATASET['annotations']
+                       if image_id in results}
+        json_dataset = dict(JSON_DATASET, images=images, annotations=annotations)
+
+        # Atomic: a crash never leaves a truncated train.json
+        save_dataset(json_dataset, save_path + '/train.json.tmp')
+        os.replace(save_path + '/train.json.tmp', save_path + '/train.json')
+
+        widths = np.array([x['width'] for x in images])
+        heights = np.array([x['height'] for x in images])
+        print('[{}] avg_w: {:.2f}, avg_h: {:.2f}, min_w: {}, min_h: {}, max_w: {}, max_h: {}'.format(
+            size, widths.mean(), heights.mean(), widths.min(), heights.min(), widths.max(), heights.max()))
 
     # Compute elapsed time
     hours, rem = divmod(time.time() - start_time, 3600)
@@ -148,5 +128,4 @@ def main():
 
 
 if __name__ == "__main__":
-    pass
     main()
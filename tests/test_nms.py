@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+torch = pytest.importorskip("torch")
+utils = pytest.importorskip("utils.utils")  # Also needs cv2, albumentations...
+
+
+def reference_nms(boxes, scores, nms_thres):
+    """Sequential greedy NMS, one box at a time (the old while-loop) => kept indices by decreasing score"""
+    keep, suppressed = [], torch.zeros(len(boxes), dtype=torch.bool)
+    for i in scores.argsort(descending=True).tolist():
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= utils.box_iou_matrix(boxes[i:i + 1], boxes)[0] > nms_thres
+    return keep
+
+
+def chain(n, step=3, side=10):
+    # Each box overlaps the next one (IoU 0.57) but not the one after (IoU 0.29)
+    x = torch.arange(n, dtype=torch.float32) * step
+    boxes = torch.stack((x, torch.zeros(n), x + side, torch.full((n,), float(side))), 1)
+    return boxes, torch.linspace(1.0, 0.5, n)
+
+
+@pytest.mark.parametrize("max_passes", [1, 8, 1000])
+def test_long_chain_matches_the_sequential_greedy(max_passes):
+    boxes, scores = chain(600)
+    keep, owner = utils.nms_groups(boxes, scores, torch.zeros(len(boxes), dtype=torch.long), nms_thres=0.5,
+                                   max_passes=max_passes)
+    assert keep.tolist() == reference_nms(boxes, scores, 0.5) == list(range(0, 600, 2))
+    assert owner[1::2].tolist() == list(range(0, 600, 2))  # Suppressed by the previous box
+
+
+def test_random_boxes_match_the_sequential_greedy():
+    rng = torch.Generator().manual_seed(0)
+    for _ in range(20):
+        n = int(torch.randint(1, 300, (1,), generator=rng))
+        xy = torch.rand(n, 2, generator=rng) * 200
+        boxes = torch.cat((xy, xy + 5 + torch.rand(n, 2, generator=rng) * 55), 1)
+        scores = torch.rand(n, generator=rng)
+        groups = torch.randint(0, 3, (n,), generator=rng)
+
+        keep, _ = utils.nms_groups(boxes, scores, groups, nms_thres=0.4, block_size=64, max_passes=2)
+        expected = []
+        for group in range(3):
+            idxs = (groups == group).nonzero().view(-1)
+            expected += idxs[reference_nms(boxes[idxs], scores[idxs], 0.4)].tolist()
+        assert sorted(keep.tolist()) == sorted(expected)
+        assert scores[keep].tolist() == sorted(scores[keep].tolist(), reverse=True)
@@ -0,0 +1,159 @@
+import os
+import sys
+import subprocess
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+from utils.page_cache import PageCache, attach_segment
+
+INPUT_SIZE = 64
+SHAPE = (INPUT_SIZE, INPUT_SIZE)
+
+
+def make_page(value):
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+def make_letterbox(value):
+    return np.array([value, value, 1, 1, 0, 0], dtype=np.float32)
+
+
+def fill_in_worker(cache, index):
+    # Runs in a spawned process: the cache is attached by name (see PageCache.__setstate__)
+    cache.put(index, SHAPE, make_page(index), make_letterbox(index))
+    cache.close()
+
+
+@pytest.fixture
+def page_cache():
+    cache = PageCache(2 * INPUT_SIZE * INPUT_SIZE, SHAPE)  # 2 slots
+    yield cache
+    cache.close()
+
+
+def test_get_returns_the_page_and_its_letterbox(page_cache):
+    assert page_cache.get(0, SHAPE) is None
+    page_cache.put(0, SHAPE, make_page(7), make_letterbox(7))
+    img, letterbox = page_cache.get(0, SHAPE)
+    assert np.array_equal(img, make_page(7))
+    assert np.array_equal(letterbox, make_letterbox(7))
+    assert page_cache.get(0, (48, INPUT_SIZE)) is None  # Another letterbox of the same page
+    assert page_cache.stats()['hits'] == 1
+
+
+def test_eviction_keeps_the_pages_hit_since_the_last_sweep(page_cache):
+    page_cache.put(0, SHAPE, make_page(0), make_letterbox(0))
+    page_cache.put(1, SHAPE, make_page(1), make_letterbox(1))
+    page_cache.get(0, SHAPE)  # Second chance
+    page_cache.put(2, SHAPE, make_page(2), make_letterbox(2))
+
+    assert page_cache.get(1, SHAPE) is None
+    assert np.array_equal(page_cache.get(0, SHAPE)[0], make_page(0))
+    assert np.array_equal(page_cache.get(2, SHAPE)[0], make_page(2))
+    assert page_cache.stats()['evictions'] == 1
+
+
+def test_pages_larger_than_a_slot_are_not_cached(page_cache):
+    assert not page_cache.put(0, SHAPE, np.zeros((INPUT_SIZE + 1, INPUT_SIZE), dtype=np.uint8), make_letterbox(0))
+    assert page_cache.stats()['pages'] == 0
+
+
+def test_segment_survives_a_spawned_worker():
+    ctx = multiprocessing.get_context('spawn')
+    page_cache = PageCache(2 * INPUT_SIZE * INPUT_SIZE, SHAPE, context=ctx)
+    for index in (3, 4):  # One worker after another: the first one exiting must not unlink the segment
+        worker = ctx.Process(target=fill_in_worker, args=(page_cache, index))
+        worker.start()
+        worker.join()
+        assert worker.exitcode == 0
+
+    for index in (3, 4):
+        img, letterbox = page_cache.get(index, SHAPE)
+        assert np.array_equal(img, make_page(index))
+        assert np.array_equal(letterbox, make_letterbox(index))
+
+    # Still attachable by name (eg. by the next epoch's workers)
+    shm = shared_memory.SharedMemory(name=page_cache.shm.name)
+    shm.close()
+    page_cache.close()
+
+
+def test_segment_survives_a_process_with_its_own_resource_tracker(page_cache):
+    page_cache.put(0, SHAPE, make_page(5), make_letterbox(5))
+    # Independent interpreter (own resource tracker), which is stopped before exiting: it cleans up synchronously
+    code = "import sys; sys.path.insert(0, {!r}); from utils.page_cache import attach_segment; " \
+           "from multiprocessing import resource_tracker; attach_segment({!r}).close(); " \
+           "resource_tracker._resource_tracker._stop()".format(BASE_PATH, page_cache.shm.name)
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+    assert np.array_equal(page_cache.get(0, SHAPE)[0], make_page(5))
+    attach_segment(page_cache.shm.name).close()
+
+
+def test_budget_smaller_than_a_page_is_rejected():
+    with pytest.raises(ValueError):
+        PageCache(INPUT_SIZE * INPUT_SIZE - 1, SHAPE)
+
+
+def test_close_unlinks_the_segment():
+    cache = PageCache(INPUT_SIZE * INPUT_SIZE, SHAPE)
+    name = cache.shm.name
+    cache.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+@pytest.fixture
+def dataset_path(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+
+    # One wide page (not square => letterboxed) with two boxes
+    page = np.full((90, 150), 255, dtype=np.uint8)
+    page[20:40, 30:80] = 0
+    page[50:80, 100:140] = 0
+    cv2.imwrite(str(tmp_path / "page.png"), page)
+    with open(tmp_path / "page.txt", 'w') as f:
+        f.write("0 0.3667 0.3333 0.3333 0.2222\n")
+        f.write("1 0.8000 0.7222 0.2667 0.3333\n")
+    return str(tmp_path)
+
+
+def make_dataset(path, page_cache, multiscale=False):
+    pytest.importorskip("torch")
+    pytest.importorskip("albumentations")
+    from utils.datasets import ListDataset
+    return ListDataset(path, path, INPUT_SIZE, multiscale=multiscale, class_names=["a", "b"], single_channel=True,
+                       page_cache=page_cache)
+
+
+def assert_same_sample(miss, hit):
+    _, img_miss, labels_miss, bboxes_miss, letterbox_miss = miss
+    _, img_hit, labels_hit, bboxes_hit, letterbox_hit = hit
+    assert np.array_equal(img_miss, img_hit)
+    assert labels_miss.tolist() == labels_hit.tolist()
+    assert np.allclose(np.asarray(letterbox_miss, dtype=np.float32), letterbox_hit)
+    assert np.allclose(np.asarray(bboxes_miss)[:, :4], np.asarray(bboxes_hit)[:, :4], atol=1e-4)
+
+
+@pytest.mark.parametrize("shape", [None, (48, INPUT_SIZE)])
+def test_hit_yields_the_same_sample_as_a_miss(dataset_path, page_cache, shape):
+    dataset = make_dataset(dataset_path, page_cache)
+    miss = dataset.load_sample(0, shape)
+    hit = dataset.load_sample(0, shape)
+    assert page_cache.stats()['hits'] == 1
+    assert_same_sample(miss, hit)
+
+
+def test_hit_ignores_the_multiscale_size(dataset_path, page_cache):
+    dataset = make_dataset(dataset_path, page_cache, multiscale=True)
+    miss = dataset.load_sample(0)
+    dataset.input_size = INPUT_SIZE + 32  # As the multiscale collate does
+    hit = dataset.load_sample(0)
+    assert page_cache.stats()['hits'] == 1
+    assert_same_sample(miss, hit)
@@ -0,0 +1,122 @@
+import os
+import sys
+
+import pytest
+
+BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, BASE_PATH)
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+runtime = pytest.importorskip("utils.runtime")
+darknet = pytest.importorskip("models.yolov3.darknet")  # Also needs cv2, albumentations...
+
+# Every layer type of the YOLOv3 cfgs: 2 YOLO layers (strides 4 and 2), a shortcut, routes and an upsample
+TINY_CFG = """
+[net]
+channels=1
+
+[convolutional]
+batch_normalize=1
+filters=8
+size=3
+stride=1
+pad=1
+activation=leaky
+
+[maxpool]
+size=2
+stride=2
+
+[convolutional]
+batch_normalize=1
+filters=16
+size=3
+stride=2
+pad=1
+activation=leaky
+
+[convolutional]
+batch_normalize=1
+filters=16
+size=1
+stride=1
+pad=1
+activation=leaky
+
+[shortcut]
+from=-2
+activation=linear
+
+[convolutional]
+size=1
+stride=1
+pad=1
+filters=21
+activation=linear
+
+[yolo]
+mask=3,4,5
+anchors=4,4, 8,4, 4,8, 16,16, 32,16, 16,32
+classes=2
+num=6
+
+[route]
+layers=-3
+
+[upsample]
+stride=2
+
+[route]
+layers=-1, -8
+
+[convolutional]
+size=1
+stride=1
+pad=1
+filters=21
+activation=linear
+
+[yolo]
+mask=0,1,2
+anchors=4,4, 8,4, 4,8, 16,16, 32,16, 16,32
+classes=2
+num=6
+"""
+
+
+@pytest.fixture
+def tiny_darknet(tmp_path):
+    cfg_path = tmp_path / "tiny.cfg"
+    cfg_path.write_text(TINY_CFG)
+    torch.manual_seed(0)
+    return darknet.Darknet(config_path=str(cfg_path), input_size=96).eval()
+
+
+def test_darknet_parity(tiny_darknet, tmp_path):
+    onnx_path = str(tmp_path / "tiny.onnx")
+    darknet.export_darknet(tiny_darknet, onnx_path, (64, 96))
+    backend = runtime.ONNXBackend(onnx_path)
+    assert backend.input_channels == 1
+
+    # Dynamic axes: another batch size and the transposed rectangle
+    for size in [(64, 96), (96, 64)]:
+        for batch_size in [1, 3]:
+            runtime.check_parity(tiny_darknet, backend, size, batch_size=batch_size, channels=1)
+
+
+def test_ssd_parity(tmp_path, monkeypatch):
+    ssd = pytest.importorskip("models.ssd.model")
+    monkeypatch.setattr(ssd.VGGBase, "load_pretrained_layers", lambda self: None)  # No ImageNet download
+    torch.manual_seed(0)
+    model = ssd.SSD300(n_classes=3, input_size=(300, 300)).cpu().eval()
+    model.priors_cxcy = model.priors_cxcy.cpu()
+
+    onnx_path = str(tmp_path / "ssd.onnx")
+    ssd.export_ssd(model, onnx_path)
+    backend = runtime.ONNXBackend(onnx_path)
+    assert torch.allclose(backend.priors_cxcy, model.priors_cxcy)
+    assert backend.n_classes == 3
+
+    for batch_size in [1, 2]:
+        runtime.check_parity(model, backend, model.input_size, batch_size=batch_size)
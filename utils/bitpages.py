@@ -0,0 +1,65 @@
+import struct
+import functools
+
+import numpy as np
+
+# Page file (*.bits): header (magic, height, width, bits per pixel) + one packed bit plane per bit (MSB first),
+# each plane packed by rows => (bits, height, ceil(width / 8)) bytes
+PAGE_MAGIC = b'BITP'
+PAGE_HEADER = struct.Struct('<4sIIB3x')
+
+
+@functools.lru_cache(maxsize=None)
+def page_lut(bits):
+    """Gray level of each value: 1 bit => (0, 255); 2 bits => (0, 85, 170, 255)"""
+    return np.linspace(0, 255, 2 ** bits).round().astype(np.uint8)
+
+
+def pack_page(gray, bits=1, threshold=128):
+    """
+    Grayscale page (h, w) uint8 => packed bit planes (bits, h, ceil(w / 8)).
+    1 bit: binarized at 'threshold' (white=1); 2 bits: the 4 most significant gray levels
+    """
+    levels = (gray >= threshold).astype(np.uint8) if bits == 1 else gray >> (8 - bits)
+    return np.stack([np.packbits((levels >> (bits - 1 - i)) & 1, axis=1) for i in range(bits)])
+
+
+def unpack_page(planes, width):
+    """
+    Packed bit planes => page (h, w) of uint8 gray levels (batches stay uint8 up to the model, see
+    utils.utils.normalize_batch). Vectorized: one unpackbits per plane and a single table lookup
+    """
+    bits = planes.shape[0]
+    levels = np.unpackbits(planes[0], axis=1, count=width)
+    for plane in planes[1:]:
+        levels = (levels << 1) | np.unpackbits(plane, axis=1, count=width)
+    return page_lut(bits)[levels]
+
+
+def save_page(filename, gray, bits=1, threshold=128):
+    planes = pack_page(gray, bits=bits, threshold=threshold)
+    with open(filename, 'wb') as f:
+        f.write(PAGE_HEADER.pack(PAGE_MAGIC, gray.shape[0], gray.shape[1], bits))
+        f.write(planes.tobytes())
+
+
+def read_page_header(f):
+    magic, height, width, bits = PAGE_HEADER.unpack(f.read(PAGE_HEADER.size))
+    if magic != PAGE_MAGIC:
+        raise ValueError("Not a bit-packed page: {}".format(f.name))
+    return height, width, bits
+
+
+def load_page(filename):
+    """*.bits page => (h, w) uint8 array (see unpack_page)"""
+    with open(filename, 'rb') as f:
+        height, width, bits = read_page_header(f)
+        planes = np.frombuffer(f.read(), dtype=np.uint8).reshape(bits, height, (width + 7) // 8)
+    return unpack_page(planes, width)
+
+
+def page_size(filename):
+    """(width, height) of a *.bits page (header only)"""
+    with open(filename, 'rb') as f:
+        height, width, _ = read_page_header(f)
+    return width, height
@@ -1,7 +1,13 @@
 import glob
+import math
+import struct
+import hashlib
+import multiprocessing
+import functools
 import random
 import os
 import sys
+import warnings
 import numpy as np
 from PIL import Image
 import torch
@@ -9,16 +15,380 @@ import torch.nn.functional as F
 import albumentations as A
 
 # from utils.augmentations import horisontal_flip
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from torchvision import transforms
 from utils.utils import *
 from models.ssd.utils import transform
-
+from utils.bitpages import load_page, page_size
+
+# Shard files (see pack_dataset)
+SHARD_META = 'meta.json'
+SHARD_IMAGES = 'images.bin'
+SHARD_LABELS = 'labels.npy'
+SHARD_BBOXES = 'bboxes.npy'
+SHARD_OFFSETS = 'offsets.npy'
+SHARD_LETTERBOXES = 'letterboxes.npy'
+
+
+def load_image(img_path, single_channel=False):
+    """
+    Image => RGB numpy array (uint8), or grayscale (h, w) if 'single_channel' (decoded as L, not converted later).
+    Raw arrays (*.npy) skip decoding, and bit-packed pages (*.bits, see utils.bitpages) are unpacked
+    (see preprocessing/preprocessing.py)
+    """
+    if img_path.endswith('.bits'):
+        img = load_page(img_path)
+    elif img_path.endswith('.npy'):
+        img = np.load(img_path)
+        if img.ndim == 3 and single_channel:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    else:
+        return np.asarray(Image.open(img_path).convert('L' if single_channel else 'RGB'))
+    return img if single_channel or img.ndim == 3 else np.stack([img] * 3, axis=-1)
+
+
+def load_image_reduced(img_path, shape, single_channel=False):
+    """
+    Image to be letterboxed into 'shape' (height, width) => (img, original (height, width)).
+    JPEGs at least 2x larger than their letterbox are decoded at a reduced scale (1/2, 1/4 or 1/8, in the DCT
+    domain, see PIL draft()) and then resized to the exact size the full decode would be letterboxed to, so the
+    letterbox (and its record, from the original size) is the same. Other images are decoded in full
+    """
+    if img_path.endswith(('.bits', '.npy')):
+        img = load_image(img_path, single_channel=single_channel)
+        return img, img.shape[:2]
+
+    pil_img = Image.open(img_path)
+    w, h = pil_img.size
+    scale = min(shape[0] / h, shape[1] / w)
+    mode = 'L' if single_channel else 'RGB'
+    if pil_img.format != 'JPEG' or scale > 0.5:
+        return np.asarray(pil_img.convert(mode)), (h, w)
+
+    # Reduced decode (>= the requested size) + final resize (as letterbox/letterbox_record)
+    new_h, new_w = min(int(round(h * scale)), shape[0]), min(int(round(w * scale)), shape[1])
+    pil_img.draft(mode, (new_w, new_h))
+    img = np.asarray(pil_img.convert(mode))
+    if img.shape[:2] != (new_h, new_w):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    return img, (h, w)
+
+
+def image_to_tensor(img):
+    """
+    (h, w) or (h, w, c) uint8 array => (c, h, w) uint8 tensor, built on the array memory (no float conversion here:
+    batches cross the DataLoader IPC 4x smaller; see utils.utils.normalize_batch).
+    Read-only arrays (eg. memory-mapped shard pages) are not copied either: the tensor is read-only too, so do not
+    modify it in place (the collate stacks the images into a new batch)
+    """
+    img = np.require(img, dtype=np.uint8, requirements=['C'])
+    if img.flags.writeable:
+        img = torch.from_numpy(img)
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # Non-writable array (documented above)
+            img = torch.from_numpy(img)
+    return img.unsqueeze(0) if img.dim() == 2 else img.permute(2, 0, 1)
 
 
 def resize(image, size):
-    image = F.interpolate(image.unsqueeze(0), size=size, mode="nearest").squeeze(0)
-    return image
+    if tuple(image.shape[-2:]) == (size, size):
+        return image
+    dtype = image.dtype
+    image = F.interpolate(image.unsqueeze(0).float(), size=size, mode="nearest").squeeze(0)
+    return image.to(dtype)
+
+
+def letterbox_record(original_shape, shape, max_size=None):
+    """
+    Letterbox of an image => float tensor (orig_h, orig_w, scale_h, scale_w, pad_top, pad_left).
+    The image is resized to fit into 'shape' (height, width), or its longest side to 'max_size' if given,
+    and padded (centered) to 'shape'. See utils.utils.unletterbox_boxes for the inverse transform
+    """
+    h, w = original_shape[:2]
+    scale = max_size / max(h, w) if max_size else min(shape[0] / h, shape[1] / w)
+    new_h, new_w = min(int(round(h * scale)), shape[0]), min(int(round(w * scale)), shape[1])
+    return torch.tensor([h, w, new_h / h, new_w / w, (shape[0] - new_h) // 2, (shape[1] - new_w) // 2],
+                        dtype=torch.float32)
+
+
+def letterbox_bboxes(bboxes_albu, letterbox, shape):
+    """
+    Bboxes in albumentations format (REL(xyxy)) in the original image => in its letterbox of 'shape' (height, width),
+    as the default format does, given the letterbox record of the image (no image needed)
+    """
+    orig_h, orig_w, scale_h, scale_w, pad_top, pad_left = [float(v) for v in letterbox]
+    sx, sy = orig_w * scale_w / shape[1], orig_h * scale_h / shape[0]
+    ox, oy = pad_left / shape[1], pad_top / shape[0]
+    return [(x1 * sx + ox, y1 * sy + oy, x2 * sx + ox, y2 * sy + oy) + tuple(rest)
+            for x1, y1, x2, y2, *rest in bboxes_albu]
+
+
+@functools.lru_cache(maxsize=None)
+def letterbox_format(max_side, min_height, min_width):
+    """
+    Default format (letterbox) for the images whose longest side must be resized to 'max_side'.
+    Cached, so the pipeline is only built once per (max_side, input size) bucket
+    """
+    return A.Compose([
+        # A.ToGray(p=1.0),
+        A.LongestMaxSize(max_size=max_side, interpolation=cv2.INTER_AREA),
+        A.PadIfNeeded(min_height=min_height, min_width=min_width,
+                      border_mode=cv2.BORDER_CONSTANT,
+                      value=(128, 128, 128)),
+    ], p=1)
+
+
+def label_filename(img_filename):
+    return os.path.splitext(img_filename)[0] + ".txt"  # jpg, png, webp, npy...
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.npy', '.bits')
+
+
+def list_images(images_path):
+    """Sorted image paths of a folder (other files, eg. a manifest or temporary files, are skipped)"""
+    return [os.path.join(images_path, f) for f in sorted(os.listdir(images_path))
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+
+
+class LabelStore:
+    """
+    Labels of a whole dataset in a single binary file (.npz), instead of one .txt per image.
+    Rows keep the format of the .txt files (class_id + REL(xywh)), stored as flat arrays plus per-image offsets,
+    so each lookup is O(1) and does not touch the filesystem.
+    """
+    def __init__(self, path):
+        data = np.load(path)
+        self.names = data['names'].tolist()
+        self.boxes = data['boxes']
+        self.offsets = data['offsets']
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        i = self.index[name]
+        return self.boxes[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def save(path, names, boxes):
+        """
+        names: label filenames (eg. 'page.txt'); boxes: list of arrays (n_i, 5) => class_id + REL(xywh)
+        """
+        offsets = np.cumsum([0] + [len(b) for b in boxes]).astype(np.int64)
+        boxes = np.concatenate([np.asarray(b, dtype=np.float32).reshape(-1, 5) for b in boxes]) if boxes \
+            else np.zeros((0, 5), dtype=np.float32)
+        np.savez(path, names=np.array(names), boxes=boxes, offsets=offsets)
+
+    @staticmethod
+    def from_labels_dir(labels_path, path):
+        names = sorted(f for f in os.listdir(labels_path) if f.endswith(".txt"))
+        boxes = [np.loadtxt(os.path.join(labels_path, f)).reshape(-1, 5) for f in tqdm.tqdm(names, desc="Reading labels")]
+        LabelStore.save(path, names, boxes)
+        return LabelStore(path)
+
+    @staticmethod
+    def from_json(json_path, path, images_path=None):
+        """
+        Converts the preprocessing json (images + ABS(xywh) annotations per image id).
+        Image sizes are taken from the json or, if missing, from the image headers in 'images_path'
+        """
+        json_dataset = load_dataset(json_path)
+        images_path = images_path or os.path.dirname(json_path)
+
+        names, boxes = [], []
+        for image_data in tqdm.tqdm(json_dataset['images'], desc="Reading annotations"):
+            if 'width' in image_data and 'height' in image_data:
+                img_w, img_h = image_data['width'], image_data['height']
+            else:
+                img_w, img_h = image_size(os.path.join(images_path, image_data['filename']))  # Header only
+
+            target_i = [[bbox['category_id'], bbox['bbox'][0]/img_w, bbox['bbox'][1]/img_h,
+                         bbox['bbox'][2]/img_w, bbox['bbox'][3]/img_h]
+                        for bbox in json_dataset['annotations'].get(str(image_data['id']), [])]
+            names.append(label_filename(image_data['filename']))
+            boxes.append(np.array(target_i, dtype=np.float32).reshape(-1, 5))
+        LabelStore.save(path, names, boxes)
+        return LabelStore(path)
+
+
+def list_labeled_files(images_path, labels_path, label_store=None):
+    """
+    Pairs each image with its labels: a .txt path or, with a label store, its key in the store
+    """
+    img_files = []
+    label_files = []
+    for filename in os.listdir(images_path):
+        img_path = os.path.join(images_path, filename)
+
+        # Check if labels exist
+        if label_store is not None:
+            label_path = label_filename(filename)
+            if label_path in label_store:
+                img_files.append(img_path)
+                label_files.append(label_path)
+        else:
+            label_path = os.path.join(labels_path, label_filename(filename))
+            if os.path.exists(label_path):
+                img_files.append(img_path)
+                label_files.append(label_path)
+    return img_files, label_files
+
+
+def load_labels(label_path, label_store=None):
+    if label_store is not None:
+        return torch.from_numpy(label_store[label_path].astype(np.float64))
+    return torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
+
+
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_size(path):
+    """
+    (width, height) of an image read from its header only (JPEG SOF / PNG IHDR). Other formats => PIL (lazy open)
+    """
+    if path.endswith('.npy'):
+        height, width = np.load(path, mmap_mode='r').shape[:2]
+        return width, height
+    if path.endswith('.bits'):
+        return page_size(path)
+
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return struct.unpack('>II', head[16:24])
+
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            while True:
+                byte = f.read(1)
+                if not byte:
+                    break
+                if byte != b'\xff':
+                    continue
+                marker = f.read(1)
+                while marker == b'\xff':  # Fill bytes
+                    marker = f.read(1)
+                if not marker:
+                    break
+                marker = ord(marker)
+                if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:  # No segment
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return width, height
+                f.seek(length - 2, 1)
+
+    return Image.open(path).size
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Content hash (SHA-1) of a file, read by chunks"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _probe_sample(paths):
+    # Manifest worker: image header + hash, and its labels (None => taken from the label store)
+    img_path, label_path = paths
+    width, height = image_size(img_path)
+    bboxes = np.loadtxt(label_path).reshape(-1, 5) if label_path else None
+    return width, height, file_hash(img_path), bboxes
+
+
+class Manifest:
+    """
+    Index of a dataset in a single file (.npz): image filenames, sizes (from the headers), content hashes,
+    label keys and the number of boxes per class of each image.
+    Datasets can start from it instead of listing the folders and checking every label file, and samplers or
+    statistics get the image sizes without decoding the images.
+    """
+    def __init__(self, path):
+        data = np.load(path)
+        self.names = data['names'].tolist()
+        self.label_names = data['label_names'].tolist()
+        self.heights = data['heights']
+        self.widths = data['widths']
+        self.hashes = data['hashes'].tolist()
+        self.histograms = data['histograms']  # (n_images, n_classes) => boxes per class
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def label_counts(self):
+        return self.histograms.sum(axis=1)
+
+    @property
+    def class_histogram(self):
+        return self.histograms.sum(axis=0)
+
+    def files(self, images_path, labels_path=None):
+        """
+        Image paths and their labels: a .txt path or, if 'labels_path' is a label store, its key in the store
+        (same as list_labeled_files)
+        """
+        img_files = [os.path.join(images_path, name) for name in self.names]
+        if labels_path and os.path.isfile(labels_path):
+            label_files = list(self.label_names)
+        else:
+            label_files = [os.path.join(labels_path, name) if labels_path else name for name in self.label_names]
+        return img_files, label_files
+
+    def stats(self):
+        return {'images': len(self), 'boxes': int(self.histograms.sum()),
+                'avg_w': float(self.widths.mean()), 'avg_h': float(self.heights.mean()),
+                'min_w': int(self.widths.min()), 'min_h': int(self.heights.min()),
+                'max_w': int(self.widths.max()), 'max_h': int(self.heights.max())}
+
+    @staticmethod
+    def build(images_path, labels_path, path, num_classes=None, num_workers=None):
+        """
+        Probes the images in parallel (headers and hashes only, nothing is decoded) and saves the manifest.
+        With labels, only the labeled images are kept (as list_labeled_files); without them, every image is
+        """
+        label_store = LabelStore(labels_path) if labels_path and os.path.isfile(labels_path) else None
+        if labels_path:
+            img_files, label_files = list_labeled_files(images_path, labels_path, label_store)
+            order = sorted(range(len(img_files)), key=lambda i: img_files[i])
+            img_files, label_files = [img_files[i] for i in order], [label_files[i] for i in order]
+        else:
+            img_files = list_images(images_path)
+            label_files = [label_filename(os.path.basename(f)) for f in img_files]
+
+        # Probe (the label store is read here; .txt files in the workers)
+        jobs = [(img_path, label_path if labels_path and label_store is None else None)
+                for img_path, label_path in zip(img_files, label_files)]
+        with multiprocessing.Pool(num_workers) as pool:
+            results = list(tqdm.tqdm(pool.imap(_probe_sample, jobs, chunksize=32), total=len(jobs),
+                                     desc="Probing {}".format(images_path)))
+
+        widths, heights, hashes, bboxes = [list(x) for x in zip(*results)] if results else ([], [], [], [])
+        if label_store is not None:
+            bboxes = [label_store[label_path] for label_path in label_files]
+        classes = [b[:, 0].astype(np.int64) for b in bboxes if b is not None and len(b)]
+        if num_classes is None:
+            num_classes = int(max([c.max() for c in classes] + [-1])) + 1
+        histograms = np.zeros((len(img_files), num_classes), dtype=np.int32)
+        for i, b in enumerate(bboxes):
+            if b is not None and len(b):
+                histograms[i] = np.bincount(b[:, 0].astype(np.int64), minlength=num_classes)[:num_classes]
+
+        np.savez(path, names=np.array([os.path.basename(f) for f in img_files]),
+                 label_names=np.array([os.path.basename(f) for f in label_files]),
+                 heights=np.array(heights, dtype=np.int32), widths=np.array(widths, dtype=np.int32),
+                 hashes=np.array(hashes), histograms=histograms)
+        return Manifest(path)
 
 
 class PascalVOCDataset(Dataset):
@@ -64,7 +434,7 @@ class PascalVOCDataset(Dataset):
                 return img_path, None, None
 
             # Load image
-            img = np.asarray(Image.open(img_path).convert('RGB'))
+            img = load_image(img_path)
 
             # Get input dimensions
             h, w, c = img.shape
@@ -78,14 +448,8 @@ class PascalVOCDataset(Dataset):
             min_h = min(h, self.input_size[0])
             max_side = max(min_h, min_w)
 
-            # Data format
-            self.data_format = A.Compose([
-                # A.ToGray(p=1.0),
-                A.LongestMaxSize(max_size=max_side, interpolation=cv2.INTER_AREA),
-                A.PadIfNeeded(min_height=self.input_size[0], min_width=self.input_size[1],
-                              border_mode=cv2.BORDER_CONSTANT,
-                              value=(128, 128, 128)),
-            ], p=1)
+            # Data format (built once per bucket)
+            self.data_format = letterbox_format(max_side, self.input_size[0], self.input_size[1])
 
 
             # Convert bboxes to albumentations [BBOXES=NUMPY]
@@ -111,8 +475,8 @@ class PascalVOCDataset(Dataset):
             # print("Regions: {}".format(len(bboxes_xyxy_abs)))
             # plot_bboxes(img, bboxes_xyxy_abs, title="Augmented ({})".format(img_path))
 
-            # Convert (PIL/Numpy) to PyTorch Tensor
-            img = transforms.ToTensor()(Image.fromarray(img))
+            # Convert (Numpy) to PyTorch Tensor (uint8)
+            img = image_to_tensor(img)
             img_c, img_h, img_w = img.shape
 
             # Fix bboxes (keep into the region boundaries)
@@ -187,19 +551,9 @@ class ListDatasetSSD(Dataset):
         self.ignored, self.total = 0, 0
         self.single_channel = single_channel
 
-        # Get files
-        self.img_files = []
-        self.label_files = []
-        for filename in os.listdir(images_path):
-            img_path = os.path.join(images_path, filename)
-            label_path = os.path.join(labels_path, filename.replace(".jpg", ".txt").replace(".png", ".txt"))
-
-            # Check if label file exists
-            if os.path.exists(label_path):
-                self.img_files.append(img_path)
-                self.label_files.append(label_path)
-
-
+        # Get files (labels from a single label store if 'labels_path' is a file)
+        self.label_store = LabelStore(labels_path) if os.path.isfile(labels_path) else None
+        self.img_files, self.label_files = list_labeled_files(images_path, labels_path, self.label_store)
 
     def __getitem__(self, index):
         # For debugging
@@ -211,7 +565,7 @@ class ListDatasetSSD(Dataset):
         label_path = self.label_files[index % len(self.img_files)].rstrip()
 
         # Load bboxes
-        bboxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
+        bboxes = load_labels(label_path, self.label_store)
 
         # Remove elements to balance training
         if self.balance_classes:
@@ -222,10 +576,10 @@ class ListDatasetSSD(Dataset):
         if bboxes.size(0) == 0:
             self.ignored += 1
             print("Ignored {}/{}".format(self.ignored, self.total))
-            return img_path, None, None
+            return img_path, None, [], None, None
 
         # Load image
-        img = np.asarray(Image.open(img_path).convert('RGB'))
+        img = load_image(img_path)
 
         # Get input dimensions
         h, w, c = img.shape
@@ -235,14 +589,9 @@ class ListDatasetSSD(Dataset):
         min_h = min(h, self.input_size[0])
         max_side = max(min_h, min_w)
 
-        # Data format
-        self.data_format = A.Compose([
-            #A.ToGray(p=1.0),
-            A.LongestMaxSize(max_size=max_side, interpolation=cv2.INTER_AREA),
-            A.PadIfNeeded(min_height=self.input_size[0], min_width=self.input_size[1],
-                          border_mode=cv2.BORDER_CONSTANT,
-                          value=(128, 128, 128)),
-        ], p=1)
+        # Data format (built once per bucket)
+        self.data_format = letterbox_format(max_side, self.input_size[0], self.input_size[1])
+        img_letterbox = letterbox_record((h, w), self.input_size, max_size=max_side)
 
 
         # Convert bboxes
@@ -277,8 +626,8 @@ class ListDatasetSSD(Dataset):
         # print("Regions: {}".format(len(bboxes_xyxy_abs)))
         # plot_bboxes(img, bboxes_xyxy_abs, title="Augmented ({})".format(img_path))
 
-        # Convert (PIL/Numpy) to PyTorch Tensor
-        img = transforms.ToTensor()(Image.fromarray(img))
+        # Convert (Numpy) to PyTorch Tensor (uint8)
+        img = image_to_tensor(img)
         img_c, img_h, img_w = img.shape
 
         # Fix bboxes (keep into the region boundaries)
@@ -304,7 +653,7 @@ class ListDatasetSSD(Dataset):
 
         # print(self.class_counter.tolist())
         self.total += 1
-        return img_path, img, boxes_xyxy_rel, bboxes_labels.type(torch.int64)
+        return img_path, img, boxes_xyxy_rel, bboxes_labels.type(torch.int64), img_letterbox
 
     def collate_fn(self, batch):
         """
@@ -315,13 +664,14 @@ class ListDatasetSSD(Dataset):
         Note: this need not be defined in this Class, can be standalone.
 
         :param batch: an iterable of N sets from __getitem__()
-        :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels, and difficulties
+        :return: a tensor of images, lists of varying-size tensors of bounding boxes, labels, and the letterboxes (N, 6)
         """
 
         img_paths = list()
         images = list()
         boxes = list()
         labels = list()
+        letterboxes = list()
 
         for b in batch:
             if len(b[2]) == 0:  # Skip images without bounding boxes
@@ -330,10 +680,12 @@ class ListDatasetSSD(Dataset):
             images.append(b[1])
             boxes.append(b[2])
             labels.append(b[3])
+            letterboxes.append(b[4])
 
         images = torch.stack(images, dim=0) if images else images
+        letterboxes = torch.stack(letterboxes, dim=0) if letterboxes else letterboxes
 
-        return img_paths, images, boxes, labels  # tensor (N, 3, 300, 300), 3 lists of N tensors each
+        return img_paths, images, boxes, labels, letterboxes  # tensor (N, 3, 300, 300), 3 lists of N tensors each, tensor (N, 6)
 
     def __len__(self):
         return len(self.img_files)
@@ -341,10 +693,12 @@ class ListDatasetSSD(Dataset):
 
 class ListDataset(Dataset):
     def __init__(self, images_path, labels_path, input_size, transform=None, multiscale=False, normalized_bboxes=True,
-                 balance_classes=False, class_names=None, single_channel=True):
+                 balance_classes=False, class_names=None, single_channel=True, manifest=None, page_cache=None,
+                 reduced_decode=True):
         self.img_files = []
         self.label_files = []
-        self.input_size = input_size
+        self.input_size = input_size  # Batch size of the collate (changes with multiscale)
+        self.base_input_size = input_size  # Letterbox of the pages (fixed; the collate resizes them)
         self.transform = transform
         self.normalized_bboxes = normalized_bboxes
         self.multiscale = multiscale
@@ -355,55 +709,75 @@ class ListDataset(Dataset):
         self.ignored, self.total = 0, 0
         self.single_channel = single_channel
         self.batch_count = 0
+        self.rect_data_formats = {}
+        self.page_cache = page_cache  # Shared decoded pages (see utils.page_cache.PageCache)
+        self.reduced_decode = reduced_decode  # Large JPEGs decoded at a reduced scale (see load_image_reduced)
 
         # Data format
-        self.data_format = A.Compose([
-            A.ToGray(p=1.0),
-            A.LongestMaxSize(max_size=self.input_size, interpolation=cv2.INTER_AREA),
-            A.PadIfNeeded(min_height=self.input_size, min_width=self.input_size, border_mode=cv2.BORDER_CONSTANT,
+        self.data_format = self.build_data_format(self.base_input_size, self.base_input_size)
+
+        # Get files (labels from a single label store if 'labels_path' is a file)
+        self.label_store = LabelStore(labels_path) if labels_path and os.path.isfile(labels_path) else None
+        self.manifest = Manifest(manifest) if manifest else None  # No folder scans (see Manifest)
+        if self.manifest is not None:
+            self.img_files, self.label_files = self.manifest.files(images_path, labels_path)
+        else:
+            self.img_files, self.label_files = self.list_files(images_path, labels_path)
+
+    def list_files(self, images_path, labels_path):
+        return list_labeled_files(images_path, labels_path, self.label_store)
+
+    def build_data_format(self, height, width):
+        # Single channel pages are decoded as L (1 channel all the way), RGB pages are converted to gray
+        return A.Compose(([] if self.single_channel else [A.ToGray(p=1.0)]) + [
+            A.LongestMaxSize(max_size=self.base_input_size, interpolation=cv2.INTER_AREA),
+            A.PadIfNeeded(min_height=height, min_width=width, border_mode=cv2.BORDER_CONSTANT,
                           value=(128, 128, 128)),
         ], p=1)
 
-        # Get files
-        self.img_files = []
-        self.label_files = []
-        for filename in os.listdir(images_path):
-            img_path = os.path.join(images_path, filename)
-            label_path = os.path.join(labels_path, filename.replace(".jpg", ".txt").replace(".png", ".txt"))
+    def get_data_format(self, shape=None):
+        """
+        Default format (letterbox) for a (height, width) input shape (None => square base_input_size)
+        """
+        if shape is None:
+            return self.data_format
 
-            # Check if label file exists
-            if os.path.exists(label_path):
-                self.img_files.append(img_path)
-                self.label_files.append(label_path)
+        if shape not in self.rect_data_formats:
+            self.rect_data_formats[shape] = self.build_data_format(shape[0], shape[1])
+        return self.rect_data_formats[shape]
 
-    def __getitem__(self, index):
-        # For debugging
-        # print("Index: {}".format(index))
-        # index = 174
-        index = index
+    def load_sample(self, index, shape=None):
+        """
+        Loads an image in its default format (letterbox) with its labels and bboxes in albumentations format
+        The letterbox is square (input_size) unless a (height, width) shape is given (see AspectRatioBatchSampler)
+        Returns: img_path, img, labels, bboxes_albu, letterbox (img=None if there are no bboxes)
+        """
         # Get paths
         img_path = self.img_files[index % len(self.img_files)].rstrip()
         label_path = self.label_files[index % len(self.img_files)].rstrip()
 
         # Load bboxes
-        bboxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
-
-        # Remove elements to balance training
-        if self.balance_classes:
-            kept_indices = balance_batch(bboxes[:, 0].numpy(), self.class_counter)
-            bboxes = bboxes[kept_indices]
+        bboxes = load_labels(label_path, self.label_store)
 
-        # Ignore image if empty boxes
+        # Empty image (do not decode it)
         if bboxes.size(0) == 0:
-            self.ignored += 1
-            print("Ignored {}/{}".format(self.ignored, self.total))
-            return img_path, None, None
-
-        # Load image
-        img = np.asarray(Image.open(img_path).convert('RGB'))
+            return img_path, None, None, None, None
+
+        # Load image (decoded and letterboxed page from the cache, if it is there)
+        page_shape = shape or (self.base_input_size, self.base_input_size)  # Not the multiscale size
+        cached = self.page_cache.get(index % len(self.img_files), page_shape) if self.page_cache is not None else None
+        if cached is not None:
+            img, img_letterbox = cached
+            h, w = int(img_letterbox[0]), int(img_letterbox[1])
+        else:
+            max_shape = (self.base_input_size, self.base_input_size)  # Longest side => base size (not multiscale)
+            if self.reduced_decode:
+                img, (h, w) = load_image_reduced(img_path, max_shape, single_channel=self.single_channel)
+            else:
+                img = load_image(img_path, single_channel=self.single_channel)
+                h, w = img.shape[:2]
 
         # Get input dimensions
-        h, w, c = img.shape
         h_factor, w_factor = (h, w) if self.normalized_bboxes else (1, 1)
 
         # Convert bboxes
@@ -416,13 +790,44 @@ class ListDataset(Dataset):
         # plot_bboxes(img, bboxes_xyxy_abs, title="Original ({})".format(img_path))
 
         # Convert bboxes to albumentations [BBOXES=NUMPY]
-        bboxes_albu = convert_bboxes_to_albumentations(bboxes_xyxy_abs.numpy(), source_format='pascal_voc', rows=img.shape[0], cols=img.shape[1])
+        bboxes_albu = convert_bboxes_to_albumentations(bboxes_xyxy_abs.numpy(), source_format='pascal_voc', rows=h, cols=w)
+
+        # Cached page => only the bboxes need the default format
+        if cached is not None:
+            return img_path, img, bboxes_labels, letterbox_bboxes(bboxes_albu, img_letterbox, img.shape[:2]), img_letterbox
 
         # Default image format
-        img_format = self.data_format(image=img, bboxes=bboxes_albu)
-        img = img_format['image'][..., 0] if self.single_channel else img_format['image']  # 1 vs. 3 channels
+        img_format = self.get_data_format(shape)(image=img, bboxes=bboxes_albu)
+        img = img_format['image']  # (h, w) if single channel, else (h, w, 3)
         # img = img[..., np.newaxis]  # Add channel dimension
         bboxes_albu = img_format['bboxes']
+        img_letterbox = letterbox_record((h, w), img.shape[:2], max_size=self.base_input_size)
+        if self.page_cache is not None:
+            self.page_cache.put(index % len(self.img_files), page_shape, img, img_letterbox)
+
+        return img_path, img, bboxes_labels, bboxes_albu, img_letterbox
+
+    def __getitem__(self, index):
+        # For debugging
+        # print("Index: {}".format(index))
+        # index = 174
+        # Index from AspectRatioBatchSampler => (index, (height, width))
+        index, shape = index if isinstance(index, tuple) else (index, None)
+
+        # Load image (default format) and bboxes
+        img_path, img, bboxes_labels, bboxes_albu, img_letterbox = self.load_sample(index, shape)
+
+        # Remove elements to balance training
+        if self.balance_classes and img is not None:
+            kept_indices = balance_batch(bboxes_labels.numpy(), self.class_counter)
+            bboxes_labels = bboxes_labels[kept_indices]
+            bboxes_albu = [bboxes_albu[i] for i in kept_indices]
+
+        # Ignore image if empty boxes
+        if img is None or len(bboxes_albu) == 0:
+            self.ignored += 1
+            print("Ignored {}/{}".format(self.ignored, self.total))
+            return img_path, None, None, None
 
         # Custom transformations
         if self.transform:
@@ -438,8 +843,8 @@ class ListDataset(Dataset):
         # print("Regions: {}".format(len(bboxes_xyxy_abs)))
         # plot_bboxes(img, bboxes_xyxy_abs, title="Augmented ({})".format(img_path))
 
-        # Convert (PIL/Numpy) to PyTorch Tensor
-        img = transforms.ToTensor()(Image.fromarray(img))
+        # Convert (Numpy) to PyTorch Tensor (uint8)
+        img = image_to_tensor(img)
         img_c, img_h, img_w = img.shape
 
         # Fix bboxes (keep into the region boundaries)
@@ -473,17 +878,17 @@ class ListDataset(Dataset):
 
         # print(self.class_counter.tolist())
         self.total += 1
-        return img_path, img, targets
+        return img_path, img, targets, img_letterbox
 
     def collate_fn(self, batch):
-        img_paths, imgs, targets = list(zip(*batch))
+        # Drop the ignored images (all their fields at once, so paths, images and letterboxes stay aligned)
+        batch = [sample for sample in batch if sample[1] is not None]
 
         # If empty, leave
-        if targets[0] is None:
-            return None, None, None
-
-        # Get targets as a list of tensors
-        targets = [boxes for boxes in targets if boxes is not None]
+        if not batch:
+            return None, None, None, None
+        img_paths, imgs, targets, letterboxes = list(zip(*batch))
+        targets = list(targets)
 
         # Add index to track this batch
         for i, boxes in enumerate(targets):
@@ -495,34 +900,227 @@ class ListDataset(Dataset):
         # Selects new image size every tenth batch
         if self.multiscale and self.batch_count % 10 == 0:
             self.input_size = random.choice(range(self.min_input_size, self.max_input_size + 1, 32))
-        # Resize images to input shape
-        imgs = torch.stack([resize(img, self.input_size) for img in imgs])
+        # Letterbox of each image (the default format; custom transformations are not tracked)
+        letterboxes = torch.stack(letterboxes)
+
+        # Resize images to input shape (rectangular batches are already letterboxed to their own shape)
+        base_shape = (self.base_input_size, self.base_input_size)
+        shapes = set(tuple(img.shape[1:]) for img in imgs)
+        if shapes == {base_shape}:
+            letterboxes[:, 2:] *= self.input_size / self.base_input_size  # Scales and padding (multiscale)
+            imgs = torch.stack([resize(img, self.input_size) for img in imgs])
+        elif len(shapes) == 1:
+            imgs = torch.stack(imgs)
+        else:
+            raise ValueError("Images of different shapes in a batch: {}".format(sorted(shapes)))
 
         # Images to Tensor
         # imgs = torch.stack([img for img in imgs])
         self.batch_count += 1
-        return img_paths, imgs, targets
+        return img_paths, imgs, targets, letterboxes
 
     def __len__(self):
         return len(self.img_files)
 
 
+class ShardDataset(ListDataset):
+    """
+    ListDataset that reads the letterboxed pages (uint8) and their bboxes from a shard written by pack_dataset.
+    Pages are memory-mapped (zero-copy), so the workers only apply the custom transformations (augmentation).
+    """
+    def __init__(self, shard_path, transform=None, multiscale=False, balance_classes=False, class_names=None):
+        self.shard_path = shard_path
+        self._images = None  # Opened lazily (once per worker)
+
+        # Read shard
+        with open(os.path.join(shard_path, SHARD_META), 'r') as f:
+            self.meta = json.load(f)
+        self.labels = np.load(os.path.join(shard_path, SHARD_LABELS))
+        self.bboxes = np.load(os.path.join(shard_path, SHARD_BBOXES))
+        self.offsets = np.load(os.path.join(shard_path, SHARD_OFFSETS))
+        letterboxes_path = os.path.join(shard_path, SHARD_LETTERBOXES)
+        self.letterboxes = np.load(letterboxes_path) if os.path.exists(letterboxes_path) else None  # Older shards
+
+        super(ShardDataset, self).__init__(images_path=shard_path, labels_path=None, input_size=self.meta['input_size'],
+                                           transform=transform, multiscale=multiscale, balance_classes=balance_classes,
+                                           class_names=class_names, single_channel=self.meta['single_channel'])
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.shard_path, SHARD_IMAGES), dtype=np.uint8, mode='r',
+                                     shape=tuple(self.meta['shape']))
+        return self._images
+
+    def __getstate__(self):
+        # Do not pickle the memory map (workers open their own)
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def list_files(self, images_path, labels_path):
+        img_files = self.meta['img_files']
+        return img_files, [None] * len(img_files)
+
+    def load_sample(self, index, shape=None):
+        # Shards are letterboxed offline (square input_size), so rectangular batches are not supported
+        if shape is not None and tuple(shape) != tuple(self.meta['shape'][1:3]):
+            raise ValueError("Shards are letterboxed to {}: cannot load a {} batch (AspectRatioBatchSampler)".format(
+                tuple(self.meta['shape'][1:3]), tuple(shape)))
+        index = index % len(self.img_files)
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        img = self.images[index]  # Already in its default format
+        bboxes_labels = torch.from_numpy(self.labels[start:end])
+        bboxes_albu = self.bboxes[start:end].tolist()
+        if self.letterboxes is not None:
+            img_letterbox = torch.from_numpy(self.letterboxes[index])
+        else:
+            img_letterbox = letterbox_record(img.shape[:2], img.shape[:2])  # Unknown => identity
+        return self.img_files[index], img, bboxes_labels, bboxes_albu, img_letterbox
+
+
+def pack_dataset(dataset, shard_path):
+    """
+    Writes the letterboxed pages (uint8) and the bboxes of a ListDataset into a shard (see ShardDataset).
+    Images without bboxes are skipped, as ListDataset ignores them
+    """
+    os.makedirs(shard_path, exist_ok=True)
+
+    img_files, labels, bboxes, offsets, letterboxes = [], [], [], [0], []
+    img_shape = None
+    with open(os.path.join(shard_path, SHARD_IMAGES), 'wb') as f:
+        for i in tqdm.tqdm(range(len(dataset)), desc="Packing {}".format(shard_path)):
+            img_path, img, bboxes_labels, bboxes_albu, img_letterbox = dataset.load_sample(i)
+            if img is None or len(bboxes_albu) == 0:
+                continue
+
+            # All pages share the same letterbox
+            if img_shape is None:
+                img_shape = img.shape
+            assert img.shape == img_shape
+
+            f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+            img_files.append(img_path)
+            labels.append(bboxes_labels.numpy().astype(np.float32))
+            bboxes.append(np.array([bbox[:4] for bbox in bboxes_albu], dtype=np.float32))
+            offsets.append(offsets[-1] + len(bboxes_albu))
+            letterboxes.append(img_letterbox.numpy())
+
+    np.save(os.path.join(shard_path, SHARD_LABELS), np.concatenate(labels) if labels else np.zeros(0, np.float32))
+    np.save(os.path.join(shard_path, SHARD_BBOXES), np.concatenate(bboxes) if bboxes else np.zeros((0, 4), np.float32))
+    np.save(os.path.join(shard_path, SHARD_OFFSETS), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(shard_path, SHARD_LETTERBOXES), np.array(letterboxes, dtype=np.float32).reshape(-1, 6))
+
+    meta = {'input_size': dataset.base_input_size,
+            'single_channel': dataset.single_channel,
+            'shape': [len(img_files)] + list(img_shape or []),
+            'img_files': img_files}
+    with open(os.path.join(shard_path, SHARD_META), 'w') as f:
+        json.dump(meta, f)
+    return len(img_files)
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batch sampler that groups images with similar aspect ratio. Each batch is letterboxed to the smallest
+    stride-multiple rectangle that fits its images (at 'input_size'), instead of to a square with gray padding.
+
+    Yields lists of (index, (height, width)), which ListDataset understands as index.
+    """
+    def __init__(self, dataset, batch_size, indices=None, shuffle=True, stride=32, drop_last=False):
+        self.batch_size = batch_size
+        self.indices = list(range(len(dataset))) if indices is None else list(indices)
+        self.shuffle = shuffle
+        self.stride = stride
+        self.drop_last = drop_last
+
+        # Letterboxed size of each image (from the manifest, or reading the image headers)
+        input_size = getattr(dataset, 'base_input_size', dataset.input_size)
+        manifest = getattr(dataset, 'manifest', None)
+        self.sizes = {}
+        for i in self.indices:
+            if manifest is not None:
+                j = i % len(manifest)
+                w, h = int(manifest.widths[j]), int(manifest.heights[j])
+            else:
+                w, h = image_size(dataset.img_files[i % len(dataset.img_files)])
+            scale = input_size / max(h, w)
+            self.sizes[i] = (min(int(round(h * scale)), input_size), min(int(round(w * scale)), input_size))
+
+    def batch_shape(self, batch):
+        max_h = max(self.sizes[i][0] for i in batch)
+        max_w = max(self.sizes[i][1] for i in batch)
+        return (int(math.ceil(max_h / self.stride) * self.stride),
+                int(math.ceil(max_w / self.stride) * self.stride))
+
+    def __iter__(self):
+        indices = list(self.indices)
+        if self.shuffle:
+            random.shuffle(indices)  # Random order among images with the same aspect ratio
+
+        # Sort by aspect ratio and split into batches
+        indices.sort(key=lambda i: self.sizes[i][0] / self.sizes[i][1])
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            random.shuffle(batches)
+
+        for batch in batches:
+            shape = self.batch_shape(batch)
+            yield [(i, shape) for i in batch]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return int(math.ceil(len(self.indices) / self.batch_size))
+
+
+def letterbox(img, shape, value=128):
+    """
+    Resizes the image to fit into a (height, width) shape keeping its aspect ratio, and pads it (centered).
+    For square shapes it is the same as LongestMaxSize(INTER_AREA) + PadIfNeeded(BORDER_CONSTANT)
+    """
+    h, w = img.shape[:2]
+    scale = min(shape[0] / h, shape[1] / w)
+    new_h, new_w = min(int(round(h * scale)), shape[0]), min(int(round(w * scale)), shape[1])
+    if (new_h, new_w) != (h, w):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    # Pad
+    top, left = (shape[0] - new_h) // 2, (shape[1] - new_w) // 2
+    bottom, right = shape[0] - new_h - top, shape[1] - new_w - left
+    return cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(value, value, value))
+
+
+def input_shape(input_size):
+    # int => square (size, size); (height, width) => rectangular
+    return tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+
+
 class ImageFolder(Dataset):
-    def __init__(self, images_path, input_size, transform=None):
+    def __init__(self, images_path, input_size, transform=None, manifest=None, single_channel=False,
+                 reduced_decode=True):
+        """
+        input_size: int (square) or (height, width). Both must be multiples of the network stride (32)
+        manifest: path to a Manifest of the folder (its files are used instead of listing the folder)
+        single_channel: 1-channel tensors (pages decoded as L), for models with 'channels=1'
+        reduced_decode: large JPEGs are decoded at a reduced scale (see load_image_reduced)
+        """
         self.images = []
         self.input_size = input_size
+        self.input_shape = input_shape(input_size)
         self.transform = transform
+        self.single_channel = single_channel
+        self.reduced_decode = reduced_decode
+        self.manifest = Manifest(manifest) if manifest else None
 
-        # Data format
-        self.data_format = A.Compose([
-            A.LongestMaxSize(max_size=self.input_size, interpolation=cv2.INTER_AREA),
-            A.PadIfNeeded(min_height=self.input_size, min_width=self.input_size, border_mode=cv2.BORDER_CONSTANT,
-                          value=(128, 128, 128))
-        ], p=1)
-
-        # Get images
-        for file in os.listdir(images_path):
-            self.images.append(os.path.join(images_path, file))
+        # Get images (sorted, so the order is the same in every process/run)
+        if self.manifest is not None:
+            self.images, _ = self.manifest.files(images_path)
+        else:
+            self.images = list_images(images_path)
 
     def __getitem__(self, index):
         # For debugging
@@ -530,50 +1128,47 @@ class ImageFolder(Dataset):
         # index = 174
         image_path = self.images[index % len(self.images)]
 
-        # Load image as RGB
-        img = np.asarray(Image.open(image_path).convert('RGB'))  # L
+        # Load image (RGB or L)
+        if self.reduced_decode:
+            img, original_shape = load_image_reduced(image_path, self.input_shape, single_channel=self.single_channel)
+        else:
+            img = load_image(image_path, single_channel=self.single_channel)
+            original_shape = img.shape[:2]
 
         # Default image format
-        img = self.data_format(image=img)
-        img = img['image']
+        img_letterbox = letterbox_record(original_shape, self.input_shape)
+        img = letterbox(img, self.input_shape)
 
         if self.transform:
             # Perform augmentation
             augmented_data = self.transform(image=img)
             img = augmented_data['image']
 
-        # Convert image (PIL/Numpy) to PyTorch Tensor
-        img = transforms.ToTensor()(img)
-        return image_path, img
+        # Convert image (Numpy) to PyTorch Tensor (uint8)
+        img = image_to_tensor(img)
+        return image_path, img, img_letterbox
 
     def __len__(self):
         return len(self.images)
 
 
 class SingleImage:
-    def __init__(self, input_size, transform=None):
+    def __init__(self, input_size, transform=None, single_channel=False):
         self.images = []
         self.input_size = input_size
+        self.input_shape = input_shape(input_size)
         self.transform = transform
-
-        # Data format
-        self.data_format = A.Compose([
-            # A.ToGray(p=1.0),
-            A.LongestMaxSize(max_size=self.input_size[0], interpolation=cv2.INTER_AREA),
-            A.PadIfNeeded(min_height=self.input_size[0], min_width=self.input_size[1], border_mode=cv2.BORDER_CONSTANT,
-                          value=(128, 128, 128)),
-        ], p=1)
-
+        self.single_channel = single_channel
 
     def apply_transform(self, img_path):
-        # Load image as RGB
-        img = np.asarray(Image.open(img_path).convert('RGB'))  # L
+        # Load image (RGB or L)
+        img = load_image(img_path, single_channel=self.single_channel)
 
         # Default image format
-        img = self.data_format(image=img)
-        img = img['image']
+        img_letterbox = letterbox_record(img.shape, self.input_shape)
+        img = letterbox(img, self.input_shape)
 
-        # Convert image (PIL/Numpy) to PyTorch Tensor
-        img = transforms.ToTensor()(img)
+        # Convert image (Numpy) to PyTorch Tensor (uint8)
+        img = image_to_tensor(img)
 
-        return img
+        return img, img_letterbox
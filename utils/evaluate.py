@@ -2,7 +2,7 @@ import os
 import sys
 import torch
 from models.ssd.utils import find_jaccard_overlap
-from utils.utils import img2img, rescale_boxes, plot_bboxes
+from utils.utils import img2img, rescale_boxes, plot_bboxes, plot_bboxes_batch
 
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, BASE_PATH)
@@ -187,6 +187,22 @@ def get_stats(confusion_matrix):
     return metrics
 
 
+def compare_stats(stats, new_stats, class_names=None):
+    """
+    Compares two results of get_stats (eg. float vs. quantized model).
+
+    :return: table rows [metric, before, after, diff.] (mAP, recall, precision, f1 and the AP of each class)
+    """
+    rows = [["Metric", "Before", "After", "Diff."]]
+    for k in ['mAP', 'recall', 'precision', 'f1']:
+        rows.append([k, "%.5f" % stats[k], "%.5f" % new_stats[k], "%+.5f" % (new_stats[k] - stats[k])])
+    for c in sorted(stats['classes'].keys()):
+        name = class_names[c] if class_names and c < len(class_names) else c
+        ap, new_ap = stats['classes'][c]['AP'], new_stats['classes'].get(c, {'AP': 0.0})['AP']
+        rows.append(["AP ({})".format(name), "%.5f" % ap, "%.5f" % new_ap, "%+.5f" % (new_ap - ap)])
+    return rows
+
+
 def ignore_bg(labels, remove_bg=False):
     new_labels = []
     for i in range(len(labels)):
@@ -251,38 +267,25 @@ def compute_hoeim(pred_class, pred_iou, true_class):
     return analysis
 
 
-def plot_predictions(image_paths, images, det_boxes, det_labels, det_scores, true_boxes, true_labels, class_names):
+def plot_predictions(image_paths, images, det_boxes, det_labels, det_scores, true_boxes, true_labels, class_names,
+                     num_workers=4):
     assert len(det_boxes) == len(det_labels) == len(det_scores) == len(true_boxes) == len(true_labels)
 
+    output_path = BASE_PATH + "/outputs"
+    if not os.path.exists(output_path):
+        os.mkdir(output_path)
+
+    # One render per page (REL(xyxy) boxes on the input image), in a worker pool
+    jobs = []
     for i in range(len(image_paths)):
-        use_original = False
-        output_path = BASE_PATH + "/outputs"
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-        save_path = "{}/{}".format(output_path, image_paths[i].split('/')[-1])
-
-        # Output
-        p_bboxes = det_boxes[i].cpu().data.numpy()
-        p_labels = det_labels[i].cpu().data.numpy()
-        t_bboxes = true_boxes[i].cpu().data.numpy()
-        t_labels = true_labels[i].cpu().data.numpy()
-
-        if use_original:
-            input_img = img2img(image_paths[i])
-
-            # Rescale boxes
-            p_bboxes = rescale_boxes(p_bboxes, current_shape=input_img.shape[:2], original_shape=input_img.shape[:2],
-                                     relxyxy=True)
-            t_bboxes = rescale_boxes(t_bboxes, current_shape=input_img.shape[:2], original_shape=input_img.shape[:2],
-                                     relxyxy=True)
-
-            plot_bboxes(use_original, p_bboxes, class_ids=p_labels, class_names=class_names, show_results=False,
-                        coords_rel=False,
-                        t_bboxes=t_bboxes, title="Detection + ground truth ({})".format(image_paths[i]),
-                        save_path=save_path)
-        else:
-            input_img = img2img(images[i])
-            plot_bboxes(input_img, p_bboxes, class_ids=p_labels, class_names=class_names, show_results=False,
-                        coords_rel=True,
-                        t_bboxes=t_bboxes, title="Detection + ground truth ({})".format(image_paths[i]),
-                        save_path=save_path)
+        jobs.append({
+            'img': img2img(images[i]),
+            'bboxes': det_boxes[i].cpu().data.numpy(),
+            'class_ids': det_labels[i].cpu().data.numpy(),
+            'class_names': class_names,
+            't_bboxes': true_boxes[i].cpu().data.numpy(),
+            'coords_rel': True,
+            'title': "Detection + ground truth ({})".format(image_paths[i]),
+            'save_path': "{}/{}".format(output_path, image_paths[i].split('/')[-1]),
+        })
+    plot_bboxes_batch(jobs, num_workers=num_workers)
@@ -0,0 +1,163 @@
+import os
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# Header of the segment (int64): clock hand, hits, misses, insertions
+_HAND, _HITS, _MISSES, _INSERTS = range(4)
+_HEADER_SIZE = 4
+
+
+def attach_segment(name):
+    """
+    Attaches to an existing shared memory segment without registering it with the resource tracker of this process.
+    Otherwise (Python < 3.13) the tracker of a worker would unlink the segment when the worker exits, under the
+    process that created it and the other workers
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python >= 3.13
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class PageCache(object):
+    """
+    Cache of decoded pages in their default format (letterboxed uint8 arrays) in POSIX shared memory, shared by
+    the DataLoader workers: any worker can fill it or hit it, and the pages survive between epochs.
+
+    The budget is split into fixed slots of 'max_shape' (the largest page, eg. (input_size, input_size) or
+    (input_size, input_size, 3)); smaller pages (rectangular batches) fit into a slot. When it is full, a slot
+    is freed with the clock algorithm (second chance: pages hit since the last sweep are kept).
+    Each page keeps its letterbox record (see utils.datasets.letterbox_record), so hits need no decoding at all.
+
+    Create it in the main process (before the workers start) and pass it to the datasets. Call close() at the end.
+    'context' is the multiprocessing context of the workers (eg. the DataLoader multiprocessing_context), if it is
+    not the default one
+    """
+
+    def __init__(self, budget_bytes, max_shape, name=None, context=None):
+        self.max_shape = tuple(max_shape)
+        self.slot_bytes = int(np.prod(self.max_shape))
+        self.num_slots = int(budget_bytes) // self.slot_bytes
+        if self.num_slots < 1:
+            raise ValueError("Page cache budget ({} bytes) is smaller than one page of {} ({} bytes)".format(
+                int(budget_bytes), self.max_shape, self.slot_bytes))
+        self.lock = (context or multiprocessing).Lock()
+        self.owner_pid = os.getpid()
+
+        size = self._offsets()[-1]
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._attach()
+        self.header[:] = 0
+        self.keys[:] = -1  # Empty slot
+        self.refs[:] = 0
+
+    def _offsets(self):
+        n = self.num_slots
+        sizes = [8 * _HEADER_SIZE, 8 * n, n, 4 * 3 * n, 4 * 6 * n, n * self.slot_bytes]
+        sizes = [(s + 63) // 64 * 64 for s in sizes]  # Aligned arrays
+        return np.cumsum([0] + sizes).tolist()
+
+    def _attach(self):
+        n, buf = self.num_slots, self.shm.buf
+        offsets = self._offsets()
+        self.header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=buf, offset=offsets[0])
+        self.keys = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=offsets[1])
+        self.refs = np.ndarray((n,), dtype=np.uint8, buffer=buf, offset=offsets[2])
+        self.shapes = np.ndarray((n, 3), dtype=np.int32, buffer=buf, offset=offsets[3])  # h, w, channels (0: 2D)
+        self.letterboxes = np.ndarray((n, 6), dtype=np.float32, buffer=buf, offset=offsets[4])
+        self.data = np.ndarray((n, self.slot_bytes), dtype=np.uint8, buffer=buf, offset=offsets[5])
+
+    def __getstate__(self):
+        # Workers (spawn) attach to the same segment by name
+        state = self.__dict__.copy()
+        for k in ['shm', 'header', 'keys', 'refs', 'shapes', 'letterboxes', 'data']:
+            del state[k]
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = attach_segment(shm_name)  # Only the creating process unlinks it (see close)
+        self._attach()
+
+    @staticmethod
+    def make_key(index, shape):
+        # (index, (height, width)) => int64
+        return (int(index) << 32) | (int(shape[0]) << 16) | int(shape[1])
+
+    def _find(self, key):
+        slots = np.flatnonzero(self.keys == key)
+        return int(slots[0]) if len(slots) else None
+
+    def get(self, index, shape):
+        """Page and letterbox record of (index, shape), or None (miss)"""
+        key = self.make_key(index, shape)
+        with self.lock:
+            slot = self._find(key)
+            if slot is None:
+                self.header[_MISSES] += 1
+                return None
+            self.header[_HITS] += 1
+            self.refs[slot] = 1
+            h, w, c = self.shapes[slot].tolist()
+            page_shape = (h, w, c) if c else (h, w)
+            img = self.data[slot, :int(np.prod(page_shape))].reshape(page_shape).copy()
+            letterbox = self.letterboxes[slot].copy()
+        return img, letterbox
+
+    def put(self, index, shape, img, letterbox):
+        """Adds a page (uint8 array no larger than 'max_shape'), evicting another one if needed"""
+        if img.size > self.slot_bytes:
+            return False
+        key = self.make_key(index, shape)
+        with self.lock:
+            if self._find(key) is not None:
+                return True  # Added by another worker
+
+            # Clock: skip (and clear) the pages used since the last sweep
+            hand = int(self.header[_HAND])
+            while self.keys[hand] != -1 and self.refs[hand]:
+                self.refs[hand] = 0
+                hand = (hand + 1) % self.num_slots
+            self.header[_HAND] = (hand + 1) % self.num_slots
+
+            self.keys[hand] = key
+            self.refs[hand] = 0
+            self.shapes[hand] = (img.shape[0], img.shape[1], img.shape[2] if img.ndim == 3 else 0)
+            self.letterboxes[hand] = np.asarray(letterbox, dtype=np.float32)
+            self.data[hand, :img.size] = img.reshape(-1)
+            self.header[_INSERTS] += 1
+        return True
+
+    def stats(self):
+        with self.lock:
+            hits, misses, inserts = [int(x) for x in self.header[[_HITS, _MISSES, _INSERTS]]]
+            valid = self.keys != -1
+            pages = int(valid.sum())
+            used_bytes = int(self.shapes[valid, 0].astype(np.int64).dot(
+                self.shapes[valid, 1] * np.maximum(self.shapes[valid, 2], 1)))
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / lookups if lookups else 0.0,
+                'pages': pages, 'slots': self.num_slots, 'evictions': max(0, inserts - pages),
+                'used_bytes': used_bytes, 'budget_bytes': self.num_slots * self.slot_bytes}
+
+    def report(self):
+        stats = self.stats()
+        return "Page cache: {:.1%} hit rate ({} hits, {} misses), {}/{} pages, {} evictions, {:.1f}/{:.1f} MB".format(
+            stats['hit_rate'], stats['hits'], stats['misses'], stats['pages'], stats['slots'], stats['evictions'],
+            stats['used_bytes'] / 2 ** 20, stats['budget_bytes'] / 2 ** 20)
+
+    def close(self):
+        self.header = self.keys = self.refs = self.shapes = self.letterboxes = self.data = None  # Views first
+        self.shm.close()
+        if os.getpid() == self.owner_pid:
+            self.shm.unlink()  # Freed when the last process detaches
@@ -0,0 +1,123 @@
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()  # End of the stream
+
+
+class StageStats(object):
+    """Time spent by a stage in its own work (waits for the previous/next stage excluded)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def add(self, elapsed, items=1):
+        with self.lock:
+            self.busy += elapsed
+            self.items += items
+
+    def __str__(self):
+        ms_item = 1000.0 * self.busy / self.items if self.items else 0.0
+        return "{}: {:.2f}s busy, {} items, {:.1f} ms/item".format(self.name, self.busy, self.items, ms_item)
+
+
+class Pipeline(object):
+    """
+    Staged pipeline with bounded queues:
+        loader (iterable, eg. a DataLoader with workers) => model (calling thread) => post-process (thread pool)
+        => writer (thread)
+    Every stage runs at the same time as the others, so the throughput is the one of the slowest stage
+    (ideally the forward pass). A full queue blocks the previous stage instead of piling up batches.
+    Batches reach the writer in order.
+    """
+
+    def __init__(self, loader, model_fn, post_fn, write_fn, num_post_workers=2, queue_size=4):
+        self.loader = loader
+        self.model_fn = model_fn  # batch => model outputs
+        self.post_fn = post_fn  # (batch, outputs) => results
+        self.write_fn = write_fn  # results => None
+        self.num_post_workers = num_post_workers
+        self.queue_size = queue_size
+        self.stats = [StageStats(name) for name in ["loader", "model", "post-process", "writer"]]
+        self.total_time = 0.0
+        self.errors = []
+
+    def _timed(self, stats, fn, *args):
+        start_time = time.time()
+        result = fn(*args)
+        stats.add(time.time() - start_time)
+        return result
+
+    def _load(self, batches):
+        loader_stats = self.stats[0]
+        try:
+            iterator = iter(self.loader)
+            while True:
+                start_time = time.time()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                loader_stats.add(time.time() - start_time)
+                batches.put(batch)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            batches.put(_DONE)
+
+    def _write(self, results):
+        writer_stats = self.stats[3]
+        while True:
+            future = results.get()
+            if future is _DONE:
+                break
+            if self.errors:
+                continue  # Keep draining, so the model stage does not block
+            try:
+                self._timed(writer_stats, self.write_fn, future.result())
+            except Exception as e:
+                self.errors.append(e)
+
+    def run(self):
+        batches = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+        model_stats, post_stats = self.stats[1], self.stats[2]
+
+        start_time = time.time()
+        loader_thread = threading.Thread(target=self._load, args=(batches,), daemon=True)
+        writer_thread = threading.Thread(target=self._write, args=(results,), daemon=True)
+        loader_thread.start()
+        writer_thread.start()
+
+        with ThreadPoolExecutor(max_workers=self.num_post_workers) as executor:
+            while True:
+                batch = batches.get()
+                if batch is _DONE:
+                    break
+                if self.errors:
+                    continue  # Keep draining, so the loader does not block
+                try:
+                    outputs = self._timed(model_stats, self.model_fn, batch)
+                except Exception as e:
+                    self.errors.append(e)
+                    continue
+                results.put(executor.submit(self._timed, post_stats, self.post_fn, batch, outputs))
+            results.put(_DONE)
+            writer_thread.join()
+        loader_thread.join()
+        self.total_time = time.time() - start_time
+
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
+
+    def report(self):
+        items = self.stats[1].items
+        lines = ["\t+ {}".format(stats) for stats in self.stats]
+        lines.append("\t+ Total: {:.2f}s, {} items, {:.2f} items/s".format(
+            self.total_time, items, items / self.total_time if self.total_time else 0.0))
+        return "\n".join(lines)
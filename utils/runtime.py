@@ -0,0 +1,140 @@
+import numpy as np
+import torch
+
+
+class TorchBackend(object):
+    """
+    Runs a PyTorch model (Darknet, CompiledDarknet, SSD300...) for inference.
+    Same interface as ONNXBackend: backend(images) => the model outputs, on the CPU
+    """
+
+    def __init__(self, model, device=None, input_channels=None):
+        self.model = model.eval()
+        self.device = device if device is not None else next(model.parameters()).device
+        self.input_channels = input_channels if input_channels is not None else model_input_channels(model)
+
+    def __call__(self, images):
+        with torch.no_grad():
+            outputs = self.model(images.to(self.device))
+        if isinstance(outputs, tuple):
+            return tuple(output.detach().cpu() for output in outputs)
+        return outputs.detach().cpu()
+
+    def __getattr__(self, name):
+        # Model helpers (eg. SSD300.detect_objects)
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def eval(self):
+        return self
+
+
+class ONNXBackend(object):
+    """
+    Runs an exported graph (export_darknet or export_ssd) with ONNX Runtime, on the CPU.
+    The outputs are returned as torch tensors, so the post-processing (NMS, detect_objects...) is the same.
+    The forward pass does not run in PyTorch, but the data loading and post-processing still need torch (a CPU
+    build is enough)
+    """
+
+    def __init__(self, onnx_path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_channels = self.session.get_inputs()[0].shape[1]  # Static (only batch/height/width are dynamic)
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+        # SSD graphs also export their priors (constant), needed to decode the locations
+        self.priors_cxcy, self.n_classes = None, None
+        if "priors" in self.output_names:
+            self.output_names.remove("priors")
+            _, channels, height, width = self.session.get_inputs()[0].shape  # Batch is dynamic (a string)
+            if not all(isinstance(dim, int) for dim in (channels, height, width)):
+                raise ValueError("SSD graph with dynamic input size {} (priors need a fixed one)".format(
+                    self.session.get_inputs()[0].shape))
+            dummy = np.zeros((1, channels, height, width), dtype=np.float32)
+            self.priors_cxcy = torch.from_numpy(self.session.run(["priors"], {self.input_name: dummy})[0])
+            self.n_classes = self.session.get_outputs()[1].shape[-1]
+
+    def __call__(self, images):
+        images = images.detach().cpu().numpy().astype(np.float32, copy=False)
+        outputs = self.session.run(self.output_names, {self.input_name: images})
+        outputs = tuple(torch.from_numpy(output) for output in outputs)
+        return outputs if len(outputs) > 1 else outputs[0]
+
+    def detect_objects(self, *args, **kwargs):
+        from models.ssd.model import SSD300
+        return SSD300.detect_objects(self, *args, **kwargs)
+
+    def eval(self):
+        return self
+
+
+def model_input_channels(model):
+    """Input channels of a PyTorch model (those of its first convolution), None if unknown (eg. quantized)"""
+    for param in model.parameters():
+        if param.dim() == 4:
+            return param.size(1)
+    return None
+
+
+def is_backend_path(path):
+    """Exported graph (*.onnx) or TorchScript model (*.jit, eg. quantized), loaded with load_backend"""
+    return bool(path) and path.endswith((".onnx", ".jit"))
+
+
+def load_backend(path, model=None, num_threads=None):
+    """
+    Exported graph (*.onnx) => ONNXBackend; TorchScript model (*.jit) => TorchBackend on the CPU;
+    otherwise the given (already loaded) model => TorchBackend
+    """
+    if path and path.endswith(".onnx"):
+        return ONNXBackend(path, num_threads=num_threads)
+    elif path and path.endswith(".jit"):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        extra_files = {"input_channels": ""}  # Saved by the quantize scripts
+        model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        input_channels = int(extra_files["input_channels"]) if extra_files["input_channels"] else None
+        return TorchBackend(model, device=torch.device("cpu"), input_channels=input_channels)
+    return TorchBackend(model)
+
+
+def synthetic_pages(batch_size, channels, height, width, seed=0):
+    """Random pages in [0, 1]: white background with dark blocks (lines of text, formulas...)"""
+    rng = np.random.RandomState(seed)
+    pages = np.ones((batch_size, channels, height, width), dtype=np.float32)
+    for page in pages:
+        for _ in range(rng.randint(5, 20)):
+            h, w = rng.randint(4, max(5, height // 20)), rng.randint(8, max(9, width // 2))
+            y, x = rng.randint(0, height - h), rng.randint(0, width - w)
+            page[:, y:y + h, x:x + w] = rng.uniform(0.0, 0.4)
+    return torch.from_numpy(pages)
+
+
+def check_parity(model, backend, input_size, batch_size=2, channels=3, atol=1e-3):
+    """
+    Compares the outputs of a PyTorch model and a backend on synthetic pages.
+    Returns the max. absolute difference of each output (raises an AssertionError above 'atol')
+    """
+    height, width = input_size if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+    images = synthetic_pages(batch_size, channels, height, width)
+
+    expected = TorchBackend(model)(images)
+    outputs = backend(images)
+    expected = expected if isinstance(expected, tuple) else (expected,)
+    outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+    assert len(expected) == len(outputs), "Different number of outputs ({} vs. {})".format(len(expected), len(outputs))
+
+    diffs = []
+    for expected_i, output_i in zip(expected, outputs):
+        assert expected_i.shape == output_i.shape, "Different shapes ({} vs. {})".format(expected_i.shape, output_i.shape)
+        diffs.append((expected_i - output_i).abs().max().item())
+    assert max(diffs) <= atol, "Outputs differ: max. abs. diffs {} (atol={})".format(diffs, atol)
+    return diffs
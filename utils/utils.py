@@ -1,5 +1,6 @@
 import random
 import json
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 import cv2
 import os
@@ -20,6 +21,7 @@ import matplotlib.patches as patches
 from matplotlib.ticker import NullLocator
 
 from albumentations.augmentations.bbox_utils import convert_bboxes_to_albumentations, convert_bboxes_from_albumentations
+from utils.bitpages import save_page
 
 
 def load_dataset(filename):
@@ -93,6 +95,40 @@ def save_image(image, filename, use_cv=False):
         cv2.imwrite(filename, image)
 
 
+IMAGE_ENCODERS = {
+    # Extension => cv2 params (quality / compression level); much faster than optimized progressive JPEGs
+    '.jpg': lambda quality: [cv2.IMWRITE_JPEG_QUALITY, quality or 95],
+    '.jpeg': lambda quality: [cv2.IMWRITE_JPEG_QUALITY, quality or 95],
+    '.png': lambda quality: [cv2.IMWRITE_PNG_COMPRESSION, 1 if quality is None else quality],
+    '.webp': lambda quality: [cv2.IMWRITE_WEBP_QUALITY, quality or 95],
+}
+
+
+def write_image(image, filename, quality=None, bits=1):
+    """
+    Writes a BGR (cv2) image by its extension (any case): *.jpg/*.jpeg, *.png (level 1), *.webp, *.npy (raw RGB
+    array) or *.bits (grayscale packed to 'bits' bits per pixel, see utils.bitpages).
+    The file is written under a temporary name (filename.tmp, which no image listing matches) and renamed,
+    so a partial file is never left behind
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    tmp_filename = filename + '.tmp'
+    if ext == '.bits':
+        save_page(tmp_filename, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image, bits=bits)
+    elif ext == '.npy':
+        with open(tmp_filename, 'wb') as f:  # np.save would add '.npy' to other names
+            np.save(f, cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image)
+    elif ext in IMAGE_ENCODERS:
+        ok, buffer = cv2.imencode(ext, image, IMAGE_ENCODERS[ext](quality))  # Format from 'ext', not the tmp name
+        if not ok:
+            raise IOError("Image could not be written: {}".format(filename))
+        with open(tmp_filename, 'wb') as f:
+            f.write(buffer.tobytes())
+    else:
+        raise ValueError("Unknown image format: {}".format(filename))
+    os.replace(tmp_filename, filename)
+
+
 def crop_images(filename, bboxes, base_path='', image_id='', categories=None):
     # TODO: DELETE
     print("Croping image #{} => {}...".format(image_id, filename))
@@ -115,18 +151,28 @@ def crop_images(filename, bboxes, base_path='', image_id='', categories=None):
         cv2.imwrite(filename2, crop)
 
 
+def letterbox_coords(ori_w, ori_h, inp_dim, padding=True):
+    """
+    Geometry of letterbox_image, without the image (eg. from the image header):
+    (x1, y1, new_w, new_h, ori_w, ori_h)
+    """
+    max_w, max_h = inp_dim
+    min_ar = min(max_w / ori_w, max_h / ori_h)
+    new_w = min(int(ori_w * min_ar) + 1, max_w)
+    new_h = min(int(ori_h * min_ar) + 1, max_h)
+    x1, y1 = ((max_w - new_w) // 2, (max_h - new_h) // 2) if padding else (0, 0)
+    return x1, y1, new_w, new_h, ori_w, ori_h
+
+
 def letterbox_image(img, inp_dim, padding=True):
     # TODO: DELETE
     """
     resize image with unchanged aspect ratio using padding
     """
-    ori_w, ori_h = img.shape[1], img.shape[0]
-    max_w, max_h = inp_dim
+    coords = letterbox_coords(img.shape[1], img.shape[0], inp_dim, padding=padding)
+    x1, y1, new_w, new_h = coords[:4]
 
     # Resize image
-    min_ar = min(max_w / ori_w, max_h / ori_h)
-    new_w = min(int(ori_w * min_ar) + 1, max_w)
-    new_h = min(int(ori_h * min_ar) + 1, max_h)
     resized_image = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
 
     if padding:
@@ -134,14 +180,11 @@ def letterbox_image(img, inp_dim, padding=True):
         canvas = np.full((inp_dim[1], inp_dim[0], 3), 128, dtype=np.uint8)
 
         # Paste image
-        y1 = (max_h - new_h) // 2
-        x1 = (max_w - new_w) // 2
         canvas[y1:y1 + new_h, x1:x1 + new_w, :] = resized_image
     else:
-        x1, y1 = 0, 0
         canvas = resized_image
 
-    return canvas, (x1, y1, new_w, new_h, ori_w, ori_h)
+    return canvas, coords
 
 
 def resize_bboxes(bboxes, coords):
@@ -296,39 +339,166 @@ def keep_max_class(image_predictions):
     return max_class_predictions
 
 
+def box_iou_matrix(boxes1, boxes2):
+    """
+    Pairwise IoU between two sets of ABS(xyxy) boxes => (len(boxes1), len(boxes2))
+    Uses the same (+1 pixel) convention as bbox_iou
+    """
+    inter_x1 = torch.max(boxes1[:, None, 0], boxes2[None, :, 0])
+    inter_y1 = torch.max(boxes1[:, None, 1], boxes2[None, :, 1])
+    inter_x2 = torch.min(boxes1[:, None, 2], boxes2[None, :, 2])
+    inter_y2 = torch.min(boxes1[:, None, 3], boxes2[None, :, 3])
+    inter_area = (inter_x2 - inter_x1 + 1).clamp(min=0) * (inter_y2 - inter_y1 + 1).clamp(min=0)
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0] + 1) * (boxes1[:, 3] - boxes1[:, 1] + 1)
+    area2 = (boxes2[:, 2] - boxes2[:, 0] + 1) * (boxes2[:, 3] - boxes2[:, 1] + 1)
+    return inter_area / (area1[:, None] + area2[None, :] - inter_area + 1e-16)
+
+
+def greedy_suppression(overlap, alive):
+    """
+    Sequential greedy NMS => kept mask, given the overlap matrix of boxes sorted by score (upper triangular:
+    overlap[i, j] => i suppresses j if kept) and the boxes that are not suppressed yet.
+    One row operation per kept box, so its cost does not depend on how long the chains of overlapping boxes are
+    """
+    overlap = overlap.cpu().numpy()
+    keep = alive.cpu().numpy().copy()
+    for i in np.flatnonzero(keep):
+        if keep[i]:  # Final: only higher-scored boxes can suppress it
+            keep &= ~overlap[i]
+    return torch.from_numpy(keep).to(alive.device)
+
+
+def nms_groups(boxes, scores, groups, nms_thres=0.5, block_size=2048, iou_fn=box_iou_matrix, max_passes=8):
+    """
+    Greedy NMS over several independent groups (eg. image*num_classes + class) in a single pass.
+
+    Boxes of different groups are shifted apart (class-offset trick) so they never overlap, and the
+    suppression is solved with IoU matrices over blocks of 'block_size' boxes, so memory stays bounded.
+    'iou_fn' computes the pairwise IoU matrix (eg. find_jaccard_overlap for REL(xyxy) boxes).
+    Each block is solved with up to 'max_passes' vectorized passes, then with greedy_suppression if it has not
+    converged (eg. long chains of overlapping boxes on dense pages settle one box per pass)
+
+    Returns:
+        keep: indices of the kept boxes, by decreasing score
+        owner: for each box, the index of the kept box that suppressed it (itself if kept)
+    """
+    n = boxes.size(0)
+    device = boxes.device
+    if n == 0:
+        empty = torch.zeros(0, dtype=torch.long, device=device)
+        return empty, empty
+
+    # Sort by score and move each group to its own region
+    order = scores.argsort(descending=True)
+    offset = boxes.max() - boxes.min() + 2
+    s_boxes = boxes[order] + (groups[order].to(boxes.dtype) * offset).unsqueeze(1)
+
+    s_owner = torch.full((n,), -1, dtype=torch.long, device=device)
+    s_keep = torch.zeros(0, dtype=torch.long, device=device)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        blk_boxes = s_boxes[start:end]
+        blk_owner = s_owner[start:end]  # view
+
+        # Suppress by the boxes kept in the previous blocks (first match owns the box)
+        if s_keep.numel():
+            overlap = iou_fn(s_boxes[s_keep], blk_boxes) > nms_thres  # (n_kept, n_blk)
+            hit = overlap.any(0)
+            blk_owner[hit] = s_keep[overlap.int().argmax(0)[hit]]
+        alive = blk_owner < 0
+
+        # Greedy NMS inside the block: iterate 'keep = not suppressed by any higher-scored kept box'
+        # up to its fixed point, which is unique and equal to the sequential greedy result.
+        # Each pass is O(block²): fall back to the sequential greedy once the passes stop shrinking the changes
+        overlap = (iou_fn(blk_boxes, blk_boxes) > nms_thres).triu(diagonal=1)
+        blk_keep = alive.clone()
+        num_changes = end - start + 1
+        for _ in range(max_passes):
+            new_keep = alive & ~(overlap & blk_keep.unsqueeze(1)).any(0)
+            changes = int((new_keep ^ blk_keep).sum())
+            blk_keep = new_keep
+            if changes == 0:
+                break
+            if changes >= num_changes:
+                blk_keep = greedy_suppression(overlap, alive)
+                break
+            num_changes = changes
+        else:
+            blk_keep = greedy_suppression(overlap, alive)
+
+        # Suppressed boxes are owned by the first kept box that overlaps them
+        overlap = (overlap | torch.eye(end - start, dtype=torch.bool, device=device)) & blk_keep.unsqueeze(1)
+        first = overlap.int().argmax(0) + start
+        blk_owner[alive] = first[alive]
+        s_keep = torch.cat((s_keep, blk_keep.nonzero().view(-1) + start))
+
+    # Back to input indices
+    owner = torch.empty_like(s_owner)
+    owner[order] = order[s_owner]
+    return order[s_keep], owner
+
+
+def batched_non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, merge_boxes=True):
+    """
+    Confidence filtering + class-aware NMS for a whole batch of YOLO outputs in one call.
+
+    Expects the raw Darknet output: (batch, hypothesis, ABS(cxcywh) + obj_conf + class probs)
+    Returns a list with one tensor per image (empty if nothing is detected) with rows:
+        (x1, y1, x2, y2, obj_conf, class_conf, class_idx), sorted by obj_conf*class_conf
+    If 'merge_boxes', every kept box is the obj_conf-weighted average of the boxes it suppressed.
+    """
+    batch_size = prediction.size(0)
+    num_classes = prediction.size(2) - 5
+
+    # Filter out confidence scores below threshold (all images at once)
+    image_idxs, hyp_idxs = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+    hypothesis = prediction[image_idxs, hyp_idxs]
+
+    # Keep max class: (x1,y1,x2,y2, obj_conf) + class_conf + class_idx
+    class_confs, class_idxs = hypothesis[:, 5:].max(1)
+    boxes = cxcywh2xyxy(hypothesis[:, :4])
+    detections = torch.cat((boxes, hypothesis[:, 4:5], class_confs.unsqueeze(1), class_idxs.unsqueeze(1).float()), 1)
+
+    # One NMS group per (image, class)
+    keep, owner = nms_groups(boxes, hypothesis[:, 4] * class_confs, image_idxs * num_classes + class_idxs,
+                             nms_thres=nms_thres)
+
+    if merge_boxes and keep.numel():
+        # Merge overlapping bboxes (weighted average by object confidence)
+        weights = hypothesis[:, 4]
+        merged = torch.zeros_like(boxes).index_add_(0, owner, weights.unsqueeze(1) * boxes)
+        total_weights = torch.zeros_like(weights).index_add_(0, owner, weights)
+        detections[keep, :4] = merged[keep] / total_weights[keep].unsqueeze(1)
+
+    detections, image_idxs = detections[keep], image_idxs[keep]
+    return [detections[image_idxs == i] for i in range(batch_size)]
+
+
 def non_max_suppression(image_predictions, nms_thres=0.5):
     """
-    Requires predictions in xyxy format
+    Requires predictions in xyxy format (see keep_max_class)
+    Prefer batched_non_max_suppression, which also filters by confidence for the whole batch
     """
     output = []
-
-    for i, hypothesis in enumerate(image_predictions):
+    for hypothesis in image_predictions:
         # If none are remaining => process next image
         if not hypothesis.size(0):
             continue
 
-        keep_boxes = []
-        detections = hypothesis.clone()
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres  # Get bboxes that overlap by more than a threshold
-            label_match = detections[0, -1] == detections[:, -1]  # Get prediction of class == class_pred[0]
-
-            # Indices of boxes large IOUs and matching labels (same class)
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]  # Object confidence as weight
+        weights = hypothesis[:, 4]
+        keep, owner = nms_groups(hypothesis[:, :4], weights * hypothesis[:, 5], hypothesis[:, 6].long(),
+                                 nms_thres=nms_thres)
 
-            # Merge overlapping bboxes by order of confidence (weighted average)
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]  # remove invalid bboxes
-
-        if keep_boxes:
-            output.append(torch.stack(keep_boxes))
+        # Merge overlapping bboxes by order of confidence (weighted average)
+        detections = hypothesis.clone()
+        merged = torch.zeros_like(detections[:, :4]).index_add_(0, owner, weights.unsqueeze(1) * hypothesis[:, :4])
+        total_weights = torch.zeros_like(weights).index_add_(0, owner, weights)
+        detections[keep, :4] = merged[keep] / total_weights[keep].unsqueeze(1)
+        output.append(detections[keep])
     return output
 
 
-
-
 #############################################
 #############################################
 #############################################
@@ -359,8 +529,8 @@ def rescale_boxes(boxes, current_shape, original_shape, relxyxy=False):
     Expects boxes in ABS(xyxy)
     Return boxes in ABS(xyxy)
     """
-    orig_h, orig_w = original_shape
-    this_h, this_w = current_shape
+    orig_h, orig_w = original_shape[:2]
+    this_h, this_w = current_shape[:2]
 
     if relxyxy:
         boxes[:, 0] *= this_w
@@ -368,63 +538,54 @@ def rescale_boxes(boxes, current_shape, original_shape, relxyxy=False):
         boxes[:, 2] *= this_w
         boxes[:, 3] *= this_h
 
-    # The amount of padding that was added
-    pad_x = max(orig_h - orig_w, 0) * (this_w / max(original_shape))
-    pad_y = max(orig_w - orig_h, 0) * (this_h / max(original_shape))
-    # Image height and width after padding is removed
-    unpad_h = this_h - pad_y
-    unpad_w = this_w - pad_x
+    # Image height and width after padding is removed (letterbox, square or rectangular)
+    scale = min(this_h / orig_h, this_w / orig_w)
+    unpad_h = min(int(round(orig_h * scale)), this_h)
+    unpad_w = min(int(round(orig_w * scale)), this_w)
+    # The amount of padding that was added (top/left)
+    pad_x = (this_w - unpad_w) // 2
+    pad_y = (this_h - unpad_h) // 2
     # Rescale bounding boxes to dimension of original image
-    boxes[:, 0] = ((boxes[:, 0] - pad_x // 2) / unpad_w) * orig_w
-    boxes[:, 1] = ((boxes[:, 1] - pad_y // 2) / unpad_h) * orig_h
-    boxes[:, 2] = ((boxes[:, 2] - pad_x // 2) / unpad_w) * orig_w
-    boxes[:, 3] = ((boxes[:, 3] - pad_y // 2) / unpad_h) * orig_h
-
-
+    boxes[:, 0] = ((boxes[:, 0] - pad_x) / unpad_w) * orig_w
+    boxes[:, 1] = ((boxes[:, 1] - pad_y) / unpad_h) * orig_h
+    boxes[:, 2] = ((boxes[:, 2] - pad_x) / unpad_w) * orig_w
+    boxes[:, 3] = ((boxes[:, 3] - pad_y) / unpad_h) * orig_h
 
     return boxes
 
 
-def non_max_suppression2(prediction, conf_thres=0.5, nms_thres=0.4):
+def unletterbox_boxes(boxes, letterboxes, image_idxs=None, clip=True):
     """
-    Removes detections with lower object confidence score than 'conf_thres' and performs
-    Non-Maximum Suppression to further filter detections.
-    Returns detections with shape:
-        (x1, y1, x2, y2, object_conf, class_score, class_pred)
+    Maps ABS(xyxy) boxes in letterboxed inputs back to their original images (vectorized, no I/O)
+    letterboxes: (N, 6) records (orig_h, orig_w, scale_h, scale_w, pad_top, pad_left) (see utils.datasets.letterbox_record)
+    image_idxs: image (row of 'letterboxes') of each box (None => one record per box)
     """
+    records = letterboxes if image_idxs is None else letterboxes[image_idxs]
+    records = records.to(boxes.device, boxes.dtype)
+    orig_h, orig_w, scale_h, scale_w, pad_top, pad_left = records.t()
+
+    boxes = boxes.clone()
+    boxes[:, 0::2] = (boxes[:, 0::2] - pad_left.unsqueeze(1)) / scale_w.unsqueeze(1)
+    boxes[:, 1::2] = (boxes[:, 1::2] - pad_top.unsqueeze(1)) / scale_h.unsqueeze(1)
+    if clip:
+        boxes[:, 0::2] = torch.min(boxes[:, 0::2].clamp(min=0), orig_w.unsqueeze(1))
+        boxes[:, 1::2] = torch.min(boxes[:, 1::2].clamp(min=0), orig_h.unsqueeze(1))
+    return boxes
 
-    # From (center x, center y, width, height) to (x1, y1, x2, y2)
-    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
-    output = [None for _ in range(len(prediction))]
-    for image_i, image_pred in enumerate(prediction):
-        # Filter out confidence scores below threshold
-        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
-        # If none are remaining => process next image
-        if not image_pred.size(0):
-            continue
-        # Object confidence times class confidence
-        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
-        # Sort by it
-        image_pred = image_pred[(-score).argsort()]
-        class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
-        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
-        if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
-
-    return output
 
+def unletterbox_detections(detections, letterboxes):
+    """
+    Output of batched_non_max_suppression (list of (n_i, 7)) => same detections with the boxes in the original images.
+    The whole batch is mapped at once
+    """
+    counts = [det.size(0) for det in detections]
+    if not sum(counts):
+        return detections
+    all_detections = torch.cat(detections, 0)
+    image_idxs = torch.repeat_interleave(torch.arange(len(counts)), torch.tensor(counts)).to(all_detections.device)
+    all_detections = all_detections.clone()
+    all_detections[:, :4] = unletterbox_boxes(all_detections[:, :4], letterboxes, image_idxs)
+    return list(all_detections.split(counts))
 
 
 def ap_per_class(tp, conf, pred_cls, target_cls):
@@ -644,21 +805,22 @@ def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres):
     nB = pred_boxes.size(0)  # images
     nA = pred_boxes.size(1)  # anchors
     nC = pred_cls.size(-1)  # classes
-    nG = pred_boxes.size(2)  # grid_size
+    nGh = pred_boxes.size(2)  # grid_h
+    nGw = pred_boxes.size(3)  # grid_w
 
     # Output tensors
-    obj_mask = ByteTensor(nB, nA, nG, nG).fill_(0)
-    noobj_mask = ByteTensor(nB, nA, nG, nG).fill_(1)
-    class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
-    iou_scores = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tx = FloatTensor(nB, nA, nG, nG).fill_(0)
-    ty = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tw = FloatTensor(nB, nA, nG, nG).fill_(0)
-    th = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
-
-    # Convert to position relative to box
-    target_boxes = target[:, 2:6] * nG
+    obj_mask = ByteTensor(nB, nA, nGh, nGw).fill_(0)
+    noobj_mask = ByteTensor(nB, nA, nGh, nGw).fill_(1)
+    class_mask = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    iou_scores = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tx = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    ty = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tw = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    th = FloatTensor(nB, nA, nGh, nGw).fill_(0)
+    tcls = FloatTensor(nB, nA, nGh, nGw, nC).fill_(0)
+
+    # Convert to position relative to box (REL(cxcywh) => grid units)
+    target_boxes = target[:, 2:6] * FloatTensor([nGw, nGh, nGw, nGh])
     gxy = target_boxes[:, :2]
     gwh = target_boxes[:, 2:]
 
@@ -706,107 +868,89 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def plot_bboxes(img, bboxes, class_ids=None, class_probs=None, class_names=None, show_results=True, save_path=None, title=None, colors=None, t_bboxes=None, t_class_ids=None, coords_rel=False):
-    # Settings
-    dpi = 80
-    txt_y_offset = 0.5
+DEFAULT_COLORS = [plt.get_cmap("tab20b")(i) for i in np.linspace(0, 1, 20)]
+
+
+def color2bgr(color):
+    """Matplotlib-like color (RGB/RGBA in [0, 1] or [0, 255]) => cv2 color (BGR, [0, 255])"""
+    color = np.array(color[:3], dtype=np.float64)
+    if color.max() <= 1.0:
+        color = color * 255.0
+    return tuple(int(c) for c in color[::-1])
+
+
+def render_bboxes(img, bboxes, class_ids=None, class_names=None, colors=None, t_bboxes=None, coords_rel=False):
+    """
+    Draws the detections (and ground truth) on a copy of the image => RGB uint8 image.
+    The boxes of each class are drawn with a single cv2 call; ground truth is a translucent green fill
+    """
     img = img2img(img)  # Force casting
+    img = np.squeeze(img, axis=2) if img.ndim == 3 and img.shape[2] == 1 else img
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
     img_h, img_w = img.shape[:2]
-    t_color = np.array([0.0, 200.0, 0.0, 150.0]) / 255.0
-
-    # Bounding-box colors
-    if colors is None:
-        cmap = plt.get_cmap("tab20b")
-        colors = [cmap(i) for i in np.linspace(0, 1, 20)]
-
-    # Default values
-    if class_ids is None:
-        class_ids = [0]*len(bboxes)
-    if class_probs is None:
-        class_probs = [0.0] * len(bboxes)
-    if class_names is None:
-        class_names = ['Unknown'] * len(bboxes)
-    if t_class_ids is None and t_bboxes is not None:
-        t_class_ids = [None] * len(t_bboxes)
-
-    # Config plot
-    fig, ax = plt.subplots()
-    fig.set_size_inches(img_w/dpi, img_h/dpi)
-    if title:
-        fig.canvas.set_window_title(title)
-    r = fig.canvas.get_renderer()
-    plt.tight_layout()
-
-    # Set colormap (if needed)
-    if len(img.shape) == 2:
-        ax.imshow(img, cmap='gray')
-    else:
-        if img.shape[2] == 1:
-            ax.imshow(np.squeeze(img), cmap='gray')
-        else:
-            ax.imshow(img)
-
-    # Coordinates from relative to absolute
-    if coords_rel:
-        if bboxes is not None:
-            bboxes[:, 0] *= img_w
-            bboxes[:, 1] *= img_h
-            bboxes[:, 2] *= img_w
-            bboxes[:, 3] *= img_h
-
-        if t_bboxes is not None:
-            t_bboxes[:, 0] *= img_w
-            t_bboxes[:, 1] *= img_h
-            t_bboxes[:, 2] *= img_w
-            t_bboxes[:, 3] *= img_h
-
-    # Draw bounding boxes and labels of ground truth
-    if t_bboxes is not None:
-        for t_bbox, class_id in zip(t_bboxes, t_class_ids):
-            t_x1, t_y1, t_x2, t_y2 = t_bbox
-            t_bbox = patches.Rectangle((t_x1, t_y1), t_x2 - t_x1, t_y2 - t_y1, color=t_color)
-            ax.add_patch(t_bbox)
-
-    # Draw bounding boxes and labels of detections
-    for p_bbox, class_id, class_prob in zip(bboxes, class_ids, class_probs):
-        # Get color
-        color = colors[int(class_id) % len(colors)]
-
-        # Get box dimensions
-        x1, y1, x2, y2 = p_bbox
-        box_w = x2 - x1
-        box_h = y2 - y1
-
-        # Create a Rectangle patch
-        bbox = patches.Rectangle((x1, y1), box_w, box_h, linewidth=1, edgecolor=color, facecolor="none")
-        # Add the bbox to the plot
-        ax.add_patch(bbox)
-        # Add label
-        txt = plt.text(
-            x1,
-            y1,
-            s=class_names[int(class_id)].title(),
-            color="white",
-            verticalalignment="top",
-            bbox={"color": color, "pad": 0},
-        )
-        txt_bbox = txt.get_window_extent(renderer=r)
-        txt.set_position((x1, y1 - txt_bbox.height * txt_y_offset))
-
-    # Save generated image with detections
-    plt.axis("off")
-    plt.gca().xaxis.set_major_locator(NullLocator())
-    plt.gca().yaxis.set_major_locator(NullLocator())
+    colors = DEFAULT_COLORS if colors is None else colors
+    font, font_scale = cv2.FONT_HERSHEY_SIMPLEX, 0.4
+
+    def to_corners(boxes):
+        boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4)  # Copy (the caller's boxes are not modified)
+        if coords_rel:
+            boxes *= np.array([img_w, img_h, img_w, img_h], dtype=np.float32)
+        x1, y1, x2, y2 = np.round(boxes).astype(np.int32).T
+        return np.stack([np.stack([x1, y1], 1), np.stack([x2, y1], 1), np.stack([x2, y2], 1), np.stack([x1, y2], 1)], 1)
+
+    # Ground truth (translucent fill, all at once)
+    if t_bboxes is not None and len(t_bboxes):
+        overlay = img.copy()
+        cv2.fillPoly(overlay, list(to_corners(t_bboxes)), (0, 200, 0))
+        img = cv2.addWeighted(overlay, 150.0 / 255.0, img, 1.0 - 150.0 / 255.0, 0)
+
+    # Detections: boxes and label backgrounds of each class at once, then the labels
+    if bboxes is not None and len(bboxes):
+        corners = to_corners(bboxes)
+        class_ids = np.zeros(len(corners), dtype=np.int64) if class_ids is None else np.asarray(class_ids).astype(np.int64)
+        for class_id in np.unique(class_ids):
+            name = class_names[class_id].title() if class_names is not None else "Unknown"
+            (txt_w, txt_h), baseline = cv2.getTextSize(name, font, font_scale, 1)
+            class_corners = corners[class_ids == class_id]
+            x1, y1 = class_corners[:, 0, 0], class_corners[:, 0, 1] - (txt_h + baseline) // 2
+            txt_corners = np.stack([np.stack([x1, y1 - txt_h], 1), np.stack([x1 + txt_w, y1 - txt_h], 1),
+                                    np.stack([x1 + txt_w, y1 + baseline], 1), np.stack([x1, y1 + baseline], 1)], 1)
+
+            color = color2bgr(colors[int(class_id) % len(colors)])
+            cv2.polylines(img, list(class_corners), isClosed=True, color=color, thickness=1)
+            cv2.fillPoly(img, list(txt_corners), color)
+            for x, y in zip(x1.tolist(), y1.tolist()):
+                cv2.putText(img, name, (x, y), font, font_scale, (255, 255, 255), 1, cv2.LINE_AA)
+
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def plot_bboxes(img, bboxes, class_ids=None, class_probs=None, class_names=None, show_results=True, save_path=None, title=None, colors=None, t_bboxes=None, t_class_ids=None, coords_rel=False):
+    # Render (cv2, headless)
+    img = render_bboxes(img, bboxes, class_ids=class_ids, class_names=class_names, colors=colors, t_bboxes=t_bboxes,
+                        coords_rel=coords_rel)
 
     # Save image
     if save_path:
-        plt.savefig(save_path, bbox_inches="tight", pad_inches=0.0, dpi=dpi)
+        cv2.imwrite(save_path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
         print("\t\t=> Image saved! ({})".format(save_path))
 
     # Show image
     if show_results:
+        plt.figure(title)
+        plt.imshow(img)
+        plt.axis("off")
         plt.show()
-    plt.close()
+        plt.close()
+
+
+def plot_bboxes_batch(jobs, num_workers=4):
+    """
+    Runs plot_bboxes for each job (dict of its arguments, without show_results) in a thread pool.
+    cv2 releases the GIL, so the pages are rendered in parallel
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(lambda job: plot_bboxes(show_results=False, **job), jobs))
 
 
 def process_detections(img, img_detections, input_size, class_names, show_results=True, save_path=False,
@@ -832,7 +976,8 @@ def process_detections(img, img_detections, input_size, class_names, show_result
 
         # Rescale boxes
         if rescale_bboxes:
-            bboxes = rescale_boxes(bboxes, (input_size, input_size), np_img.shape[:2])
+            current_shape = tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+            bboxes = rescale_boxes(bboxes, current_shape, np_img.shape[:2])
 
         save_path_i = None
         if save_path:
@@ -844,6 +989,21 @@ def process_detections(img, img_detections, input_size, class_names, show_result
                     save_path=save_path_i, title=title, colors=colors, t_bboxes=t_bboxes, t_class_ids=t_class_ids)
 
 
+def detection_record(image_path, detections, original_shape):
+    """
+    Detections of an image in its original coordinates (see unletterbox_detections) => dict (JSON serializable)
+    """
+    orig_h, orig_w = original_shape[:2]
+    return {
+        "image": image_path,
+        "height": int(orig_h),
+        "width": int(orig_w),
+        "boxes": [[round(v, 2) for v in box] for box in detections[:, :4].tolist()],
+        "scores": [round(v, 5) for v in (detections[:, 4] * detections[:, 5]).tolist()],  # P(obj)*P(class|obj)
+        "labels": [int(v) for v in detections[:, 6].tolist()],
+    }
+
+
 def in_target2out_target(in_target, out_h, out_w):
     # in_target => image_i + class_id + REL(cxcywh)
     # out_target => ABS(cxcywh) + obj_conf + class_prob + class_id
@@ -877,12 +1037,25 @@ def img2img(img):
     if isinstance(img, str):
         img = np.array(Image.open(img))
     elif isinstance(img, torch.Tensor):
-        img = np.transpose(img.cpu().numpy()*255.0, (1, 2, 0)).astype(dtype=np.uint8)
+        img = img.cpu().numpy() if img.dtype == torch.uint8 else img.cpu().numpy()*255.0
+        img = np.transpose(img, (1, 2, 0)).astype(dtype=np.uint8)
     elif isinstance(img, np.ndarray):
         img = img.astype(dtype=np.uint8)
     return img
 
 
+def normalize_batch(imgs, device=None, dtype=torch.float32):
+    """
+    Batch from the loaders (uint8, see utils.datasets.image_to_tensor) => 'dtype' in [0.0-1.0] on 'device'.
+    The copy to the device is done first, so it moves 4x fewer bytes than a float batch
+    """
+    if device is not None:
+        imgs = imgs.to(device, non_blocking=True)
+    if imgs.dtype == torch.uint8:
+        imgs = imgs.to(dtype).div_(255.0)
+    return imgs
+
+
 def fix_bboxes(bboxes_xyxy, h, w, area_thres=5*5):
     """
     ABS(xyxy)
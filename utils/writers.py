@@ -0,0 +1,183 @@
+import os
+import json
+import shutil
+import zipfile
+
+import numpy as np
+
+
+class DetectionWriter(object):
+    """
+    Streams detection records (see utils.utils.detection_record) to a file.
+    Use it as a context manager (or call close) so the file is complete
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0  # Images written
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def write_batch(self, records):
+        for record in records:
+            self.write(record)
+        self.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONLWriter(DetectionWriter):
+    """One JSON record per line (ABS(xyxy) boxes in the original image)"""
+
+    def __init__(self, path, append=False):
+        super(JSONLWriter, self).__init__(path)
+        self.f = open(path, "a" if append else "w")
+
+    def write(self, record):
+        self.f.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class COCOWriter(DetectionWriter):
+    """
+    COCO results file (results.json): a list of {image_id, category_id, bbox: ABS(xywh), score}, streamed.
+    image_id is the file name without extension (int if it is a number); category_id is category_ids[class index]
+    (list or dict, eg. the ids of the ground truth annotations), or the class index itself if it is not given
+    """
+
+    def __init__(self, path, category_ids=None):
+        super(COCOWriter, self).__init__(path)
+        self.category_ids = category_ids
+        self.f = open(path, "w")
+        self.f.write("[")
+        self.first = True
+
+    def write(self, record):
+        image_id = os.path.splitext(os.path.basename(record["image"]))[0]
+        image_id = int(image_id) if image_id.isdigit() else image_id
+        for (x1, y1, x2, y2), score, label in zip(record["boxes"], record["scores"], record["labels"]):
+            category_id = self.category_ids[label] if self.category_ids is not None else label
+            result = {"image_id": image_id, "category_id": category_id,
+                      "bbox": [x1, y1, round(x2 - x1, 2), round(y2 - y1, 2)], "score": score}
+            self.f.write(("\n" if self.first else ",\n") + json.dumps(result))
+            self.first = False
+        self.count += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.write("\n]\n")
+        self.f.close()
+
+
+class BinaryWriter(DetectionWriter):
+    """
+    Compact columnar file (*.npz, as LabelStore): names, heights and widths of the images; boxes (float32 ABS(xyxy)),
+    scores (float32) and labels (int16) of all the detections; offsets: detections of image i => [offsets[i], offsets[i+1])
+
+    Memory does not grow with the run: every 'chunk_size' images are appended to a temporary file per column
+    (path.<column>.tmp), and close() streams them into the npz
+    """
+    COLUMNS = {"heights": (np.int32, ()), "widths": (np.int32, ()), "offsets": (np.int64, ()),
+               "boxes": (np.float32, (4,)), "scores": (np.float32, ()), "labels": (np.int16, ())}
+
+    def __init__(self, path, chunk_size=1024):
+        super(BinaryWriter, self).__init__(path)
+        self.chunk_size = chunk_size
+        self.files = {column: open(self.tmp_filename(column), "wb") for column in ["names"] + list(self.COLUMNS)}
+        self.rows = {column: 0 for column in self.COLUMNS}
+        self.name_length = 1  # Longest name (dtype of the names column)
+        self.num_detections = 0
+        self.append("offsets", [0])
+        self.chunk = []
+
+    def tmp_filename(self, column):
+        return "{}.{}.tmp".format(self.path, column)
+
+    def append(self, column, values):
+        dtype, shape = self.COLUMNS[column]
+        values = np.asarray(values, dtype=dtype).reshape((-1,) + shape)
+        self.files[column].write(values.tobytes())
+        self.rows[column] += len(values)
+
+    def write(self, record):
+        self.chunk.append(record)
+        self.count += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        names = [record["image"] for record in self.chunk]
+        self.name_length = max(self.name_length, max(len(name) for name in names))
+        self.files["names"].write(("\n".join(names) + "\n").encode("utf-8"))
+
+        counts = np.array([len(record["labels"]) for record in self.chunk], dtype=np.int64)
+        self.append("heights", [record["height"] for record in self.chunk])
+        self.append("widths", [record["width"] for record in self.chunk])
+        self.append("offsets", self.num_detections + np.cumsum(counts))
+        self.append("boxes", [box for record in self.chunk for box in record["boxes"]])
+        self.append("scores", [score for record in self.chunk for score in record["scores"]])
+        self.append("labels", [label for record in self.chunk for label in record["labels"]])
+        self.num_detections += int(counts.sum())
+        self.chunk = []
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+        # npz = zip of .npy files (as np.savez, without loading the columns)
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_STORED, allowZip64=True) as npz:
+            names_dtype = np.dtype("<U{}".format(self.name_length))
+            with npz.open("names.npy", "w", force_zip64=True) as f, open(self.tmp_filename("names"), "rb") as src:
+                self.write_header(f, names_dtype, (self.count,))
+                for lines in iter(lambda: src.readlines(2 ** 20), []):  # ~1 MB of names at a time
+                    names = [line.decode("utf-8").rstrip("\n") for line in lines]
+                    f.write(np.array(names, dtype=names_dtype).tobytes())
+            for column, (dtype, shape) in self.COLUMNS.items():
+                src_filename = self.tmp_filename(column)
+                with npz.open(column + ".npy", "w", force_zip64=True) as f, open(src_filename, "rb") as src:
+                    self.write_header(f, np.dtype(dtype), (self.rows[column],) + shape)
+                    shutil.copyfileobj(src, f)
+
+        for column in self.files:
+            os.remove(self.tmp_filename(column))
+
+    @staticmethod
+    def write_header(f, dtype, shape):
+        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                 "fortran_order": False, "shape": shape})
+
+
+def get_writer(path, category_ids=None):
+    """
+    Writer for the extension of 'path': *.jsonl (JSON lines), *.json (COCO results) or *.npz (columnar).
+    category_ids: COCO category id of each class index (*.json only)
+    """
+    if path.endswith(".jsonl"):
+        return JSONLWriter(path)
+    elif path.endswith(".json"):
+        return COCOWriter(path, category_ids=category_ids)
+    elif path.endswith(".npz"):
+        return BinaryWriter(path)
+    raise ValueError("Unknown detections format: {} (*.jsonl, *.json or *.npz)".format(path))